@@ -7,16 +7,36 @@ v0.0.2: add OWT retrieval and mulitple source L2A input
 __package__ = 'GRSl2bgen'
 __version__ = '0.0.2'
 
-from .product import Product
-from .output import L2bProduct
-
-from .chlorophyll_a import Chl
-from .suspended_particulate_matter import Spm
-from .cdom import Cdom
-from .transparency import Transparency
-from .owt import OWT, OWT_process
-
-from .process import Process
+# classes are imported on first access, so that the CLI and the worker processes
+# only load the dependencies (xarray, dask, numba, matplotlib, rasterio...) they use
+_lazy_imports = {
+    'Product': 'product',
+    'L2bProduct': 'output',
+    'Chl': 'chlorophyll_a',
+    'Spm': 'suspended_particulate_matter',
+    'Cdom': 'cdom',
+    'Transparency': 'transparency',
+    'OWT': 'owt',
+    'OWT_process': 'owt',
+    'warmup': 'owt',
+    'Process': 'process',
+    'Composite': 'composite',
+    'ZonalStats': 'zonal',
+    'Matchup': 'matchup',
+    'Spectra': 'spectra',
+    'Mosaic': 'mosaic',
+}
+
+
+def __getattr__(name):
+    if name in _lazy_imports:
+        import importlib
+        return getattr(importlib.import_module('.' + _lazy_imports[name], __name__), name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy_imports))
 
 
 
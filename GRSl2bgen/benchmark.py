@@ -0,0 +1,104 @@
+''' Micro-benchmark of the memory layouts of the OWT classification kernels on a synthetic tile
+
+Usage:
+  GRSl2bgen_benchmark [--size <size>] [--repeat <repeat>]
+  GRSl2bgen_benchmark -h | --help
+
+Options:
+  -h --help            Show this screen.
+  --size size          Size of the synthetic square tile (pixels) [default: 1024]
+  --repeat repeat      Number of runs of each kernel, the fastest one being kept [default: 3]
+'''
+
+import json
+import time
+
+import numpy as np
+import xarray as xr
+
+from .owt import OWT
+
+# Sentinel-2 MSI bands of the synthetic tile within the OWT spectral range (nm)
+MSI_WL = [443, 490, 560, 665, 705, 740, 783]
+
+
+def synthetic_tile(size=1024, wl=MSI_WL, seed=0):
+    '''
+    Band-sequential (wl, y, x) Rrs tile of random mixtures of the Spyrakos et al. (2018) OWT spectra,
+    with a few invalid (NaN) pixels.
+
+    :param size: size of the square tile (pixels)
+    :param wl: wavelengths of the bands (nm)
+    :param seed: seed of the random generator
+    :return: xarray Dataset with the Rrs variable
+    '''
+    rng = np.random.default_rng(seed)
+    wl = np.asarray(wl, dtype=np.float32)
+    raster = xr.Dataset(dict(Rrs=(['wl', 'y', 'x'], np.zeros((len(wl), 1, 1), dtype=np.float32))),
+                        coords=dict(wl=wl))
+    spectra = OWT(raster).Rrs_owt.transpose('owt', 'wl').values
+    weights = rng.dirichlet(np.ones(len(spectra)), size=(size, size)).astype(np.float32)
+    Rrs = np.einsum('yxo,ow->wyx', weights, spectra) * rng.uniform(0.5, 2, (size, size)).astype(np.float32)
+    Rrs[:, rng.random((size, size)) < 0.01] = np.nan
+    return xr.Dataset(dict(Rrs=(['wl', 'y', 'x'], Rrs.astype(np.float32))),
+                      coords=dict(wl=wl, y=np.arange(size), x=np.arange(size)))
+
+
+def best_time(func, repeat=3):
+    '''
+    Fastest of several runs of func.
+
+    :return: time (s), result of the last run
+    '''
+    seconds = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        seconds = min(seconds, time.perf_counter() - start)
+    return seconds, result
+
+
+def benchmark_layouts(size=1024, repeat=3):
+    '''
+    Compare the band-sequential (wl, y, x) and pixel-interleaved (y, x, wl) SAM kernels on a synthetic tile:
+    kernel alone, and pixel-interleaved kernel including the layout transform of a band-sequential window.
+
+    :param size: size of the synthetic square tile (pixels)
+    :param repeat: number of runs of each kernel, the fastest one being kept
+    :return: dict of the timings (s), throughputs (Mpixels/s) and check of identical outputs
+    '''
+    raster = synthetic_tile(size)
+    bsq = raster.Rrs.values
+    bip = np.ascontiguousarray(bsq.transpose(1, 2, 0))
+    kernel_bsq = OWT(raster, layout='bsq')
+    kernel_bip = OWT(raster, layout='bip')
+    # compilation (or loading from the cache) is not timed
+    kernel_bsq.classify(bsq[:, :1, :1])
+    kernel_bip.classify_bip(bip[:1, :1])
+
+    runs = dict(bsq=lambda: kernel_bsq.classify(bsq),
+                bip=lambda: kernel_bip.classify_bip(bip),
+                bip_transform=lambda: kernel_bip.classify(bsq))
+    report = dict(size=size, bands=bsq.shape[0], owt=kernel_bsq.Nowt)
+    outputs = {}
+    for layout, run in runs.items():
+        seconds, outputs[layout] = best_time(run, repeat)
+        report[layout] = dict(seconds=round(seconds, 4),
+                              Mpixels_per_second=round(size ** 2 / seconds / 1e6, 2))
+    report['identical'] = all(np.array_equal(output, reference, equal_nan=True)
+                              for layout in ['bip', 'bip_transform']
+                              for output, reference in zip(outputs[layout], outputs['bsq']))
+    report['speedup'] = round(report['bsq']['seconds'] / report['bip_transform']['seconds'], 2)
+    return report
+
+
+def main():
+    from docopt import docopt
+
+    args = docopt(__doc__)
+    report = benchmark_layouts(size=int(args['--size']), repeat=int(args['--repeat']))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
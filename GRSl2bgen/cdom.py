@@ -2,14 +2,18 @@ import os
 import numpy as np
 import xarray as xr
 
+from .uncertainty import band_uncertainty, quadrature, uncertainty_layer
+
 
 class Cdom():
     def __init__(self,
                  raster,
-                 param='Rrs'):
+                 param='Rrs',
+                 unc_param=None):
 
         self.raster = raster
         self.Rrs = raster[param]
+        self.Rrs_unc = band_uncertainty(raster, unc_param)
         self.output = None
 
 
@@ -29,10 +33,20 @@ class Cdom():
             'units': 'm-1',
             'range':[0,60]}
 
-        self.output = xr.merge([acdom_B15])
+        params = [acdom_B15]
+        if self.Rrs_unc is not None:
+            params.append(uncertainty_layer(self.brezonik15_unc(acdom_B15, acoef=acoef), acdom_B15))
+        self.output = xr.merge(params)
 
     def set_range(self,param,minval=0,maxval=30):
         return param.where((param>minval)&(param<maxval) )
 
     def brezonik15(self, acoef = [1.872, -0.83]):
         return np.exp(acoef[0] + acoef[1] * np.log(self.Rrs.sel(wl=490) / self.Rrs.sel(wl=740)))
+
+    def brezonik15_unc(self, acdom, acoef=[1.872, -0.83]):
+        '''
+        Uncertainty of brezonik15: power law of the 490/740 ratio.
+        '''
+        return np.abs(acoef[1] * acdom) * quadrature(self.Rrs_unc.sel(wl=490) / self.Rrs.sel(wl=490),
+                                                     self.Rrs_unc.sel(wl=740) / self.Rrs.sel(wl=740))
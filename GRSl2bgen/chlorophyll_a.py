@@ -2,14 +2,18 @@ import os
 import numpy as np
 import xarray as xr
 
+from .uncertainty import band_uncertainty, quadrature, uncertainty_layer
+
 
 class Chl():
     def __init__(self,
                  raster,
-                 param='Rrs'):
+                 param='Rrs',
+                 unc_param=None):
 
         self.raster = raster
         self.Rrs = raster[param]
+        self.Rrs_unc = band_uncertainty(raster, unc_param)
         self.OC2ratio = self.OC2_ratio()
         self.OC3ratio = self.OC3_ratio()
         self.output=None
@@ -17,6 +21,7 @@ class Chl():
     def process(self):
         # NASA OC2 for OCTS; bands 490, 565 nm
         acoef = [0.2236, -1.8296, 1.9094, -2.9481, -0.1718]
+        self.OC2_acoef = acoef
         self.chl_nasa_oc2 = self.OC2(acoef)
         self.chl_nasa_oc2 = self.set_range(self.chl_nasa_oc2)
         self.chl_nasa_oc2.name = 'Chla_OC2nasa'
@@ -30,6 +35,7 @@ class Chl():
 
         # Gitelson-like Red-edge
         acoef = [232.329, 23.174]
+        self.M09B_acoef = acoef
         self.chl_M09B = self.M09B(acoef=acoef)
         self.chl_M09B = self.set_range(self.chl_M09B)
         self.chl_M09B.name = 'Chla_M09B'
@@ -44,7 +50,11 @@ class Chl():
             'range':[0,2000]
             }
 
-        self.output = xr.merge([self.chl_nasa_oc2,self.chl_M09B]).drop_vars('wl').load()
+        params = [self.chl_nasa_oc2, self.chl_M09B]
+        if self.Rrs_unc is not None:
+            params += [uncertainty_layer(self.OC2_unc(self.chl_nasa_oc2, self.OC2_acoef), self.chl_nasa_oc2),
+                       uncertainty_layer(self.M09B_unc(self.M09B_acoef), self.chl_M09B)]
+        self.output = xr.merge(params).drop_vars('wl')
 
     def set_range(self,param,minval=0,maxval=1200):
         return param.where((param>minval)&(param<maxval) )
@@ -66,6 +76,16 @@ class Chl():
     def OC2(self, acoef):
         return self.OCX_chl(self.OC2ratio, acoef)
 
+    def OC2_unc(self, chl, acoef):
+        '''
+        Uncertainty of OC2: d(chl)/d(Rrs_i) = chl * d(log10 chl)/d(ratio) / Rrs_i (ln(10) terms cancel out).
+        '''
+        dlogchl = 0
+        for i in range(1, len(acoef)):
+            dlogchl += i * acoef[i] * self.OC2ratio ** (i - 1)
+        return np.abs(chl * dlogchl) * quadrature(self.Rrs_unc.sel(wl=490) / self.Rrs.sel(wl=490),
+                                                   self.Rrs_unc.sel(wl=560) / self.Rrs.sel(wl=560))
+
     def OC3(self, acoef):
         blue = np.max(self.Rrs.sel(wl=[443, 490]))
         ratio = np.log10(blue / self.Rrs.sel(wl=560))
@@ -82,6 +102,16 @@ class Chl():
         index = self.RED3()
         return (acoef[0] * index + acoef[1])
 
+    def M09B_unc(self, acoef=np.array([232.329, 23.174])):
+        '''
+        Uncertainty of M09B from the partial derivatives of the RED3 index.
+        '''
+        R665, R705, R740 = [self.Rrs.sel(wl=wl) for wl in [665, 705, 740]]
+        u665, u705, u740 = [self.Rrs_unc.sel(wl=wl) for wl in [665, 705, 740]]
+        return np.abs(acoef[0]) * quadrature(R740 / R665 ** 2 * u665,
+                                             R740 / R705 ** 2 * u705,
+                                             (1 / R665 - 1 / R705) * u740)
+
     def G10B(self, acoef=np.array([113.36, -16.45, 1.124])):
         index = self.RED3(self.Rrs)
         return ((acoef[0] * index + acoef[1]) ** acoef[2])
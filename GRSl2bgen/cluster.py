@@ -0,0 +1,376 @@
+''' Distributed processing of tile archives, on a dask-distributed cluster or through a file-based work queue
+
+Usage:
+  GRSl2bgen_worker <queue_dir> [--retries <retries>] [--lease <lease>] [--streaming]
+  GRSl2bgen_worker -h | --help
+
+Options:
+  -h --help              Show this screen.
+
+  <queue_dir>            Directory of the work queue (shared between the nodes), see TileQueue
+  --retries retries      Number of attempts of a tile before it is set as failed [default: 3]
+  --lease lease          Seconds without heartbeat after which a running tile is requeued [default: 600]
+  --streaming            Process and write the tiles window by window.
+
+  Example:
+      # on the submitting node
+      python -c "from GRSl2bgen.cluster import TileQueue; TileQueue('/shared/queue').submit(l2a_files, '/shared/L2B')"
+      # on each worker node
+      GRSl2bgen_worker /shared/queue
+'''
+
+import os
+import glob
+import json
+import time
+import socket
+import threading
+import contextlib
+
+import dask
+import logging
+
+from .process import Process
+from .owt import warmup
+
+
+def worker_name():
+    try:
+        from dask.distributed import get_worker
+        return get_worker().address
+    except (ImportError, ValueError):
+        return '{}-{:d}'.format(socket.gethostname(), os.getpid())
+
+
+def l2b_name(l2a_obj, odir):
+    basename = os.path.basename(l2a_obj.rstrip('/'))
+    if basename[-3:] != '.nc':
+        basename = basename + '.nc'
+    return os.path.join(odir, basename.replace('L2Agrs', 'L2B'))
+
+
+def process_tile(l2a_obj, l2b_path, **kwargs):
+    '''
+    Process one tile with the threads of the current worker. The product is written into a temporary file
+    and committed by an atomic rename, so that a retried or duplicated job never leaves a partial product.
+
+    :param l2a_obj: path of the L2A input image
+    :param l2b_path: path of the L2B output file
+    :param kwargs: options of Process
+    :return: dict of the job statistics
+    '''
+    start = time.perf_counter()
+    odir = os.path.dirname(l2b_path)
+    if (odir != '') and not os.path.exists(odir):
+        os.makedirs(odir, exist_ok=True)
+    root, extension = os.path.splitext(l2b_path)
+    tmp_root = '{}.tmp-{}-{:d}'.format(root, socket.gethostname(), os.getpid())
+
+    try:
+        with dask.config.set(scheduler='threads'):
+            process = Process(l2a_obj, tmp_root + extension, scheduler='threads', **kwargs)
+            process.execute()
+            process.write_output()
+        for sidecar in ['_zonal.csv', '_qa.json']:
+            if os.path.exists(tmp_root + sidecar):
+                os.replace(tmp_root + sidecar, root + sidecar)
+        os.replace(tmp_root + extension, l2b_path)
+    finally:
+        for tmp_file in [tmp_root + extension, tmp_root + '_zonal.csv', tmp_root + '_qa.json']:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    return dict(l2a=l2a_obj,
+                l2b=l2b_path,
+                worker=worker_name(),
+                seconds=time.perf_counter() - start,
+                pixels=process.prod.raster.sizes['y'] * process.prod.raster.sizes['x'])
+
+
+def throughput(records):
+    '''
+    Per-worker throughput of the processed tiles.
+
+    :param records: list of job statistics (see process_tile)
+    :return: dict of the number of tiles, processing time and Mpixels per second of each worker
+    '''
+    report = {}
+    for record in records:
+        worker = report.setdefault(record['worker'], dict(tiles=0, seconds=0., Mpixels=0.))
+        worker['tiles'] += 1
+        worker['seconds'] += record['seconds']
+        worker['Mpixels'] += record['pixels'] / 1e6
+    for worker in report.values():
+        worker['Mpixels_per_second'] = round(worker['Mpixels'] / worker['seconds'], 3)
+        worker['seconds'] = round(worker['seconds'], 3)
+    return report
+
+
+class Cluster():
+    '''
+    Distribution of tiles over the workers of a dask-distributed cluster.
+    '''
+
+    def __init__(self,
+                 scheduler=None,
+                 n_workers=2,
+                 threads_per_worker=1):
+        '''
+
+        :param scheduler: address of the dask-distributed scheduler (e.g., "tcp://10.0.0.1:8786");
+                          if None, a local multi-process cluster is started
+        :param n_workers: number of workers of the local cluster
+        :param threads_per_worker: number of threads per worker of the local cluster
+        '''
+        from dask.distributed import Client, LocalCluster
+
+        if scheduler is None:
+            self.cluster = LocalCluster(n_workers=n_workers, threads_per_worker=threads_per_worker)
+            self.client = Client(self.cluster)
+        else:
+            self.cluster = None
+            self.client = Client(scheduler)
+        # numba kernels are compiled by the workers before receiving the tiles
+        self.client.run(warmup)
+        self.records = []
+        self.failed = {}
+
+    def process(self, l2a_objs, odir, retries=2, no_clobber=True, **kwargs):
+        '''
+        Process the tiles, one task per tile.
+
+        :param l2a_objs: list of paths of the L2A images (accessible from the workers)
+        :param odir: output directory (accessible from the workers)
+        :param retries: number of times a failed tile is resubmitted
+        :param no_clobber: skip the tiles whose L2B product already exists
+        :param kwargs: options of Process
+        :return: per-worker throughput report
+        '''
+        from dask.distributed import as_completed
+
+        futures = {}
+        for l2a_obj in l2a_objs:
+            l2b_path = l2b_name(l2a_obj, odir)
+            if no_clobber and os.path.exists(l2b_path):
+                logging.info('File ' + l2b_path + ' already processed; skip!')
+                continue
+            future = self.client.submit(process_tile, l2a_obj, l2b_path, retries=retries, pure=False, **kwargs)
+            futures[future] = l2a_obj
+
+        for future in as_completed(futures):
+            if future.status == 'error':
+                self.failed[futures[future]] = repr(future.exception())
+                logging.info('failed: ' + futures[future] + ' ' + self.failed[futures[future]])
+                continue
+            self.records.append(future.result())
+
+        report = throughput(self.records)
+        logging.info('throughput: ' + json.dumps(report))
+        return report
+
+    def close(self):
+        self.client.close()
+        if self.cluster is not None:
+            self.cluster.close()
+
+
+class TileQueue():
+    '''
+    File-based work queue in a shared directory: a job file is claimed by an atomic rename
+    from todo/ to running/, then moved to done/ (with its statistics) or back to todo/ until
+    the number of retries is reached (failed/).
+    A claimed job is leased: its worker touches the job file while processing it (heartbeat),
+    and jobs whose file has not been touched for longer than the lease (dead node, killed job)
+    are moved back to todo/ by the other workers.
+    '''
+
+    states = ['todo', 'running', 'done', 'failed']
+
+    def __init__(self, queue_dir, lease=600):
+        '''
+
+        :param queue_dir: directory of the queue, shared between the nodes
+        :param lease: seconds without heartbeat after which a running job is requeued
+                      (the heartbeat period is a quarter of the lease)
+        '''
+        self.queue_dir = queue_dir
+        self.lease = lease
+        for state in self.states:
+            os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+
+    def path(self, state, name):
+        return os.path.join(self.queue_dir, state, name)
+
+    def submit(self, l2a_objs, odir, **kwargs):
+        '''
+        Add a job per tile to the queue.
+
+        :param l2a_objs: list of paths of the L2A images
+        :param odir: output directory
+        :param kwargs: options of Process
+        :return: list of the job names
+        '''
+        names = []
+        for l2a_obj in l2a_objs:
+            name = os.path.basename(l2a_obj.rstrip('/')) + '.json'
+            job = dict(l2a=l2a_obj, l2b=l2b_name(l2a_obj, odir), kwargs=kwargs, attempts=0)
+            tmp_file = self.path('todo', '.' + name)
+            with open(tmp_file, 'w') as f:
+                json.dump(job, f)
+            os.replace(tmp_file, self.path('todo', name))
+            names.append(name)
+        return names
+
+    def claim(self):
+        '''
+        Claim the next job; the rename fails if another worker claimed it first.
+        The attempt is counted in the job file, whose modification time starts the lease.
+        '''
+        for name in sorted(os.listdir(os.path.join(self.queue_dir, 'todo'))):
+            if name.startswith('.'):
+                continue
+            try:
+                os.rename(self.path('todo', name), self.path('running', name))
+            except OSError:
+                continue
+            with open(self.path('running', name)) as f:
+                job = json.load(f)
+            job['attempts'] += 1
+            job['worker'] = worker_name()
+            self.write(self.path('running', name), job)
+            return name, job
+        return None, None
+
+    @staticmethod
+    def write(file, job):
+        tmp_file = os.path.join(os.path.dirname(file), '.' + os.path.basename(file))
+        with open(tmp_file, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_file, file)
+
+    def release(self, name, job, state):
+        '''
+        Move a running job to its final state; if its lease expired meanwhile, the job was requeued
+        (and possibly claimed by another worker) and is left as it is.
+        '''
+        try:
+            os.rename(self.path('running', name), self.path('running', '.' + name + '.released'))
+        except OSError:
+            logging.info('lease of ' + name + ' expired, job requeued')
+            return False
+        self.write(self.path(state, name), job)
+        os.remove(self.path('running', '.' + name + '.released'))
+        return True
+
+    @contextlib.contextmanager
+    def heartbeat(self, name):
+        '''
+        Touch the file of a running job every quarter of the lease while it is processed.
+        '''
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease / 4):
+                try:
+                    os.utime(self.path('running', name))
+                except OSError:
+                    return
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def requeue_stale(self, retries=3):
+        '''
+        Move the running jobs whose lease expired back to todo/ (or to failed/ after the last attempt).
+
+        :param retries: number of attempts of a job before it is set as failed
+        :return: names of the requeued jobs
+        '''
+        requeued = []
+        now = time.time()
+        for name in os.listdir(os.path.join(self.queue_dir, 'running')):
+            if name.startswith('.'):
+                continue
+            try:
+                if now - os.path.getmtime(self.path('running', name)) < self.lease:
+                    continue
+                # the rename fails if another worker requeued it first (or its worker released it)
+                stale = self.path('running', '.' + name + '.stale')
+                os.rename(self.path('running', name), stale)
+            except OSError:
+                continue
+            with open(stale) as f:
+                job = json.load(f)
+            job['error'] = 'lease expired on ' + job.get('worker', 'unknown worker')
+            state = 'todo' if job['attempts'] < retries else 'failed'
+            logging.info('requeue {} ({})'.format(name, job['error']))
+            self.write(self.path(state, name), job)
+            os.remove(stale)
+            requeued.append(name)
+        return requeued
+
+    def work(self, retries=3, **kwargs):
+        '''
+        Process the jobs of the queue until it is empty.
+
+        :param retries: number of attempts of a job before it is set as failed
+        :param kwargs: options of Process overriding those of the jobs
+        :return: statistics of the jobs processed by this worker
+        '''
+        records = []
+        while True:
+            self.requeue_stale(retries)
+            name, job = self.claim()
+            if name is None:
+                break
+            logging.info('process ' + job['l2a'] + ' (attempt {:d})'.format(job['attempts']))
+            try:
+                with self.heartbeat(name):
+                    if os.path.exists(job['l2b']):
+                        logging.info('File ' + job['l2b'] + ' already processed; skip!')
+                    else:
+                        job['stats'] = process_tile(job['l2a'], job['l2b'], **{**job['kwargs'], **kwargs})
+                if 'stats' in job:
+                    records.append(job['stats'])
+                self.release(name, job, 'done')
+            except Exception as error:
+                job['error'] = repr(error)
+                logging.info('failed: ' + job['l2a'] + ' ' + job['error'])
+                self.release(name, job, 'todo' if job['attempts'] < retries else 'failed')
+        return records
+
+    def report(self):
+        '''
+        Number of jobs per state and per-worker throughput of the processed jobs.
+        '''
+        records, counts = [], {}
+        for state in self.states:
+            files = glob.glob(self.path(state, '*.json'))
+            counts[state] = len(files)
+            if state == 'done':
+                for file in files:
+                    with open(file) as f:
+                        job = json.load(f)
+                    if 'stats' in job:
+                        records.append(job['stats'])
+        return dict(jobs=counts, throughput=throughput(records))
+
+
+def main():
+    from docopt import docopt
+
+    args = docopt(__doc__)
+    queue = TileQueue(args['<queue_dir>'], lease=float(args['--lease']))
+    warmup()
+    kwargs = dict(streaming=True) if args['--streaming'] else {}
+    queue.work(retries=int(args['--retries']), **kwargs)
+    print(json.dumps(queue.report()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+'''
+Module dedicated to temporal composites of L2B products.
+'''
+
+import os, re
+import itertools
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import logging
+
+from .output import L2bProduct, LOG_MIN, is_log_param
+
+
+class Composite():
+    '''
+    Streaming temporal statistics over a collection of L2B products.
+    '''
+
+    def __init__(self,
+                 l2b_objs,
+                 variables=None,
+                 quantiles=[0.5],
+                 chunk=512,
+                 nbins=128):
+        '''
+        Compute running statistics over several L2B products with bounded memory:
+        each spatial window is read from every product in turn and reduced into
+        per-pixel accumulators (count, mean, variance, histogram sketch for the quantiles
+        and class counters for the OWT modes).
+
+        :param l2b_objs: list of paths or xarray of the L2B products (same grid)
+        :param variables: variables to composite, all the L2B parameters if None
+        :param quantiles: quantiles approximated from the per-pixel histogram sketches
+        :param chunk: size of the spatial windows streamed over the products
+        :param nbins: number of bins of the histogram sketches
+        '''
+        self.l2b_objs = l2b_objs
+        self.quantiles = quantiles
+        self.chunk = chunk
+        self.nbins = nbins
+        self.output = None
+
+        self.l2b_rasters = [L2bProduct.decode(xr.open_dataset(obj, decode_coords='all'))
+                            if isinstance(obj, str) else obj for obj in l2b_objs]
+        self.Nprod = len(self.l2b_rasters)
+        self.check_grid()
+
+        ref = self.l2b_rasters[0]
+        if variables is None:
+            variables = [variable for variable in ref.data_vars
+                         if ref[variable].dims == ('y', 'x') and
+                         variable not in ['mask', 'flags']]
+        self.variables = variables
+        self.owt_variables = [variable for variable in variables if variable.startswith('owt_index')]
+        self.height, self.width = ref.sizes['y'], ref.sizes['x']
+
+        self.bin_edges = {}
+        for variable in self.variables:
+            if variable not in self.owt_variables:
+                self.bin_edges[variable] = self.get_bin_edges(ref[variable])
+
+    def check_grid(self):
+        ref = self.l2b_rasters[0]
+        for raster in self.l2b_rasters[1:]:
+            if not (np.array_equal(raster.x, ref.x) and np.array_equal(raster.y, ref.y)):
+                raise ValueError('L2B products to composite must share the same x/y grid')
+
+    def get_bin_edges(self, param):
+        '''
+        Get the bin edges of the histogram sketch from the declared range of the parameter,
+        or from the int16 packing range when no range is declared.
+        '''
+        if 'range' in param.attrs:
+            minval, maxval = np.array(param.attrs['range'], dtype=np.float64)[:2]
+        elif 'scale_factor' in param.encoding:
+            scale_factor, add_offset = param.encoding['scale_factor'], param.encoding['add_offset']
+            minval = add_offset - 2 ** 15 * scale_factor
+            maxval = add_offset + (2 ** 15 - 1) * scale_factor
+        else:
+            minval, maxval = float(param.min()), float(param.max())
+
+        if is_log_param(param.name):
+            return np.logspace(np.log10(max(minval, LOG_MIN)), np.log10(maxval), self.nbins + 1)
+        return np.linspace(minval, maxval, self.nbins + 1)
+
+    @staticmethod
+    def group_files(files, freq='MS'):
+        '''
+        Group L2B files per period from the acquisition date in their names
+        (e.g., S2B_MSIL2B_20220731T103629_...).
+
+        :param files: list of L2B file paths
+        :param freq: pandas frequency of the periods (e.g., 'MS' for monthly composites)
+        :return: dictionary {period start: list of files}
+        '''
+        dates = []
+        for file in files:
+            date = re.search(r'\d{8}T\d{6}', os.path.basename(file))
+            if date is None:
+                raise ValueError('no acquisition date found in ' + file)
+            dates.append(pd.Timestamp(date.group()))
+        series = pd.Series(files, index=pd.DatetimeIndex(dates)).sort_index()
+        return {period: list(group.values) for period, group in series.groupby(pd.Grouper(freq=freq)) if len(group) > 0}
+
+    @staticmethod
+    def hist_quantiles(hist, count, bin_edges, quantiles):
+        '''
+        Approximate quantiles from per-pixel histograms with linear interpolation within the bins.
+
+        :param hist: histograms of shape (Nbins, Npix)
+        :param count: number of observations per pixel
+        :param bin_edges: edges of the Nbins bins
+        :param quantiles: list of quantiles
+        :return: array of shape (Nquantiles, Npix)
+        '''
+        cumhist = np.cumsum(hist, axis=0)
+        ipix = np.arange(hist.shape[1])
+        out = np.full((len(quantiles), hist.shape[1]), np.nan, dtype=np.float32)
+        for iq, q in enumerate(quantiles):
+            target = q * count
+            ibin = np.argmax(cumhist >= np.maximum(target, 1e-9), axis=0)
+            prev = cumhist[ibin, ipix] - hist[ibin, ipix]
+            frac = np.clip((target - prev) / np.maximum(hist[ibin, ipix], 1), 0, 1)
+            out[iq] = bin_edges[ibin] + frac * (bin_edges[ibin + 1] - bin_edges[ibin])
+        out[:, count == 0] = np.nan
+        return out
+
+    def process_window(self, iy, yc, ix, xc):
+        '''
+        Statistics of a spatial window.
+
+        :return: dictionary {(variable, statistic): array}
+        '''
+        Ny, Nx = yc - iy, xc - ix
+        Npix = Ny * Nx
+        ipix = np.arange(Npix)
+        stats = {}
+        for variable in self.variables:
+            stats[variable] = dict(count=np.zeros(Npix, dtype=np.uint16))
+            if variable in self.owt_variables:
+                # categorical variables: class counters only (mode), no mean/variance
+                stats[variable]['classes'] = {}
+                continue
+            stats[variable].update(mean=np.zeros(Npix, dtype=np.float64),
+                                   M2=np.zeros(Npix, dtype=np.float64))
+            if len(self.quantiles) > 0:
+                stats[variable]['hist'] = np.zeros((self.nbins, Npix), dtype=np.uint16)
+
+        for raster in self.l2b_rasters:
+            window = raster.isel(y=slice(iy, yc), x=slice(ix, xc))
+            if 'mask' in window.keys():
+                good = window['mask'].values.ravel() == 0
+            else:
+                good = np.ones(Npix, dtype=bool)
+
+            for variable in self.variables:
+                if variable not in window.keys():
+                    continue
+                arr = window[variable].values.ravel().astype(np.float64)
+                valid = good & np.isfinite(arr)
+                stat = stats[variable]
+
+                stat['count'][valid] += 1
+
+                if variable in self.owt_variables:
+                    # class indices are not exact integers once unpacked from int16
+                    arr = np.rint(arr)
+                    for owt in np.unique(arr[valid]).astype(int):
+                        if owt not in stat['classes']:
+                            stat['classes'][owt] = np.zeros(Npix, dtype=np.uint16)
+                        stat['classes'][owt][valid & (arr == owt)] += 1
+                    continue
+
+                # Welford update of mean and variance
+                delta = arr[valid] - stat['mean'][valid]
+                stat['mean'][valid] += delta / stat['count'][valid]
+                stat['M2'][valid] += delta * (arr[valid] - stat['mean'][valid])
+
+                if len(self.quantiles) > 0:
+                    bin_edges = self.bin_edges[variable]
+                    ibin = np.clip(np.searchsorted(bin_edges, arr[valid], side='right') - 1, 0, self.nbins - 1)
+                    stat['hist'] += np.bincount(ibin * Npix + ipix[valid],
+                                                minlength=self.nbins * Npix).reshape(self.nbins, Npix).astype(np.uint16)
+
+        output = {}
+        for variable, stat in stats.items():
+            count = stat['count']
+            output[variable, 'count'] = count.reshape(Ny, Nx)
+            if variable in self.owt_variables:
+                classes = sorted(stat['classes'].keys())
+                if len(classes) > 0:
+                    counters = np.stack([stat['classes'][owt] for owt in classes])
+                    mode = np.array(classes, dtype=np.float32)[np.argmax(counters, axis=0)]
+                else:
+                    mode = np.full(Npix, np.nan, dtype=np.float32)
+                output[variable, 'mode'] = np.where(count > 0, mode, np.nan).reshape(Ny, Nx)
+            else:
+                mean = np.where(count > 0, stat['mean'], np.nan)
+                std = np.where(count > 1, np.sqrt(stat['M2'] / np.maximum(count - 1, 1)), np.nan)
+                output[variable, 'mean'] = mean.reshape(Ny, Nx)
+                output[variable, 'std'] = std.reshape(Ny, Nx)
+                if len(self.quantiles) == 0:
+                    continue
+                qvalues = self.hist_quantiles(stat['hist'], count, self.bin_edges[variable], self.quantiles)
+                for q, qvalue in zip(self.quantiles, qvalues):
+                    output[variable, 'q{:d}'.format(int(round(100 * q)))] = qvalue.reshape(Ny, Nx)
+        return output
+
+    def process(self):
+        logging.info('compute temporal composite over {:d} products'.format(self.Nprod))
+        chunk = self.chunk
+        height, width = self.height, self.width
+
+        # {(variable, statistic): array}, so that the names of the statistics are never parsed back
+        arrays = {}
+        for iy, ix in itertools.product(range(0, height, chunk), range(0, width, chunk)):
+            yc = min(height, iy + chunk)
+            xc = min(width, ix + chunk)
+            for key, arr in self.process_window(iy, yc, ix, xc).items():
+                if key not in arrays:
+                    if key[1] == 'count':
+                        arrays[key] = np.zeros((height, width), dtype=np.uint16)
+                    else:
+                        arrays[key] = np.full((height, width), np.nan, dtype=np.float32)
+                arrays[key][iy:yc, ix:xc] = arr
+
+        ######################################
+        # construct xarray composite
+        ######################################
+        ref = self.l2b_rasters[0]
+        composite = xr.Dataset(coords=dict(x=ref.x, y=ref.y))
+        if 'spatial_ref' in ref.variables:
+            composite['spatial_ref'] = ref['spatial_ref']
+        for (variable, statistic), arr in arrays.items():
+            if statistic == 'count':
+                attrs = {'description': 'number of valid observations', 'units': '1'}
+            else:
+                attrs = {key: val for key, val in ref[variable].attrs.items() if key not in ['grid_mapping']}
+                attrs['statistic'] = statistic
+            composite[variable + '_' + statistic] = xr.DataArray(arr, dims=('y', 'x'), attrs=attrs)
+        composite.attrs = {key: val for key, val in ref.attrs.items()
+                           if not key.startswith(('processing_time', 'processor'))}
+        composite.attrs['composite_number_of_products'] = self.Nprod
+        composite.attrs['composite_sources'] = '\n'.join([os.path.basename(obj) for obj in self.l2b_objs
+                                                           if isinstance(obj, str)])
+        self.output = composite
+        return composite
+
+    def export_to_netcdf(self, ofile):
+        '''
+        Write the composite with the int16 encoding of the L2B products.
+        '''
+        l2b = L2bProduct(None, [self.output])
+        l2b.export_to_netcdf(ofile)
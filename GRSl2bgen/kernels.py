@@ -0,0 +1,194 @@
+''' Compiled pixel kernels of GRSl2bgen
+
+The kernels are compiled for explicit signatures (float32 arrays of any layout, int64 sizes)
+on their first call, not at import, and cached on disk (numba cache=True), so that the compilation
+is paid once per installation. They release the GIL to run in parallel in dask threads.
+
+Usage:
+  GRSl2bgen_precompile
+
+  Compile and cache the kernels, e.g., when building a container image.
+'''
+
+import time
+import functools
+import threading
+
+import numpy as np
+
+# Rrs (wl, y, x), Rrs_owt (owt, wl), Nwl, Ny, Nx, Nowt
+_SAM_ARGS = '(float32[:, :, :], float32[:, :], int64, int64, int64, int64)'
+# Rrs (y, x, wl) C-contiguous, Rrs_owt (owt, wl), Ny, Nx, Nwl, Nowt
+_SAM_BIP_ARGS = '(float32[:, :, ::1], float32[:, :], int64, int64, int64, int64)'
+
+_compile_lock = threading.Lock()
+
+
+def lazy_njit(signature, **options):
+    '''
+    numba.njit with an explicit signature, compiled (or loaded from the cache) on the first call
+    so that importing the kernels does not load numba.
+
+    :param signature: numba signature as a string
+    :param options: options of numba.njit
+    '''
+    def decorator(func):
+        dispatcher = []
+
+        @functools.wraps(func)
+        def kernel(*args):
+            if not dispatcher:
+                # first call, possibly from several dask threads at once
+                with _compile_lock:
+                    if not dispatcher:
+                        from numba import njit
+                        dispatcher.append(njit(signature, **options)(func))
+            return dispatcher[0](*args)
+
+        return kernel
+
+    return decorator
+
+
+@lazy_njit('Tuple((float32[:, :, ::1], float32[:, ::1]))' + _SAM_ARGS, cache=True, nogil=True)
+def sam(Rrs, Rrs_owt,
+        Nwl, Ny, Nx, Nowt):
+    '''
+    Spectral angle between the Rrs spectra and the OWT reference spectra.
+
+    :return: spectral angles (owt, y, x) and index of the closest OWT (y, x), starting at 1
+    '''
+    arr_sam = np.full((Nowt, Ny, Nx), np.nan, dtype=np.float32)
+    arr_index = np.full((Ny, Nx), np.nan, dtype=np.float32)
+    Rrs_owt_mod = np.full((Nowt), 0., dtype=np.float32)
+
+    for iowt in range(Nowt):
+        for iwl in range(Nwl):
+            Rrs_owt_mod[iowt] += Rrs_owt[iowt, iwl] ** 2
+        Rrs_owt_mod[iowt] = Rrs_owt_mod[iowt] ** 0.5
+
+    for _iy in range(Ny):
+        for _ix in range(Nx):
+            if np.isnan(Rrs[0, _iy, _ix]):
+                continue
+            for iowt in range(Nowt):
+                denum = 0.
+                Rrs_mod = 0.
+
+                for iwl in range(Nwl):
+                    denum += Rrs[iwl, _iy, _ix] * Rrs_owt[iowt, iwl]
+                    Rrs_mod += Rrs[iwl, _iy, _ix] ** 2
+                Rrs_mod = Rrs_mod ** 0.5
+                arr_sam[iowt, _iy, _ix] = np.arccos(denum / (Rrs_mod * Rrs_owt_mod[iowt]))
+            arr_index[_iy, _ix] = np.argmin(arr_sam[:, _iy, _ix]) + 1
+
+    return arr_sam, arr_index
+
+
+@lazy_njit('Tuple((float32[:, ::1], float32[:, ::1]))' + _SAM_ARGS, cache=True, nogil=True)
+def sam_classify(Rrs, Rrs_owt,
+                 Nwl, Ny, Nx, Nowt):
+    '''
+    Index of the closest OWT and spectral distance to it (-angle/pi), without storing the angles
+    of every OWT (same values as sam followed by the maximum of -angle/pi).
+
+    :return: OWT index (y, x), starting at 1, and distance (y, x)
+    '''
+    arr_index = np.full((Ny, Nx), np.nan, dtype=np.float32)
+    arr_dist = np.full((Ny, Nx), np.nan, dtype=np.float32)
+    Rrs_owt_mod = np.full((Nowt), 0., dtype=np.float32)
+    pixel_sam = np.empty((Nowt), dtype=np.float32)
+    pi = np.float32(np.pi)
+
+    for iowt in range(Nowt):
+        for iwl in range(Nwl):
+            Rrs_owt_mod[iowt] += Rrs_owt[iowt, iwl] ** 2
+        Rrs_owt_mod[iowt] = Rrs_owt_mod[iowt] ** 0.5
+
+    for _iy in range(Ny):
+        for _ix in range(Nx):
+            if np.isnan(Rrs[0, _iy, _ix]):
+                continue
+            for iowt in range(Nowt):
+                denum = 0.
+                Rrs_mod = 0.
+
+                for iwl in range(Nwl):
+                    denum += Rrs[iwl, _iy, _ix] * Rrs_owt[iowt, iwl]
+                    Rrs_mod += Rrs[iwl, _iy, _ix] ** 2
+                Rrs_mod = Rrs_mod ** 0.5
+                pixel_sam[iowt] = np.arccos(denum / (Rrs_mod * Rrs_owt_mod[iowt]))
+            arr_index[_iy, _ix] = np.argmin(pixel_sam) + 1
+            arr_dist[_iy, _ix] = np.max(-pixel_sam / pi)
+
+    return arr_index, arr_dist
+
+
+@lazy_njit('Tuple((float32[:, ::1], float32[:, ::1]))' + _SAM_BIP_ARGS, cache=True, nogil=True)
+def sam_classify_bip(Rrs, Rrs_owt,
+                     Ny, Nx, Nwl, Nowt):
+    '''
+    Same as sam_classify for pixel-interleaved (y, x, wl) Rrs: each spectrum is read contiguously
+    and the scalar products with all the OWT spectra are accumulated along the contiguous OWT axis
+    of the transposed references (independent accumulators, vectorized), in the same summation
+    order as sam_classify so that the results are identical.
+
+    :return: OWT index (y, x), starting at 1, and distance (y, x)
+    '''
+    arr_index = np.full((Ny, Nx), np.nan, dtype=np.float32)
+    arr_dist = np.full((Ny, Nx), np.nan, dtype=np.float32)
+    Rrs_owt_mod = np.full((Nowt), 0., dtype=np.float32)
+    Rrs_owt_t = np.empty((Nwl, Nowt), dtype=np.float32)
+    denum = np.empty((Nowt), dtype=np.float64)
+    pixel_sam = np.empty((Nowt), dtype=np.float32)
+    pi = np.float32(np.pi)
+
+    for iowt in range(Nowt):
+        for iwl in range(Nwl):
+            Rrs_owt_mod[iowt] += Rrs_owt[iowt, iwl] ** 2
+            Rrs_owt_t[iwl, iowt] = Rrs_owt[iowt, iwl]
+        Rrs_owt_mod[iowt] = Rrs_owt_mod[iowt] ** 0.5
+
+    for _iy in range(Ny):
+        for _ix in range(Nx):
+            spectrum = Rrs[_iy, _ix]
+            if np.isnan(spectrum[0]):
+                continue
+            Rrs_mod = 0.
+            for iowt in range(Nowt):
+                denum[iowt] = 0.
+            for iwl in range(Nwl):
+                value = spectrum[iwl]
+                Rrs_mod += value ** 2
+                for iowt in range(Nowt):
+                    denum[iowt] += value * Rrs_owt_t[iwl, iowt]
+            Rrs_mod = Rrs_mod ** 0.5
+            for iowt in range(Nowt):
+                pixel_sam[iowt] = np.arccos(denum[iowt] / (Rrs_mod * Rrs_owt_mod[iowt]))
+            arr_index[_iy, _ix] = np.argmin(pixel_sam) + 1
+            arr_dist[_iy, _ix] = np.max(-pixel_sam / pi)
+
+    return arr_index, arr_dist
+
+
+def precompile():
+    '''
+    Run the kernels once on tiny arrays, so that they are compiled (or loaded from the cache).
+
+    :return: time spent (s)
+    '''
+    start = time.perf_counter()
+    Rrs = np.full((2, 1, 1), 0.01, dtype=np.float32)
+    Rrs_owt = np.full((2, 2), 0.01, dtype=np.float32)
+    sam(Rrs, Rrs_owt, 2, 1, 1, 2)
+    sam_classify(Rrs, Rrs_owt, 2, 1, 1, 2)
+    sam_classify_bip(np.ascontiguousarray(Rrs.transpose(1, 2, 0)), Rrs_owt, 1, 1, 2, 2)
+    return time.perf_counter() - start
+
+
+def main():
+    print('GRSl2bgen kernels compiled and cached ({:.3f} s)'.format(precompile()))
+
+
+if __name__ == "__main__":
+    main()
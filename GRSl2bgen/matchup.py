@@ -0,0 +1,196 @@
+'''
+Module dedicated to match-up extraction around in-situ stations for validation.
+'''
+
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import rioxarray
+import logging
+
+from pyproj import Transformer
+
+from .product import Product
+from .output import L2bProduct
+from .chlorophyll_a import Chl
+from .suspended_particulate_matter import Spm
+from .cdom import Cdom
+from .transparency import Transparency
+from .owt import OWT_process
+
+
+class Matchup():
+    '''
+    Extraction of NxN pixel windows around stations, processed window-only.
+    '''
+
+    def __init__(self,
+                 l2a_obj,
+                 stations,
+                 l2b_obj=None,
+                 window=3,
+                 id_field='id',
+                 lon_field='lon',
+                 lat_field='lat',
+                 stations_crs='EPSG:4326'):
+        '''
+        Locate the stations on the tile grid and extract the windows of the L2A Rrs cube;
+        the L2B parameters are either computed on the extracted windows only
+        or read from the windows of an already processed L2B product.
+
+        :param l2a_obj: path or xarray of the L2A input image
+        :param stations: pandas DataFrame or csv file of the stations
+        :param l2b_obj: path or xarray of the L2B product; if None, L2B parameters are computed on the windows
+        :param window: size N of the NxN windows (odd number)
+        :param id_field: name of the station ID column
+        :param lon_field: name of the longitude (or x) column
+        :param lat_field: name of the latitude (or y) column
+        :param stations_crs: CRS of the station coordinates
+        '''
+        if isinstance(stations, str):
+            stations = pd.read_csv(stations)
+        self.stations = stations
+        self.window = window
+        self.half = window // 2
+        self.id_field = id_field
+        self.lon_field = lon_field
+        self.lat_field = lat_field
+        self.stations_crs = stations_crs
+
+        # open without dask chunks so that only the windows are read from file
+        self.l2a_obj = l2a_obj
+        self.raster = Product(l2a_obj, chunks=None).raster
+        if isinstance(l2b_obj, str):
+            l2b_obj = L2bProduct.decode(xr.open_dataset(l2b_obj, decode_coords='all'))
+        self.l2b_raster = l2b_obj
+        self.output = None
+
+    def locate(self):
+        '''
+        Index the station positions against the x/y grid of the tile (regular grid)
+
+        :return: DataFrame of the stations whose windows are fully within the tile, with their row/col
+        '''
+        x, y = self.raster.x.values, self.raster.y.values
+        crs = self.raster.rio.crs
+        lon = self.stations[self.lon_field].values
+        lat = self.stations[self.lat_field].values
+        if crs is not None:
+            transformer = Transformer.from_crs(self.stations_crs, crs, always_xy=True)
+            xs, ys = transformer.transform(lon, lat)
+        else:
+            xs, ys = lon, lat
+        xs, ys = np.asarray(xs), np.asarray(ys)
+
+        col = np.rint((xs - x[0]) / (x[1] - x[0])).astype(int)
+        row = np.rint((ys - y[0]) / (y[1] - y[0])).astype(int)
+        inside = ((col >= self.half) & (col < len(x) - self.half) &
+                  (row >= self.half) & (row < len(y) - self.half))
+
+        located = self.stations[inside].copy()
+        located['x'], located['y'] = xs[inside], ys[inside]
+        located['row'], located['col'] = row[inside], col[inside]
+        located['pixel_distance'] = np.hypot(x[col[inside]] - xs[inside], y[row[inside]] - ys[inside])
+        logging.info('{:d} stations out of {:d} within the tile'.format(inside.sum(), len(inside)))
+        return located
+
+    def extract_windows(self, raster, located):
+        '''
+        Read the windows and stack them side by side along x into a small raster.
+        '''
+        windows = []
+        for row, col in zip(located['row'], located['col']):
+            windows.append(raster.isel(y=slice(row - self.half, row + self.half + 1),
+                                       x=slice(col - self.half, col + self.half + 1)).load())
+        stacked = xr.concat([window.drop_vars(['x', 'y']) for window in windows], dim='x')
+        stacked = stacked.assign_coords(x=np.arange(stacked.sizes['x']), y=np.arange(self.window))
+        return stacked
+
+    def process(self):
+        located = self.locate()
+        if len(located) == 0:
+            self.output = located
+            return self.output
+
+        logging.info('extract {:d}x{:d} windows'.format(self.window, self.window))
+        variables = ['Rrs'] + [variable for variable in ['flags', 'mask'] if variable in self.raster.keys()]
+        raster = self.extract_windows(self.raster[variables], located)
+
+        if self.l2b_raster is not None:
+            l2b = self.extract_windows(self.l2b_raster, located)
+        else:
+            logging.info('compute l2b parameters on windows')
+            owt_process = OWT_process(raster)
+            owt_process.execute()
+            l2_raster_list = [owt_process.output]
+            for algo in [Chl, Spm, Cdom, Transparency]:
+                algo_prod = algo(raster)
+                algo_prod.process()
+                l2_raster_list.append(algo_prod.output)
+            l2b = xr.merge(l2_raster_list, compat='override')
+
+        ######################################
+        # reduce each window
+        ######################################
+        Nstation, N = len(located), self.window
+        center = self.half * N + self.half
+
+        def reduce_window(arr, name, table):
+            arr = np.asarray(arr, dtype=np.float64).reshape(N, Nstation, N).transpose(1, 0, 2).reshape(Nstation, -1)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                table[name] = arr[:, center]
+                table[name + '_mean'] = np.nanmean(arr, axis=1)
+                table[name + '_std'] = np.nanstd(arr, axis=1)
+                table[name + '_n'] = np.isfinite(arr).sum(axis=1)
+
+        table = {}
+        for wl in raster.wl.values:
+            reduce_window(raster.Rrs.sel(wl=wl).values, 'Rrs_{:g}'.format(wl), table)
+        for variable in l2b.data_vars:
+            if l2b[variable].dims == ('y', 'x') and variable not in ['flags', 'mask', 'spatial_ref']:
+                reduce_window(l2b[variable].values, variable, table)
+        if 'mask' in raster.keys():
+            mask = raster['mask'].values.reshape(N, Nstation, N).transpose(1, 0, 2).reshape(Nstation, -1)
+            table['mask_n_good'] = (mask == 0).sum(axis=1)
+
+        table = pd.DataFrame(table, index=located.index)
+        self.output = pd.concat([located, table], axis=1)
+        if isinstance(self.l2a_obj, str):
+            self.output.insert(0, 'product', os.path.basename(self.l2a_obj.rstrip('/')))
+        return self.output
+
+    def write(self, ofile, fmt='csv'):
+        '''
+        Write the match-up table.
+
+        :param ofile: output file path
+        :param fmt: "csv" or "parquet" (requires pyarrow)
+        '''
+        logging.info('export match-ups into ' + ofile)
+        if fmt == 'parquet':
+            self.output.to_parquet(ofile, index=False)
+        else:
+            self.output.to_csv(ofile, index=False)
+        return ofile
+
+    @staticmethod
+    def extract_tiles(l2a_objs, stations, **kwargs):
+        '''
+        Extract the match-ups of the stations over several tiles.
+
+        :param l2a_objs: list of paths of the L2A images
+        :param stations: pandas DataFrame or csv file of the stations
+        :param kwargs: see Matchup
+        :return: concatenated match-up table
+        '''
+        if isinstance(stations, str):
+            stations = pd.read_csv(stations)
+        tables = []
+        for l2a_obj in l2a_objs:
+            matchup = Matchup(l2a_obj, stations, **kwargs)
+            tables.append(matchup.process())
+        return pd.concat(tables, ignore_index=True)
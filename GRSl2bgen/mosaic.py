@@ -0,0 +1,280 @@
+'''
+Module dedicated to regional mosaics: several L2A products (e.g., adjacent MGRS tiles) are presented
+as a single virtual grid read window by window, so that large-area L2B products are processed
+in one bounded-memory streaming pass (see pipeline.py).
+'''
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import xarray as xr
+import dask
+import logging
+
+from .product import Product
+
+# overlap resolution: the first (or last) input with a valid Rrs is kept for each pixel
+OVERLAPS = ('first', 'last')
+# validity masks (finite Rrs of the first band) of the last windows read, shared by the variables of a window
+VALID_CACHE_SIZE = 32
+
+
+class Mosaic():
+    '''
+    Virtual grid over several L2A products with the same CRS, resolution and bands, on aligned grids.
+    '''
+
+    def __init__(self,
+                 l2a_objs,
+                 crs=None,
+                 overlap='first',
+                 chunk=1024):
+        '''
+
+        :param l2a_objs: list of paths or xarray of the L2A input images
+        :param crs: expected CRS of the inputs (e.g., "EPSG:32631"), default to the CRS of the first input
+        :param overlap: overlap resolution, "first" or "last": the pixel is taken from the first (or last)
+                        input, in the order of l2a_objs, with a valid Rrs
+        :param chunk: size of the spatial windows of the virtual grid
+        '''
+        import rioxarray
+
+        if overlap not in OVERLAPS:
+            raise ValueError('overlap should be one of ' + str(OVERLAPS))
+        self.l2a_objs = l2a_objs
+        self.overlap = overlap
+        self.chunk = chunk
+
+        # inputs are opened lazily, only the windows overlapping the requested ones are read
+        self.prods = [Product(obj, chunks=None) for obj in l2a_objs]
+        self.rasters = [prod.raster for prod in self.prods]
+        self.crs = self.check_crs(crs)
+        self.check_bands()
+        self.grid()
+        self.variables = [variable for variable in ['Rrs', 'Rrs_g', 'Rrs_unc', 'flags', 'mask']
+                          if all(variable in raster.keys() for raster in self.rasters)]
+        self.__setstate__({})
+        self.raster = self.virtual_raster()
+
+    def __getstate__(self):
+        # the cache of validity masks is local to each process reading the windows
+        state = dict(self.__dict__)
+        del state['_valid_cache'], state['_valid_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._valid_cache = OrderedDict()
+        self._valid_lock = threading.Lock()
+
+    def check_crs(self, crs=None):
+        '''
+        Check that all the inputs share the same CRS (through rioxarray).
+        '''
+        crss = [raster.rio.crs for raster in self.rasters]
+        if crs is None:
+            crs = crss[0]
+        for obj, raster_crs in zip(self.l2a_objs, crss):
+            if raster_crs is None:
+                raise ValueError('CRS not defined in {}'.format(obj if isinstance(obj, str) else 'input raster'))
+            if raster_crs != crs:
+                raise ValueError('CRS {} of {} differs from the CRS {} of the mosaic; '
+                                 'reproject the input first'.format(raster_crs, obj if isinstance(obj, str) else
+                                                                    'input raster', crs))
+        return crs
+
+    def check_bands(self):
+        wl = self.rasters[0].Rrs.wl.values
+        for raster in self.rasters[1:]:
+            if not np.array_equal(raster.Rrs.wl.values, wl):
+                raise ValueError('inputs of the mosaic have different bands')
+        self.wl = self.rasters[0].Rrs.wl
+
+    @staticmethod
+    def resolution(raster):
+        return float(raster.x[1] - raster.x[0]), float(raster.y[1] - raster.y[0])
+
+    def grid(self):
+        '''
+        Virtual grid covering all the inputs and position (row, column) of each input in it.
+        '''
+        self.res_x, self.res_y = self.resolution(self.rasters[0])
+        for raster in self.rasters[1:]:
+            if not np.allclose(self.resolution(raster), (self.res_x, self.res_y)):
+                raise ValueError('inputs of the mosaic have different resolutions')
+
+        x0 = min(float(raster.x[0]) for raster in self.rasters) if self.res_x > 0 else \
+            max(float(raster.x[0]) for raster in self.rasters)
+        y0 = max(float(raster.y[0]) for raster in self.rasters) if self.res_y < 0 else \
+            min(float(raster.y[0]) for raster in self.rasters)
+
+        self.offsets = []
+        height = width = 0
+        for obj, raster in zip(self.l2a_objs, self.rasters):
+            col, row = (float(raster.x[0]) - x0) / self.res_x, (float(raster.y[0]) - y0) / self.res_y
+            if (abs(col - round(col)) > 1e-3) or (abs(row - round(row)) > 1e-3):
+                raise ValueError('grid of {} is not aligned with the mosaic'.format(
+                    obj if isinstance(obj, str) else 'input raster'))
+            row, col = int(round(row)), int(round(col))
+            self.offsets.append((row, col))
+            height = max(height, row + raster.sizes['y'])
+            width = max(width, col + raster.sizes['x'])
+
+        self.height, self.width = height, width
+        self.x = x0 + self.res_x * np.arange(width)
+        self.y = y0 + self.res_y * np.arange(height)
+        logging.info('mosaic of {:d} inputs: {:d} x {:d} pixels'.format(len(self.rasters), height, width))
+
+    def order(self):
+        indices = list(range(len(self.rasters)))
+        return indices if self.overlap == 'first' else indices[::-1]
+
+    def valid(self, index, local, Rrs0=None):
+        '''
+        Mask of the pixels of a window of an input with a valid Rrs (first band), read once per window
+        for all the variables (VALID_CACHE_SIZE last windows in memory).
+
+        :param index: index of the input
+        :param local: dict of the slices (y, x) of the window in the input
+        :param Rrs0: first band of Rrs of the window if already read
+        :return: boolean numpy array
+        '''
+        key = (index, local['y'].start, local['y'].stop, local['x'].start, local['x'].stop)
+        with self._valid_lock:
+            if key in self._valid_cache:
+                self._valid_cache.move_to_end(key)
+                return self._valid_cache[key]
+        if Rrs0 is None:
+            Rrs0 = self.rasters[index].Rrs.transpose('wl', 'y', 'x').isel(wl=0, **local).values
+        valid = np.isfinite(Rrs0)
+        with self._valid_lock:
+            self._valid_cache[key] = valid
+            while len(self._valid_cache) > VALID_CACHE_SIZE:
+                self._valid_cache.popitem(last=False)
+        return valid
+
+    def read(self, variable, iy, ix, iwl=slice(None)):
+        '''
+        Read a window of the virtual grid, only from the inputs intersecting it.
+
+        :param variable: name of the variable (Rrs, Rrs_g, Rrs_unc, flags, mask)
+        :param iy: slice of rows of the virtual grid
+        :param ix: slice of columns of the virtual grid
+        :param iwl: slice of bands (3D variables)
+        :return: numpy array
+        '''
+        y_start, y_stop, _ = iy.indices(self.height)
+        x_start, x_stop, _ = ix.indices(self.width)
+        ny, nx = y_stop - y_start, x_stop - x_start
+        template = self.rasters[0][variable]
+        cube = template.ndim == 3
+        if cube:
+            shape = (len(self.wl[iwl]), ny, nx)
+            out = np.full(shape, np.nan, dtype=template.dtype)
+        else:
+            out = np.zeros((ny, nx), dtype=template.dtype)
+        filled = np.zeros((ny, nx), dtype=bool)
+        covered = np.zeros((ny, nx), dtype=bool)
+
+        # nested reads of lazy (e.g., beam) inputs are computed in the task reading the window
+        with dask.config.set(scheduler='synchronous'):
+            for index in self.order():
+                raster, (row, col) = self.rasters[index], self.offsets[index]
+                y0, y1 = max(y_start, row), min(y_stop, row + raster.sizes['y'])
+                x0, x1 = max(x_start, col), min(x_stop, col + raster.sizes['x'])
+                if (y0 >= y1) or (x0 >= x1):
+                    continue
+                local = dict(y=slice(y0 - row, y1 - row), x=slice(x0 - col, x1 - col))
+                target = (slice(y0 - y_start, y1 - y_start), slice(x0 - x_start, x1 - x_start))
+                if cube:
+                    data = raster[variable].transpose('wl', 'y', 'x').isel(wl=iwl, **local).values
+                    first_band = (variable == 'Rrs') and (iwl.start in [None, 0])
+                    valid = self.valid(index, local, data[0] if first_band else None)
+                else:
+                    data = raster[variable].isel(**local).values
+                    valid = self.valid(index, local)
+                # pixels without valid Rrs in any input (e.g., flagged) are taken from the first input covering them
+                take = (valid | ~covered[target]) & ~filled[target]
+                if cube:
+                    out[(slice(None),) + target][:, take] = data[:, take]
+                else:
+                    out[target][take] = data[take]
+                filled[target] |= take & valid
+                covered[target] = True
+        return out
+
+    def virtual_raster(self):
+        '''
+        Lazy raster of the virtual grid (same structure as the raster of Product), each dask chunk
+        being read from the intersecting inputs when computed.
+        '''
+        import dask.array as da
+
+        data_vars = {}
+        for variable in self.variables:
+            template = self.rasters[0][variable]
+            if template.ndim == 3:
+                stack = MosaicStack(self, variable, (len(self.wl), self.height, self.width), template.dtype)
+                chunks, dims = (-1, self.chunk, self.chunk), ('wl', 'y', 'x')
+            else:
+                stack = MosaicStack(self, variable, (self.height, self.width), template.dtype)
+                chunks, dims = (self.chunk, self.chunk), ('y', 'x')
+            data = da.from_array(stack, chunks=chunks,
+                                 name='mosaic-' + variable + '-' + dask.base.tokenize(
+                                     [str(obj) if isinstance(obj, str) else id(obj) for obj in self.l2a_objs],
+                                     self.overlap),
+                                 meta=np.array((), dtype=template.dtype))
+            data_vars[variable] = xr.DataArray(data, dims=dims, attrs=template.attrs)
+
+        raster = xr.Dataset(data_vars, coords=dict(wl=self.wl.values, y=self.y, x=self.x))
+        raster.attrs = dict(self.rasters[0].attrs)
+        raster.attrs['metadata_profile'] = 'datacube'
+        raster.attrs['mosaic_inputs'] = ', '.join([os.path.basename(obj) if isinstance(obj, str) else 'raster'
+                                                   for obj in self.l2a_objs])
+        return raster.rio.write_crs(self.crs)
+
+    def process(self, l2b_path, **kwargs):
+        '''
+        Process the mosaic in one streaming pass: windows of the virtual grid are read, processed
+        and written in turn (see Pipeline).
+
+        :param l2b_path: path of the L2B output file
+        :param kwargs: options of Process (streaming by default, with chunks of the mosaic windows)
+        :return: Process object
+        '''
+        from .process import Process
+
+        kwargs.setdefault('streaming', True)
+        kwargs.setdefault('chunk', self.chunk)
+        process = Process(self.raster, l2b_path, **kwargs)
+        process.execute()
+        process.write_output()
+        return process
+
+    def close(self):
+        for raster in self.rasters:
+            raster.close()
+
+
+class MosaicStack():
+    '''
+    Array-like view of a variable of the virtual grid of a Mosaic (see BeamStack).
+    '''
+
+    def __init__(self, mosaic, variable, shape, dtype):
+        self.mosaic = mosaic
+        self.variable = variable
+        self.shape = shape
+        self.dtype = dtype
+        self.ndim = len(shape)
+
+    def __getitem__(self, key):
+        if self.ndim == 3:
+            iwl, iy, ix = key
+            if isinstance(iwl, (int, np.integer)):
+                return self.mosaic.read(self.variable, iy, ix, slice(iwl, iwl + 1))[0]
+            return self.mosaic.read(self.variable, iy, ix, iwl)
+        iy, ix = key
+        return self.mosaic.read(self.variable, iy, ix)
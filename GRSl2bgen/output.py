@@ -1,79 +1,295 @@
 import os
+import contextlib
 import numpy as np
 import xarray as xr
-import rioxarray as rio
+import dask
+import dask.array
 import logging
 import datetime
+import time
 from . import __package__, __version__
+from .uncertainty import UNC_SUFFIX
+
+# compression codecs passed to netCDF4 (zstd and blosc_* require netCDF-C >= 4.9 with its filter plugins;
+# the blosc filter takes its number of threads from BLOSC_NTHREADS only, see blosc_threads)
+CODECS = {'none': dict(compression=None),
+          'zlib': dict(compression='zlib', shuffle=True),
+          'zlib1': dict(compression='zlib', complevel=1, shuffle=True),
+          'zstd': dict(compression='zstd', complevel=3, shuffle=True),
+          'blosc_lz4': dict(compression='blosc_lz4', complevel=5, blosc_shuffle=1),
+          'blosc_zstd': dict(compression='blosc_zstd', complevel=3, blosc_shuffle=1),
+          }
+
+# int16 packing modes: from the data range, from the declared range of the parameters,
+# or from the declared range in log10 scale for the LOG_PARAMS
+PACKINGS = ('data', 'range', 'log')
+# parameters packed in log10 scale
+LOG_PARAMS = ('Chla', 'SPM', 'TURB')
+# lower bound of the log10 packing
+LOG_MIN = 1e-3
+
+
+def is_log_param(name):
+    '''
+    Parameters packed in log10 scale (LOG_PARAMS), their uncertainty layers being packed linearly.
+    '''
+    return name.startswith(LOG_PARAMS) and not name.endswith(UNC_SUFFIX)
+
+
+@contextlib.contextmanager
+def blosc_threads(nthreads=None):
+    '''
+    Number of threads of the blosc filter during an export. The filter plugin of netCDF-C has no
+    option for it and reads the BLOSC_NTHREADS environment variable, which is restored afterwards.
+
+    :param nthreads: number of threads, None to keep the current setting
+    '''
+    if nthreads is None:
+        yield
+        return
+    previous = os.environ.get('BLOSC_NTHREADS')
+    os.environ['BLOSC_NTHREADS'] = str(nthreads)
+    try:
+        yield
+    finally:
+        if previous is None:
+            del os.environ['BLOSC_NTHREADS']
+        else:
+            os.environ['BLOSC_NTHREADS'] = previous
+
 
 class L2bProduct():
-    def __init__(self, prod, l2_raster_list):
+    def __init__(self, prod, l2_raster_list,
+                 codec='zlib',
+                 codecs=None,
+                 chunk=1024,
+                 nthreads=None,
+                 packing='data',
+                 schema=None):
+        '''
+
+        :param prod: Product object of the L2A image (None for already assembled products)
+        :param l2_raster_list: list of xarray Datasets of the L2B parameters
+        :param codec: default compression codec, name of CODECS or dict of netCDF4 compression options
+        :param codecs: per-variable codecs overriding the default one, e.g. {'mask': 'zlib1'}
+        :param chunk: size of the (y, x) chunks of the NetCDF variables
+        :param nthreads: number of threads of the blosc codecs, set for the duration of the export only
+        :param packing: int16 packing mode, "data" (min/max of the data), "range" (declared range of
+                        the parameters, values out of it are masked) or "log" (as "range" with Chla, SPM and TURB
+                        in log10 scale, see decode); with the "data" packing, lazy arrays are persisted
+                        in memory before the export (see persist)
+        :param schema: declared output variables, dict of their attributes (see get_schema); the product is
+                       restricted to these variables (plus flags and mask), which must all be provided
+        '''
+        if packing not in PACKINGS:
+            raise ValueError('packing must be one of ' + str(PACKINGS))
         self.processor = __package__ + '_' + __version__
         self.prod = prod
         self.l2b_raster_list = l2_raster_list
         self.variables = None
         self.l2b_prod = None
         self.complevel = 5
+        self.codec = codec
+        self.codecs = codecs or {}
+        self.chunk = chunk
+        self.nthreads = nthreads
+        self.packing = packing
+        self.schema = schema
+        self.export_report = None
+        self.persisted = False
         self.construct_l2b()
 
     def construct_l2b(self):
+        # registers the .rio accessor (CRS and transform) of the L2B product
+        import rioxarray
+
         logging.info('construct l2b')
 
+        # arrays are kept lazy: they are computed chunk by chunk when written
         l2b_prod = xr.merge(self.l2b_raster_list,compat='override' )
+        if self.schema is not None:
+            missing = [variable for variable in self.schema if variable not in l2b_prod.keys()]
+            if len(missing) > 0:
+                raise ValueError('variables of the output schema not provided: ' + ', '.join(missing))
+            l2b_prod = l2b_prod[list(self.schema)]
+            for variable, attrs in self.schema.items():
+                l2b_prod[variable].attrs.update(attrs.get('attrs', {}))
 
-        if 'flags' in self.prod.raster.keys():
-            l2b_prod['flags'] = self.prod.raster['flags']
-        else:
-            l2b_prod['flags'] = xr.zeros_like(self.prod.raster.Rrs.isel(wl=0, drop=True).squeeze().astype(np.uint8))
-        if 'mask' in self.prod.raster.keys():
-            l2b_prod['mask'] = self.prod.raster['mask']
-        else:
-            l2b_prod['mask'] = xr.zeros_like(self.prod.raster.Rrs.isel(wl=0, drop=True).squeeze().astype(np.uint8))
+        # prod is None for already assembled products (e.g., temporal composites)
+        if self.prod is not None:
+            if 'flags' in self.prod.raster.keys():
+                l2b_prod['flags'] = self.prod.raster['flags']
+            else:
+                l2b_prod['flags'] = xr.zeros_like(self.prod.raster.Rrs.isel(wl=0, drop=True).squeeze().astype(np.uint8))
+            if 'mask' in self.prod.raster.keys():
+                l2b_prod['mask'] = self.prod.raster['mask']
+            else:
+                l2b_prod['mask'] = xr.zeros_like(self.prod.raster.Rrs.isel(wl=0, drop=True).squeeze().astype(np.uint8))
 
-        l2b_prod.attrs = self.prod.raster.attrs
+            l2b_prod.attrs = self.prod.raster.attrs
         l2b_prod.attrs['processing_time'] = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%f')
         l2b_prod.attrs['processor'] = self.processor
         self.variables = list(l2b_prod.keys())
         self.l2b_prod = l2b_prod
 
+    def persist(self):
+        '''
+        Compute the lazy arrays of the product once and keep them in memory (of the workers with
+        a distributed client): the "data" packing needs the min/max of each parameter before writing,
+        which would otherwise compute every parameter twice.
+        Statistics and overviews built on the persisted product (see quality.py, overview.py)
+        then reuse the computed chunks.
+        '''
+        if any(isinstance(self.l2b_prod[variable].data, dask.array.Array) for variable in self.variables):
+            logging.info('persist l2b product')
+            self.l2b_prod = self.l2b_prod.persist()
+        self.persisted = True
+        return self
+
+    def get_schema(self):
+        '''
+        Output schema of the product (dimensions, dtype and attributes of each variable),
+        obtained from the lazy arrays without computing them.
+        '''
+        return {variable: dict(dims=self.l2b_prod[variable].dims,
+                               dtype=str(self.l2b_prod[variable].dtype),
+                               attrs=dict(self.l2b_prod[variable].attrs))
+                for variable in self.variables}
+
     @staticmethod
     def compute_scale_and_offset(array, nbit=16):
-        max_, min_ = np.nanmax(array), np.nanmin(array)
-        # stretch/compress data to the available packed range
-        scale_factor = (max_ - min_) / (2 ** nbit - 1)
-        # translate the range to be symmetric about zero
-        add_offset = min_ + 2 ** (nbit - 1) * scale_factor
+        with np.errstate(invalid='ignore'):
+            vrange = L2bProduct.valid_range(np.nanmin(array), np.nanmax(array))
+        return L2bProduct.scale_and_offset_from_range(vrange, nbit=nbit)
+
+    @staticmethod
+    def valid_range(min_, max_, default=(0, 1)):
+        '''
+        Non-degenerate packing range for all-NaN or constant arrays.
+        '''
+        if not (np.isfinite(min_) and np.isfinite(max_)):
+            min_, max_ = default
+        if not max_ > min_:
+            max_ = min_ + max(abs(min_), 1.)
+        return float(min_), float(max_)
+
+    def data_ranges(self, variables):
+        '''
+        Min and max of the variables computed in a single pass over the (lazy) arrays.
+        '''
+        reductions = []
+        for variable in variables:
+            reductions += [self.l2b_prod[variable].min(), self.l2b_prod[variable].max()]
+        values = dask.compute(*reductions)
+        ranges = {}
+        for ivar, variable in enumerate(variables):
+            ranges[variable] = self.valid_range(float(values[2 * ivar]), float(values[2 * ivar + 1]),
+                                                default=self.l2b_prod[variable].attrs.get('range', (0, 1)))
+        return ranges
+
+    def pack(self, param, data_range=None):
+        '''
+        Transform a parameter for its int16 packing: with "range" and "log" packings, values out of
+        the declared range are masked (with "log" packing, values within the range but below LOG_MIN
+        are set to LOG_MIN).
+
+        :param param: xarray DataArray of the parameter
+        :param data_range: [min, max] of the data for the "data" packing
+        :return: values to be written, scale_factor, add_offset
+        '''
+        if data_range is not None:
+            return param, *self.scale_and_offset_from_range(data_range)
+
+        attrs = dict(param.attrs)
+        minval, maxval = float(attrs['range'][0]), float(attrs['range'][1])
+        # values out of the declared range are masked (written as _FillValue) rather than saturated
+        param = param.where((param >= minval) & (param <= maxval))
+        if (self.packing == 'log') and is_log_param(param.name):
+            minval, maxval = np.log10(max(minval, LOG_MIN)), np.log10(maxval)
+            param = np.log10(param.clip(min=10 ** minval))
+            attrs['packing'] = 'log10'
+        return param.assign_attrs(attrs), *self.scale_and_offset_from_range([minval, maxval])
+
+    @staticmethod
+    def decode(l2b_prod):
+        '''
+        Get back the physical values of the parameters packed in log10 scale.
+
+        :param l2b_prod: xarray Dataset of a L2B product
+        '''
+        for variable in l2b_prod.data_vars:
+            attrs = dict(l2b_prod[variable].attrs)
+            if attrs.pop('packing', None) == 'log10':
+                l2b_prod[variable] = (10 ** l2b_prod[variable]).assign_attrs(attrs)
+        return l2b_prod
+
+    @staticmethod
+    def scale_and_offset_from_range(vrange, nbit=16):
+        '''
+        Fixed scale factor and offset mapping the declared range of a parameter
+        onto [-2**(nbit-1)+1, 2**(nbit-1)-1], the lowest integer being kept for _FillValue.
+        '''
+        min_, max_ = float(vrange[0]), float(vrange[1])
+        scale_factor = (max_ - min_) / (2 ** nbit - 2)
+        add_offset = min_ + (2 ** (nbit - 1) - 1) * scale_factor
         return scale_factor, add_offset
 
-    def export_to_netcdf(self, ofile):
+    def get_codec(self, variable, shape=None):
+        '''
+        Compression options of a variable (netCDF4 createVariable keywords).
+
+        :param variable: variable name
+        :param shape: shape of the variable to set the chunk sizes
+        '''
+        codec = self.codecs.get(variable, self.codec)
+        if isinstance(codec, str):
+            codec = CODECS[codec]
+        codec = dict(codec)
+        if codec.get('compression') is not None:
+            codec.setdefault('complevel', self.complevel)
+        if (shape is not None) and (len(shape) == 2):
+            codec['chunksizes'] = tuple(min(self.chunk, size) for size in shape)
+        return codec
+
+    def export_to_netcdf(self, ofile, overviews=None, quality=None):
         '''
         Create output product dimensions, variables, attributes, flags....
+
+        :param ofile: path of the output NetCDF file
+        :param overviews: Overviews object (see overview.py) built on the product, computed in the same pass
+        :param quality: Quality object (see quality.py) built on the product, computed in the same pass
+                        and written into the attributes and a JSON sidecar
         :return:
         '''
         logging.info('export into encoded netcdf')
-        complevel = self.complevel
         encoding={}
+        if (self.packing == 'data') and not self.persisted:
+            self.persist()
+        l2b_prod = self.l2b_prod.copy()
+        packed = [variable for variable in self.variables
+                  if not ((variable in ['mask','flags']) or np.issubdtype(self.l2b_prod[variable].dtype, np.integer))]
+        if self.packing == 'data':
+            data_ranges = self.data_ranges(packed)
+        else:
+            data_ranges = self.data_ranges([variable for variable in packed
+                                            if 'range' not in self.l2b_prod[variable].attrs])
         for variable in self.variables:
+            codec = self.get_codec(variable, self.l2b_prod[variable].shape)
 
-            if variable in ['mask','flags']:
+            if (variable in ['mask','flags']) or np.issubdtype(self.l2b_prod[variable].dtype, np.integer):
                 encoding[variable] = {
-                    "zlib": True,
-                    "complevel": complevel,
+                    **codec,
                     "grid_mapping": "spatial_ref"
                     }
             else:
-                p = self.l2b_prod[variable]
-                scale_factor, add_offset = self.compute_scale_and_offset(p.values, nbit=16)
-                #offset = np.mean(p.range)
-                #range = float(np.diff(p.range))
-                #scale_factor = round(range / 60000, 6)
+                l2b_prod[variable], scale_factor, add_offset = self.pack(self.l2b_prod[variable],
+                                                                          data_ranges.get(variable))
                 encoding[variable] = {
                     'dtype': 'int16',
                     'scale_factor': scale_factor,
                     'add_offset': add_offset,
                     '_FillValue': -32768,
-                    "zlib": True,
-                    "complevel": complevel,
+                    **codec,
                     "grid_mapping": "spatial_ref"
                     }
 
@@ -89,7 +305,48 @@ class L2bProduct():
         if not os.path.exists(odir):
             os.makedirs(odir)
 
-        self.l2b_prod.to_netcdf(ofile, encoding=encoding)
+        start = time.perf_counter()
+        with blosc_threads(self.nthreads):
+            if (overviews is None) and (quality is None):
+                l2b_prod.to_netcdf(ofile, encoding=encoding)
+            else:
+                delayed = [l2b_prod.to_netcdf(ofile, encoding=encoding, compute=False)]
+                if quality is not None:
+                    delayed.append(quality.pending)
+                results = overviews.compute(*delayed) if overviews is not None else dask.compute(*delayed)
+                if quality is not None:
+                    quality.update(results[-1])
+                    quality.write(ofile)
+                if overviews is not None:
+                    overviews.write(ofile)
         self.l2b_prod.close()
+        self.export_report = dict(codec=self.codec if isinstance(self.codec, str) else str(self.codec),
+                                  seconds=round(time.perf_counter() - start, 3),
+                                  size_MB=round(os.path.getsize(ofile) / 2 ** 20, 3))
+        logging.info('export: {seconds} s, {size_MB} MB ({codec})'.format(**self.export_report))
+
+        return
 
-        return
\ No newline at end of file
+    def benchmark_codecs(self, odir, codecs=('none', 'zlib1', 'zlib', 'zstd', 'blosc_lz4', 'blosc_zstd')):
+        '''
+        Export the product with each codec to compare writing time and file size.
+
+        :param odir: directory of the temporary exported files
+        :param codecs: names of the codecs to compare
+        :return: dict of the export reports per codec
+        '''
+        codec, reports = self.codec, {}
+        for name in codecs:
+            self.codec = name
+            ofile = os.path.join(odir, 'benchmark_' + name + '.nc')
+            try:
+                self.export_to_netcdf(ofile)
+                reports[name] = self.export_report
+            except (ValueError, RuntimeError) as error:
+                # codec not available in the netCDF-C library
+                logging.info('codec {} not available: {}'.format(name, error))
+            finally:
+                if os.path.exists(ofile):
+                    os.remove(ofile)
+        self.codec = codec
+        return reports
\ No newline at end of file
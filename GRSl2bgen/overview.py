@@ -0,0 +1,140 @@
+'''
+Module dedicated to the multi-resolution overviews and PNG quick-looks of L2B products,
+computed in the same pass as the export of the full-resolution product.
+'''
+
+import os
+import functools
+
+import numpy as np
+import xarray as xr
+import dask
+import logging
+
+# bands of the RGB quick-look
+RGB_WL = [665, 560, 490]
+
+
+class Overviews():
+    '''
+    Decimated copies (2x, 4x, 8x...) of the L2B parameters: NaN-aware average of the continuous parameters
+    and most frequent class for the OWT indices.
+    '''
+
+    def __init__(self,
+                 factors=(2, 4, 8),
+                 quicklooks=True,
+                 cmaps=None,
+                 rgb_max=0.03):
+        '''
+
+        :param factors: decimation factors of the overviews
+        :param quicklooks: write PNG quick-looks from the coarsest overview
+        :param cmaps: colormaps of the quick-looks per variable (e.g., OWT.cmap_owt for the OWT indices)
+        :param rgb_max: Rrs value (sr-1) saturating the RGB quick-look
+        '''
+        self.factors = sorted(factors)
+        self.quicklooks = quicklooks
+        self.cmaps = cmaps or {}
+        self.rgb_max = rgb_max
+        self.levels = {}
+
+    @staticmethod
+    def class_mode(arr, axis, Nclass):
+        '''
+        Most frequent class over the coarsened axes (NaN if no valid pixel).
+        '''
+        counts = np.stack([(np.rint(arr) == iclass).sum(axis=axis) for iclass in range(1, Nclass + 1)])
+        mode = (np.argmax(counts, axis=0) + 1).astype(np.float32)
+        return np.where(counts.max(axis=0) > 0, mode, np.nan)
+
+    def coarsen(self, param, factor):
+        coarse = param.coarsen(y=factor, x=factor, boundary='trim')
+        if param.name.startswith('owt_index'):
+            Nclass = int(param.attrs.get('range', [0, 13])[1])
+            return coarse.reduce(functools.partial(self.class_mode, Nclass=Nclass), keep_attrs=True)
+        return coarse.mean(keep_attrs=True)
+
+    def build(self, l2b_prod, Rrs=None, ranges=False):
+        '''
+        Define the overviews lazily from the (lazy) arrays of the product, so that they are computed
+        in the same pass as the export.
+
+        :param l2b_prod: xarray Dataset of the L2B product
+        :param Rrs: Rrs cube for the RGB quick-look
+        :param ranges: values out of the declared range of the parameters are masked before coarsening,
+                       as in the full-resolution product ("range" and "log" packings)
+        '''
+        variables = [variable for variable in l2b_prod.data_vars
+                     if l2b_prod[variable].dims == ('y', 'x') and variable not in ['mask', 'flags']]
+        params = l2b_prod[variables]
+        if ranges:
+            for variable in variables:
+                param = params[variable]
+                if 'range' in param.attrs:
+                    params[variable] = param.where((param >= param.attrs['range'][0])
+                                                   & (param <= param.attrs['range'][1]))
+        if (Rrs is not None) and self.quicklooks:
+            for wl in RGB_WL:
+                params['Rrs_{:d}'.format(wl)] = Rrs.sel(wl=wl, method='nearest').drop_vars('wl')
+        for factor in self.factors:
+            self.levels[factor] = xr.Dataset({variable: self.coarsen(params[variable].astype(np.float32), factor)
+                                              for variable in params.data_vars})
+        return self.levels
+
+    def compute(self, *delayed):
+        '''
+        Compute the overviews together with other delayed tasks (e.g., the export of the product).
+        '''
+        results = dask.compute(*delayed, self.levels)
+        self.levels = results[-1]
+        return results[:-1]
+
+    def write(self, ofile):
+        '''
+        Append the overviews as groups (overview_2, overview_4...) of the NetCDF file
+        and write the quick-looks next to it.
+        '''
+        for factor, level in self.levels.items():
+            logging.info('export overview {:d}x'.format(factor))
+            variables = [variable for variable in level.data_vars if not variable.startswith('Rrs_')]
+            level[variables].to_netcdf(ofile, mode='a', group='overview_{:d}'.format(factor),
+                                       encoding={variable: {'zlib': True, 'complevel': 5} for variable in variables})
+        if self.quicklooks and (len(self.levels) > 0):
+            self.write_quicklooks(os.path.splitext(ofile)[0])
+
+    def write_quicklooks(self, root):
+        '''
+        Write PNG quick-looks of the coarsest overview: RGB, OWT indices and Chl-a.
+        '''
+        import matplotlib as mpl
+        import matplotlib.pyplot as plt
+
+        level = self.levels[self.factors[-1]]
+        files = []
+        bands = ['Rrs_{:d}'.format(wl) for wl in RGB_WL]
+        if all(band in level.data_vars for band in bands):
+            rgb = np.stack([level[band].values for band in bands], axis=-1)
+            rgb = np.clip(np.nan_to_num(rgb / self.rgb_max), 0, 1) ** (1 / 2.2)
+            files.append(root + '_rgb.png')
+            plt.imsave(files[-1], rgb)
+
+        for variable in level.data_vars:
+            param = level[variable]
+            if variable.startswith('owt_index'):
+                cmap = self.cmaps.get(variable, plt.cm.Spectral_r)
+                kwargs = dict(cmap=cmap, vmin=0.5, vmax=param.attrs.get('range', [0, 13])[1] + 0.5)
+            elif variable.startswith('Chla'):
+                # trophic range of Chl-a (mg m-3) in log scale
+                kwargs = dict(cmap=self.cmaps.get(variable, plt.cm.viridis),
+                              norm=mpl.colors.LogNorm(0.1, 300, clip=True))
+            else:
+                continue
+            files.append(root + '_' + variable + '.png')
+            values = np.ma.masked_invalid(param.values)
+            if 'norm' in kwargs:
+                values = kwargs.pop('norm')(values)
+                kwargs.update(vmin=0, vmax=1)
+            plt.imsave(files[-1], values, **kwargs)
+        logging.info('quick-looks: ' + ', '.join(files))
+        return files
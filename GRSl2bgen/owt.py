@@ -1,10 +1,10 @@
 import os
+import hashlib
 
 import numpy as np
 import pandas as pd
 import xarray as xr
 
-from numba import njit
 import logging
 
 from multiprocessing import Pool  # Process pool
@@ -13,13 +13,10 @@ import itertools
 
 import dask
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
-
 from importlib_resources import files
 
 from . import __package__
+from . import kernels
 
 OWT_Spyrakos2018_file = 'Spyrakos_et_al_2018_OWT_inland_mean_standardised.csv'
 OWT_Bi2024_file = 'Bi_etal_2024_OWT_mean_spec_v01.csv'
@@ -29,6 +26,36 @@ OWT_Spyrakos2018_file = files(__package__ +
 OWT_Bi2024_file = files(__package__ +
                         '.data').joinpath(OWT_Bi2024_file)
 
+# resampled reference spectra and projections, indexed by database, sensor and bands
+_reference_cache = {}
+# reference spectra of the OWT databases as read from the csv files
+_database_cache = {}
+
+
+def read_database(owt_database):
+    '''
+    Reference spectra of an OWT database, read once per process.
+
+    :param owt_database: "Spyrakos2018" or "Bi2024"
+    :return: xarray Dataset with dimensions (owt, wl)
+    '''
+    if owt_database in _database_cache:
+        return _database_cache[owt_database]
+    if owt_database == 'Spyrakos2018':
+        owt = pd.read_csv(OWT_Spyrakos2018_file, index_col=0).stack().to_xarray().astype(np.float32)
+        owt = owt.rename({'level_1': 'wl'})
+        owt['wl'] = owt.wl.astype(np.float32)
+        owt.name = 'm_nRrs'
+        owt = owt.to_dataset()
+    elif owt_database == 'Bi2024':
+        owt = pd.read_csv(OWT_Bi2024_file, index_col=[0, 1]).to_xarray()
+        owt = owt.rename({'type': 'owt', 'wavelen': 'wl'})
+        owt['owt'] = range(1, 11)
+    else:
+        raise ValueError('unknown OWT database ' + str(owt_database))
+    _database_cache[owt_database] = owt
+    return owt
+
 
 class OWT():
     def __init__(self,
@@ -39,7 +66,12 @@ class OWT():
                  suffix='',
                  wl_range=slice(350, 800),
                  chunk=1024,
-                 Nproc=8):
+                 Nproc=8,
+                 srf=None,
+                 sensor=None,
+                 reduction=None,
+                 n_components=16,
+                 layout='bip'):
         '''
         Routine for Optical Water Types (OWT) retrieval from L2A images based on several OWT database and robust spectral metric.
 
@@ -51,15 +83,41 @@ class OWT():
         :param wl_range: spectral range to apply the Spectral angle mapper
         :param chunk: chunk size for multiprocessing
         :param Nproc: number of CPU for multiprocessing
+        :param srf: sensor spectral response functions, xarray DataArray with dimensions (band, wavelength),
+                    "band" being the central wavelengths of the Rrs bands (see gaussian_srf);
+                    if None, the reference spectra are linearly interpolated to the Rrs bands
+        :param sensor: sensor name used to cache the convolved reference spectra
+        :param reduction: reduced-dimension mode for hyperspectral inputs, within [None, "binning", "pca"]
+        :param n_components: number of spectral bins or principal components of the reduced-dimension mode;
+                             with "pca" and at least as many components as OWTs, owt_dist keeps
+                             the full-band definition, otherwise it is the distance in the reduced space
+        :param layout: memory layout of the spectra given to the SAM kernel, "bip" (pixel-interleaved, y, x, wl)
+                       or "bsq" (band-sequential, wl, y, x); band-sequential windows are transposed for "bip"
         '''
 
         self.param = param
         self.chunk = chunk
         self.Nproc = Nproc
         self.raster = raster
+        self.srf = srf
+        self.sensor = sensor
+        if (srf is not None) and (sensor is None):
+            self.sensor = hashlib.sha1(np.ascontiguousarray(srf.values).tobytes()).hexdigest()
+        self.reduction = reduction
+        self.n_components = n_components
+        if layout not in ['bip', 'bsq']:
+            raise ValueError('layout should be "bip" or "bsq"')
+        self.layout = layout
 
         self.Rrs = raster.Rrs.sel(wl=wl_range)
-        self.Nwl, self.height, self.width = self.Rrs.shape
+        if self.Rrs.sizes['wl'] == 0:
+            raise ValueError('no Rrs band within the spectral range [{}, {}] nm of the OWT classification'.format(
+                wl_range.start, wl_range.stop))
+        if self.Rrs.ndim == 3:
+            self.Nwl, self.height, self.width = self.Rrs.shape
+        else:
+            # spectra of shape (Nspectra, Nwl), see process_spectra
+            self.Nwl = self.Rrs.sizes['wl']
 
         self.owt_database = owt_database
         self.suffix = suffix
@@ -72,14 +130,10 @@ class OWT():
         if xowt is not None:
             self.owt = xowt
             self.attrs_owt = xowt.attrs
-            self.cmap_owt = plt.cm.Spectral_r
+            self.owt_colors = None
         else:
+            owt = read_database(self.owt_database)
             if self.owt_database == 'Spyrakos2018':
-                owt = pd.read_csv(OWT_Spyrakos2018_file, index_col=0).stack().to_xarray().astype(np.float32)
-                owt = owt.rename({'level_1': 'wl'})
-                owt['wl'] = owt.wl.astype(np.float32)
-                owt.name = 'm_nRrs'
-                owt = owt.to_dataset()
                 self.owt_info = {
                     1: dict(color='olivedrab', label='OWT1: Hypereutrophic waters'),
                     2: dict(color='black', label='OWT2: Common case waters'),
@@ -97,10 +151,6 @@ class OWT():
                 }
 
             elif self.owt_database == 'Bi2024':
-                owt = pd.read_csv(OWT_Bi2024_file, index_col=[0, 1]).to_xarray()
-                owt = owt.rename({'type': 'owt', 'wavelen': 'wl'})
-                owt['owt'] = range(1, 11)
-
                 self.owt_info = {
                     1: dict(color='blueviolet',
                             label='Extremely clear and oligotrophic indigo-blue waters with high reflectance in the short visible wavelengths.'),
@@ -136,12 +186,84 @@ class OWT():
                 attrs += str(key) + ":" + info['label'] + '\n'
 
             self.attrs_owt = attrs
-            self.cmap_owt = mpl.colors.ListedColormap(colors)
+            self.owt_colors = colors
 
         self.Nowt = len(self.owt.owt)
-        self.Rrs_owt = self.owt.interp(wl=self.Rrs.wl).astype(np.float32).squeeze()
+        self.Rrs_owt, self.projection = self.get_reference(cache=xowt is None)
+        self.Rrs_owt_values = self.project(self.Rrs_owt.transpose('owt', 'wl').values, axis=1)
         self.output = None
 
+    def get_reference(self, cache=True):
+        '''
+        Resample the OWT reference spectra to the Rrs bands, by linear interpolation or convolution
+        with the sensor spectral response functions, and compute the projection of the reduced-dimension mode.
+        Both are computed once per database, sensor and set of bands.
+
+        :return: reference spectra (owt, wl), projection matrix (Nwl, Ncomponents) or None
+        '''
+        key = (self.owt_database, self.param, self.sensor, tuple(self.Rrs.wl.values),
+               self.reduction, self.n_components)
+        if cache and (key in _reference_cache):
+            return _reference_cache[key]
+
+        if self.srf is None:
+            Rrs_owt = self.owt.interp(wl=self.Rrs.wl).astype(np.float32).squeeze()
+        else:
+            srf = self.srf.sel(band=self.Rrs.wl.values, method='nearest').transpose('band', 'wavelength')
+            owt = self.owt.interp(wl=srf.wavelength.values).transpose('owt', 'wl').values
+            weights = srf.values
+            # the reference spectra are not defined over the full response functions
+            valid = np.isfinite(owt).astype(np.float64)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                Rrs_owt = (np.nan_to_num(owt) @ weights.T) / (valid @ weights.T)
+            Rrs_owt = xr.DataArray(Rrs_owt.astype(np.float32),
+                                   dims=['owt', 'wl'],
+                                   coords=dict(owt=self.owt.owt, wl=self.Rrs.wl))
+
+        projection = None
+        Nwl = Rrs_owt.sizes['wl']
+        if self.reduction == 'binning':
+            projection = np.zeros((Nwl, min(self.n_components, Nwl)), dtype=np.float32)
+            for icomp, iwls in enumerate(np.array_split(np.arange(Nwl), projection.shape[1])):
+                projection[iwls, icomp] = 1. / len(iwls)
+        elif self.reduction == 'pca':
+            # uncentered basis so that scalar products with the reference spectra are preserved
+            _, _, vt = np.linalg.svd(np.nan_to_num(Rrs_owt.transpose('owt', 'wl').values), full_matrices=False)
+            projection = np.ascontiguousarray(vt[:self.n_components].T, dtype=np.float32)
+
+        if cache:
+            _reference_cache[key] = (Rrs_owt, projection)
+        return Rrs_owt, projection
+
+    def project(self, Rrs, axis=0):
+        '''
+        Project spectra onto the reduced-dimension basis (if any).
+
+        :param Rrs: array of spectra with wavelengths along axis
+        :param axis: wavelength axis
+        :return: projected float32 array with the components along axis
+        '''
+        if self.projection is None:
+            return np.asarray(Rrs, dtype=np.float32)
+        proj = np.tensordot(Rrs, self.projection, axes=([axis], [0]))
+        return np.ascontiguousarray(np.moveaxis(proj, -1, axis), dtype=np.float32)
+
+    @staticmethod
+    def gaussian_srf(wl, fwhm, wavelength=np.arange(350, 1001, 1.)):
+        '''
+        Gaussian spectral response functions from band centers and full widths at half maximum
+        (e.g., for PRISMA or EnMAP).
+
+        :param wl: central wavelengths of the bands (nm)
+        :param fwhm: full widths at half maximum of the bands (nm)
+        :param wavelength: wavelength grid of the response functions (nm)
+        :return: xarray DataArray with dimensions (band, wavelength)
+        '''
+        wl = np.asarray(wl, dtype=np.float64)
+        sigma = np.broadcast_to(np.asarray(fwhm, dtype=np.float64), wl.shape) / (2 * np.sqrt(2 * np.log(2)))
+        srf = np.exp(-0.5 * ((wavelength[None, :] - wl[:, None]) / sigma[:, None]) ** 2)
+        return xr.DataArray(srf, dims=['band', 'wavelength'], coords=dict(band=wl, wavelength=wavelength))
+
 
 
     @staticmethod
@@ -151,7 +273,6 @@ class OWT():
         return np.arccos(denum / denom)
 
     @staticmethod
-    @njit()
     def SAM(Rrs, Rrs_owt,
             Nwl, Ny, Nx, Nowt):
         '''
@@ -159,33 +280,68 @@ class OWT():
         denum=(R1*R2).sum('wl')
         denom = (R1**2).sum('wl')**0.5 * (R2**2).sum('wl')**0.5
         return np.arccos(denum/denom)
-        '''
-
-        arr_sam = np.full((Nowt, Ny, Nx), np.nan, dtype=np.float32)
-        arr_index = np.full((Ny, Nx), np.nan, dtype=np.float32)
-        Rrs_owt_mod = np.full((Nowt), 0., dtype=np.float32)
-
-        for iowt in range(Nowt):
-            for iwl in range(Nwl):
-                Rrs_owt_mod[iowt] += Rrs_owt[iowt, iwl] ** 2
-            Rrs_owt_mod[iowt] = Rrs_owt_mod[iowt] ** 0.5
-
-        for _iy in range(Ny):
-            for _ix in range(Nx):
-                if np.isnan(Rrs[0, _iy, _ix]):
-                    continue
-                for iowt in range(Nowt):
-                    denum = 0.
-                    Rrs_mod = 0.
 
-                    for iwl in range(Nwl):
-                        denum += Rrs[iwl, _iy, _ix] * Rrs_owt[iowt, iwl]
-                        Rrs_mod += Rrs[iwl, _iy, _ix] ** 2
-                    Rrs_mod = Rrs_mod ** 0.5
-                    arr_sam[iowt, _iy, _ix] = np.arccos(denum / (Rrs_mod * Rrs_owt_mod[iowt]))
-                arr_index[_iy, _ix] = np.argmin(arr_sam[:, _iy, _ix]) + 1
+        see kernels.sam (compiled for float32 arrays)
+        '''
+        return kernels.sam(np.asarray(Rrs, dtype=np.float32), np.asarray(Rrs_owt, dtype=np.float32),
+                           Nwl, Ny, Nx, Nowt)
 
-        return arr_sam, arr_index
+    def classify(self, Rrs):
+        '''
+        OWT index and distance (-angle/pi) of a (wl, y, x) window of Rrs, see kernels.sam_classify.
+        '''
+        if self.layout == 'bip':
+            return self.classify_bip(Rrs.transpose(1, 2, 0))
+        Rrs_proj = self.project(Rrs)
+        Nwl, Ny, Nx = Rrs_proj.shape
+        owt_index, owt_dist = kernels.sam_classify(Rrs_proj, self.Rrs_owt_values, Nwl, Ny, Nx, self.Nowt)
+        return owt_index, self.full_band_dist(owt_dist, Rrs, Rrs_proj, axis=0)
+
+    def classify_bip(self, Rrs):
+        '''
+        OWT index and distance (-angle/pi) of a (y, x, wl) window of Rrs, see kernels.sam_classify_bip;
+        the window is only copied if its spectra are not contiguous in memory.
+        '''
+        Rrs = np.ascontiguousarray(Rrs, dtype=np.float32)
+        Rrs_proj = self.project(Rrs, axis=2)
+        Ny, Nx, Nwl = Rrs_proj.shape
+        owt_index, owt_dist = kernels.sam_classify_bip(Rrs_proj, self.Rrs_owt_values, Ny, Nx, Nwl, self.Nowt)
+        return owt_index, self.full_band_dist(owt_dist, Rrs, Rrs_proj, axis=2)
+
+    @property
+    def full_band(self):
+        '''
+        True if owt_dist matches the full-band definition: no reduction, or PCA whose components
+        span the reference spectra.
+        '''
+        if self.reduction is None:
+            return True
+        if self.reduction != 'pca':
+            return False
+        Nwl, Ncomponents = self.projection.shape
+        return Ncomponents >= min(self.Nowt, Nwl)
+
+    def full_band_dist(self, owt_dist, Rrs, Rrs_proj, axis=0):
+        '''
+        Distance of the full-band definition from the distance computed on the principal components.
+        The uncentered PCA basis spans the reference spectra (n_components >= number of OWTs), so that
+        only the norm of the pixel spectrum shrinks once projected: the cosine is rescaled by the ratio
+        of the projected to the full-band norm. The OWT index is unchanged.
+        Otherwise (fewer components, "binning" mode), the distance is left as computed in the reduced space
+        and differs from full-band runs (see the "reduction" attribute of owt_dist).
+
+        :param owt_dist: distance (-angle/pi) in the reduced space
+        :param Rrs: full-band spectra
+        :param Rrs_proj: projected spectra
+        :param axis: wavelength (component) axis of Rrs and Rrs_proj
+        '''
+        if (self.projection is None) or not self.full_band:
+            return owt_dist
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ratio = np.sqrt((Rrs_proj.astype(np.float64) ** 2).sum(axis=axis) /
+                            (np.asarray(Rrs, dtype=np.float64) ** 2).sum(axis=axis))
+            cos = np.clip(np.cos(-np.pi * owt_dist) * ratio, -1, 1)
+        return (-np.arccos(cos) / np.pi).astype(np.float32)
 
     @staticmethod
     def SCS(R1, R2):
@@ -201,8 +357,8 @@ class OWT():
         chunk = self.chunk
         height, width, Nowt = self.height, self.width, self.Nowt
 
-        owt_index = np.full((height, width), 0, dtype=np.float32)
-        owt_dist = np.full((height, width), 0, dtype=np.float32)
+        owt_index = np.full((height, width), np.nan, dtype=np.float32)
+        owt_dist = np.full((height, width), np.nan, dtype=np.float32)
         # np.seterr(divide='ignore', invalid='ignore')
         # import warnings
         # with warnings.catch_warnings():
@@ -214,25 +370,20 @@ class OWT():
                 xc = min(width, ix + chunk)
 
                 _Rrs = self.Rrs[:, iy:yc, ix:xc]
-                Nwl, Ny, Nx = _Rrs.shape
-                owt_sam, owt_index[iy:yc, ix:xc] = self.SAM(_Rrs.values,
-                                                            self.Rrs_owt.values,
-                                                            Nwl, Ny, Nx, Nowt)
-                tmp = -1 * owt_sam / np.pi
-
                 # TODO implement spectral correlation similarity (SCS) + MSAS (see Bonnier et al, 2024)
                 # issue with reshape arrays
                 #owt_scs = self.SCS(_Rrs,self.Rrs_owt)
                 #tmp = owt_scs + (1-2*owt_sam/np.pi)/2
+                owt_index[iy:yc, ix:xc], owt_dist[iy:yc, ix:xc] = self.classify(_Rrs.values)
 
-                tmp_max = np.max(tmp, axis=0)
-                owt_dist[iy:yc, ix:xc] = tmp_max
-
-        self.xowt = xr.Dataset(dict(owt_dist=(["y", "x"], owt_dist),
-                                    owt_index=(["y", "x"], owt_index), ),
+        self.xowt = xr.Dataset(data_vars={self.owt_dist_name: (["y", "x"], owt_dist),
+                                          self.owt_index_name: (["y", "x"], owt_index), },
                                coords=dict(x=self.Rrs.x,
                                            y=self.Rrs.y),
                                )
+        self.set_attrs()
+
+        return self.xowt
 
     def multi_process(self):
 
@@ -253,19 +404,7 @@ class OWT():
             tmp_owt_dist = np.ctypeslib.as_array(shared_owt_dist)
 
             _Rrs = self.Rrs[:, iy:yc, ix:xc]
-            Nwl, Ny, Nx = _Rrs.shape
-            owt_sam, tmp_owt_index[iy:yc, ix:xc] = self.SAM(_Rrs.values,
-                                                            self.Rrs_owt.values,
-                                                            Nwl, Ny, Nx, Nowt)
-
-            tmp = -1 * owt_sam / np.pi
-
-            # TODO implement spectral correlation similarity (SCS) + MSAS (see Bonnier et al, 2024)
-            # issue with reshape arrays
-            # owt_scs = self.SCS(_Rrs,self.Rrs_owt)
-            # tmp = owt_scs + (1-2*owt_sam/np.pi)/2
-
-            tmp_owt_dist[iy:yc, ix:xc] = np.max(tmp, axis=0)
+            tmp_owt_index[iy:yc, ix:xc], tmp_owt_dist[iy:yc, ix:xc] = self.classify(_Rrs.values)
 
         window_idxs = [(i, j) for i, j in
                        itertools.product(range(0, height, chunk),
@@ -291,14 +430,132 @@ class OWT():
                                coords=dict(x=self.Rrs.x,
                                            y=self.Rrs.y),
                                )
-        self.xowt[self.owt_index_name].attrs['definition'] = self.attrs_owt
+        self.set_attrs()
+
+        return self.xowt
+
+    def classify_windows(self, Rrs):
+        '''
+        OWT index and distance of a block of Rrs ((wl, y, x), or (y, x, wl) for the "bip" layout),
+        classified window by window (chunk x chunk pixels), so that the temporaries of the kernel
+        stay bounded within large dask chunks.
+
+        :return: array (2, y, x) of OWT index and distance
+        '''
+        bip = self.layout == 'bip'
+        classify = self.classify_bip if bip else self.classify
+        Ny, Nx = Rrs.shape[:2] if bip else Rrs.shape[1:]
+        if (Ny <= self.chunk) and (Nx <= self.chunk):
+            return np.stack(classify(Rrs))
+
+        out = np.empty((2, Ny, Nx), dtype=np.float32)
+        for iy in range(0, Ny, self.chunk):
+            for ix in range(0, Nx, self.chunk):
+                window = (slice(iy, iy + self.chunk), slice(ix, ix + self.chunk))
+                out[(slice(None),) + window] = np.stack(classify(Rrs[window] if bip else Rrs[(slice(None),) + window]))
+        return out
+
+    def lazy_process(self):
+        '''
+        Lazy OWT classification of a dask Rrs cube: the SAM kernel is mapped over the (y, x) chunks,
+        by windows of chunk x chunk pixels, index and distance being computed in the same task
+        when the output is written.
+        '''
+        logging.info('lazy OWT classification')
+        Rrs = self.Rrs.data.rechunk({0: -1})
+        Rrs_owt = self.Rrs_owt_values
+        name = 'owt-' + self.owt_database + '-' + self.layout + '-' + dask.base.tokenize(Rrs, Rrs_owt)
+
+        if self.layout == 'bip':
+            # layout-transform stage: pixel-interleaved (y, x, wl) blocks, made contiguous in the task
+            # of the kernel (no copy if Rrs is already stored as bip, see Product.to_scratch)
+            Rrs = Rrs.transpose(1, 2, 0)
+            owt = Rrs.map_blocks(self.classify_windows,
+                                 drop_axis=2, new_axis=0,
+                                 chunks=((2,),) + Rrs.chunks[:2],
+                                 dtype=np.float32,
+                                 name=name)
+        else:
+            owt = Rrs.map_blocks(self.classify_windows,
+                                 chunks=((2,),) + Rrs.chunks[1:],
+                                 dtype=np.float32,
+                                 name=name)
+
+        self.xowt = xr.Dataset(data_vars={self.owt_dist_name: (["y", "x"], owt[1]),
+                                          self.owt_index_name: (["y", "x"], owt[0]), },
+                               coords=dict(x=self.Rrs.x,
+                                           y=self.Rrs.y),
+                               )
+        self.set_attrs()
 
         return self.xowt
 
+    def process_spectra(self):
+        '''
+        OWT classification of spectra of shape (Nspectra, Nwl) (e.g., in-situ or tabular data),
+        vectorized with matrix products over blocks of spectra.
+
+        :return: xarray Dataset of owt_dist and owt_index along the spectrum dimension
+        '''
+        Rrs = self.Rrs.transpose(..., 'wl')
+        dims = Rrs.dims[:-1]
+        Rrs_full = Rrs.values
+        Rrs = self.project(Rrs_full, axis=1)
+        Rrs_owt = self.Rrs_owt_values
+        Rrs_owt_mod = np.sqrt((Rrs_owt ** 2).sum(axis=1))
+
+        Nspectra = Rrs.shape[0]
+        owt_index = np.full(Nspectra, np.nan, dtype=np.float32)
+        owt_dist = np.full(Nspectra, np.nan, dtype=np.float32)
+        block = self.chunk ** 2
+        for i in range(0, Nspectra, block):
+            _Rrs = Rrs[i:i + block]
+            with np.errstate(invalid='ignore'):
+                cos = (_Rrs @ Rrs_owt.T) / (np.sqrt((_Rrs ** 2).sum(axis=1))[:, None] * Rrs_owt_mod[None, :])
+                owt_sam = np.arccos(np.clip(cos, -1, 1))
+            valid = np.isfinite(owt_sam).all(axis=1)
+            owt_index[i:i + block][valid] = np.argmin(owt_sam[valid], axis=1) + 1
+            owt_dist[i:i + block][valid] = np.max(-1 * owt_sam[valid] / np.pi, axis=1)
+        owt_dist = self.full_band_dist(owt_dist, Rrs_full, Rrs, axis=1)
+
+        self.xowt = xr.Dataset(data_vars={self.owt_dist_name: (dims, owt_dist),
+                                          self.owt_index_name: (dims, owt_index), },
+                               coords={dim: self.Rrs[dim] for dim in dims if dim in self.Rrs.coords},
+                               )
+        self.set_attrs()
+
+        return self.xowt
+
+    def set_attrs(self):
+        self.xowt[self.owt_dist_name].attrs['description'] = 'spectral distance to the closest OWT (-angle/pi)'
+        self.xowt[self.owt_dist_name].attrs['range'] = [-1, 0]
+        if self.reduction is not None:
+            self.xowt[self.owt_dist_name].attrs['reduction'] = '{} ({:d} components), {}'.format(
+                self.reduction, self.projection.shape[1],
+                'full-band distance' if self.full_band else 'distance computed in the reduced space')
+        self.xowt[self.owt_index_name].attrs['definition'] = self.attrs_owt
+        self.xowt[self.owt_index_name].attrs['range'] = [0, self.Nowt]
+
     def set_range(self, param, minval=0, maxval=30):
         return param.where((param > minval) & (param < maxval))
 
+    @property
+    def cmap_owt(self):
+        return self.get_cmap(self.owt_colors)
+
+    @staticmethod
+    def get_cmap(colors=None):
+        '''
+        Colormap of the OWT classes (matplotlib is only imported when colormaps are needed).
+        '''
+        import matplotlib as mpl
+        if colors is None:
+            return mpl.colormaps['Spectral_r']
+        return mpl.colors.ListedColormap(colors)
+
     def plot(self):
+        import matplotlib.pyplot as plt
+        import matplotlib.patches as mpatches
 
         patch = []
         for key, info in self.owt_info.items():
@@ -324,17 +581,42 @@ class OWT_process():
     def __init__(self,
                  raster,
                  chunk=1024,
-                 Nproc=8):
+                 Nproc=8,
+                 parallel=True,
+                 lazy=False,
+                 **kwargs):
         '''
 
         :param raster:
         :param chunk:
         :param Nproc:
+        :param parallel: if False, windows are processed sequentially without dask
+        :param lazy: for dask rasters, return lazy outputs computed chunk by chunk when written
+        :param kwargs: spectral options passed to OWT (wl_range, srf, sensor, reduction, n_components)
         '''
 
         self.raster = raster
         self.chunk = chunk
         self.Nproc = Nproc
+        self.parallel = parallel
+        self.lazy = lazy
+        self.kwargs = kwargs
+        # colors of the OWT classes (e.g., for quick-looks)
+        self.owt_colors = {}
+
+    def run(self, OWT_kernel):
+        self.owt_colors[OWT_kernel.owt_index_name] = OWT_kernel.owt_colors
+        if OWT_kernel.Rrs.ndim == 2:
+            return OWT_kernel.process_spectra()
+        if not self.parallel:
+            return OWT_kernel.process_raster()
+        if self.lazy and (OWT_kernel.Rrs.chunks is not None):
+            return OWT_kernel.lazy_process()
+        return OWT_kernel.multi_process()
+
+    @property
+    def cmaps(self):
+        return {name: OWT.get_cmap(colors) for name, colors in self.owt_colors.items()}
 
     def execute(self):
         owt_database = 'Spyrakos2018'
@@ -343,9 +625,10 @@ class OWT_process():
                          param='m_nRrs',
                          suffix=owt_database,
                          chunk=self.chunk,
-                         Nproc=self.Nproc
+                         Nproc=self.Nproc,
+                         **self.kwargs
                          )
-        self.xowt_spyrakos2018 = OWT_kernel.multi_process()
+        self.xowt_spyrakos2018 = self.run(OWT_kernel)
 
         owt_database = 'Bi2024'
         OWT_kernel = OWT(self.raster,
@@ -353,9 +636,18 @@ class OWT_process():
                          param='m_Rrs',
                          suffix=owt_database,
                          chunk=self.chunk,
-                         Nproc=self.Nproc
+                         Nproc=self.Nproc,
+                         **self.kwargs
                          )
-        self.xowt_bi2024 = OWT_kernel.multi_process()
+        self.xowt_bi2024 = self.run(OWT_kernel)
 
         self.output = xr.merge([self.xowt_spyrakos2018,
                                 self.xowt_bi2024])
+
+
+def warmup():
+    '''
+    Compile the numba kernels (or load them from the disk cache, see kernels.py)
+    and run them on tiny arrays, e.g., when a worker process starts.
+    '''
+    return kernels.precompile()
@@ -0,0 +1,265 @@
+'''
+Module dedicated to the streaming processing of an image window by window,
+overlapping the reading, the computation and the writing of the windows.
+'''
+
+import os
+import time
+import queue
+import threading
+import itertools
+import datetime
+
+import numpy as np
+import xarray as xr
+import logging
+import netCDF4
+
+from xarray.backends.locks import HDF5_LOCK
+
+from . import __package__, __version__
+from .product import Product
+from .output import L2bProduct
+from .chlorophyll_a import Chl
+from .suspended_particulate_matter import Spm
+from .cdom import Cdom
+from .transparency import Transparency
+from .owt import OWT_process, read_database
+from .quality import Quality, pixel_area
+from .uncertainty import UNC_PARAM
+
+# end of stream
+_STOP = None
+
+
+class Pipeline():
+    '''
+    Streaming L2B processing: window N+1 is read while window N is processed
+    and window N-1 is compressed and written, with bounded queues between the stages.
+    The computation overlaps the I/O as the numba kernels release the GIL (see kernels.py);
+    the writes take the HDF5 lock of xarray, libhdf5 not being thread-safe.
+    '''
+
+    def __init__(self,
+                 prod,
+                 l2b_path,
+                 window=1024,
+                 queue_size=2,
+                 codec='zlib',
+                 codecs=None,
+                 packing='range',
+                 uncertainty=False,
+                 quality=True):
+        '''
+
+        :param prod: Product object of the L2A image
+        :param l2b_path: path of the L2B output file
+        :param window: size of the spatial windows
+        :param queue_size: maximum number of windows waiting between two stages
+        :param codec: default compression codec (see output.CODECS)
+        :param codecs: per-variable codecs overriding the default one
+        :param packing: int16 packing mode fixed before processing, "range" or "log" (see L2bProduct)
+        :param uncertainty: propagate the Rrs uncertainty (uncertainty.UNC_PARAM) to <parameter>_unc layers
+        :param quality: accumulate data-quality statistics window by window (see quality.py)
+        '''
+        if packing not in ['range', 'log']:
+            raise ValueError('streaming packing must be "range" or "log"')
+        self.prod = prod
+        self.l2b_path = l2b_path
+        # written into a temporary file renamed on success, so that no truncated product is left
+        self.tmp_path = l2b_path + '.tmp'
+        self.window = window
+        self.queue_size = queue_size
+        self.codec = codec
+        self.codecs = codecs
+        self.packing = packing
+        self.unc_param = UNC_PARAM if uncertainty else None
+        self.qa = Quality(pixel_area(prod.raster)) if quality else None
+        self.processor = __package__ + '_' + __version__
+
+        self.variables = [variable for variable in ['Rrs', self.unc_param, 'flags', 'mask']
+                          if variable in prod.raster.keys()]
+        self.height, self.width = prod.raster.sizes['y'], prod.raster.sizes['x']
+        self.windows = [(iy, min(self.height, iy + window), ix, min(self.width, ix + window))
+                        for iy, ix in itertools.product(range(0, self.height, window),
+                                                        range(0, self.width, window))]
+        self.timing = dict(read=0., compute=0., write=0., total=0.)
+        self.error = None
+
+    def read_window(self, iy, yc, ix, xc):
+        return self.prod.raster[self.variables].isel(y=slice(iy, yc), x=slice(ix, xc)).load()
+
+    def compute_window(self, raster):
+        '''
+        Run the OWT classification and all the algorithms on a loaded window.
+        '''
+        owt_process = OWT_process(raster, chunk=max(raster.sizes['y'], raster.sizes['x']), parallel=False)
+        owt_process.execute()
+        l2_raster_list = [owt_process.output]
+        for algo in [Chl, Spm, Cdom, Transparency]:
+            algo_prod = algo(raster, unc_param=self.unc_param)
+            algo_prod.process()
+            l2_raster_list.append(algo_prod.output)
+        l2b = L2bProduct(Product(raster), l2_raster_list, codec=self.codec, codecs=self.codecs, chunk=self.window,
+                         packing=self.packing)
+        if self.qa is not None:
+            self.qa.build(l2b.l2b_prod, raster.Rrs.isel(wl=0, drop=True).notnull(), ranges=True)
+            self.qa.update()
+        return l2b
+
+    def create_output(self, l2b):
+        '''
+        Create the output NetCDF file (temporary path), the int16 packing being fixed by the declared range
+        of each parameter.
+        '''
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        odir = os.path.dirname(self.l2b_path)
+        if (odir != '') and not os.path.exists(odir):
+            os.makedirs(odir)
+
+        with HDF5_LOCK:
+            return self._create_output(l2b)
+
+    def _create_output(self, l2b):
+        raster = self.prod.raster
+        l2b_window = l2b.l2b_prod
+        nc = netCDF4.Dataset(self.tmp_path, 'w')
+        nc.createDimension('y', self.height)
+        nc.createDimension('x', self.width)
+        for dim in ['y', 'x']:
+            coord = nc.createVariable(dim, raster[dim].dtype, (dim,))
+            coord[:] = raster[dim].values
+            coord.setncatts(self.netcdf_attrs(raster[dim].attrs))
+        if 'spatial_ref' in raster.variables:
+            grid_mapping = nc.createVariable('spatial_ref', 'i8')
+            grid_mapping.assignValue(0)
+            grid_mapping.setncatts(self.netcdf_attrs(raster['spatial_ref'].attrs))
+
+        for variable in l2b_window.data_vars:
+            param = l2b_window[variable]
+            if param.dims != ('y', 'x'):
+                continue
+            codec = l2b.get_codec(variable, (self.height, self.width))
+            if np.issubdtype(param.dtype, np.integer):
+                var = nc.createVariable(variable, param.dtype, ('y', 'x'), **codec)
+            else:
+                var = nc.createVariable(variable, 'i2', ('y', 'x'), fill_value=-32768, **codec)
+                param, var.scale_factor, var.add_offset = l2b.pack(param)
+            attrs = self.netcdf_attrs(param.attrs)
+            attrs['grid_mapping'] = 'spatial_ref'
+            var.setncatts(attrs)
+
+        attrs = dict(raster.attrs)
+        attrs['processing_time'] = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%f')
+        attrs['processor'] = self.processor
+        nc.setncatts(self.netcdf_attrs(attrs))
+        return nc
+
+    @staticmethod
+    def netcdf_attrs(attrs):
+        return {key: val for key, val in attrs.items()
+                if isinstance(val, (str, int, float, list, tuple, np.ndarray, np.number))
+                and not isinstance(val, bool) and not key.startswith('_')}
+
+    @staticmethod
+    def write_window(nc, l2b, iy, yc, ix, xc):
+        windows = {}
+        for variable in l2b.l2b_prod.data_vars:
+            if variable not in nc.variables:
+                continue
+            param = l2b.l2b_prod[variable]
+            if np.issubdtype(param.dtype, np.integer):
+                values = param.values
+            else:
+                # values out of the declared range are masked (log-scaled with the "log" packing)
+                values = l2b.pack(param)[0].values
+                invalid = ~np.isfinite(values)
+                values = np.ma.masked_array(np.where(invalid, 0, values), mask=invalid)
+            windows[variable] = values
+        # libhdf5 is not thread-safe: writes are serialized with the reads of xarray (reader thread)
+        with HDF5_LOCK:
+            for variable, values in windows.items():
+                nc[variable][iy:yc, ix:xc] = values
+
+    def reader(self, read_queue):
+        try:
+            for window in self.windows:
+                start = time.perf_counter()
+                raster = self.read_window(*window)
+                self.timing['read'] += time.perf_counter() - start
+                read_queue.put((window, raster))
+                if self.error is not None:
+                    break
+        except Exception as error:
+            self.error = error
+        read_queue.put(_STOP)
+
+    def writer(self, nc, write_queue):
+        try:
+            while True:
+                item = write_queue.get()
+                if item is _STOP:
+                    break
+                window, l2b = item
+                start = time.perf_counter()
+                self.write_window(nc, l2b, *window)
+                self.timing['write'] += time.perf_counter() - start
+        except Exception as error:
+            self.error = error
+            # keep consuming so that the compute stage never blocks
+            while write_queue.get() is not _STOP:
+                pass
+        finally:
+            with HDF5_LOCK:
+                nc.close()
+
+    def run(self):
+        logging.info('streaming processing of {:d} windows'.format(len(self.windows)))
+        start_total = time.perf_counter()
+        # OWT reference spectra read once for all the windows
+        for owt_database in ['Spyrakos2018', 'Bi2024']:
+            read_database(owt_database)
+        read_queue = queue.Queue(maxsize=self.queue_size)
+        write_queue = queue.Queue(maxsize=self.queue_size)
+
+        reader = threading.Thread(target=self.reader, args=(read_queue,), daemon=True)
+        reader.start()
+
+        writer = None
+        while True:
+            item = read_queue.get()
+            if item is _STOP:
+                break
+            window, raster = item
+            start = time.perf_counter()
+            try:
+                l2b = self.compute_window(raster)
+                self.timing['compute'] += time.perf_counter() - start
+                if writer is None:
+                    nc = self.create_output(l2b)
+                    writer = threading.Thread(target=self.writer, args=(nc, write_queue), daemon=True)
+                    writer.start()
+            except Exception as error:
+                self.error = error
+                while read_queue.get() is not _STOP:
+                    pass
+                break
+            write_queue.put((window, l2b))
+
+        if writer is not None:
+            write_queue.put(_STOP)
+            writer.join()
+        reader.join()
+        if self.error is not None:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+            raise self.error
+        os.replace(self.tmp_path, self.l2b_path)
+        if self.qa is not None:
+            self.qa.write(self.l2b_path)
+
+        self.timing['total'] = time.perf_counter() - start_total
+        logging.info('streaming timing (s): ' + ', '.join(['{}: {:.2f}'.format(stage, duration)
+                                                            for stage, duration in self.timing.items()]))
+        return self.timing
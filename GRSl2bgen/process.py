@@ -7,62 +7,209 @@ import glob
 import numpy as np
 import xarray as xr
 import logging
-from dask.distributed import Client
+import dask
 
-client = Client(processes=False)  # this yields a LocalCluster that doesn't have multiprocessing capabilities (doc is very brief and not very helpful: http://distributed.dask.org/en/stable/api.html#distributed.LocalCluster)
-from . import Product, L2bProduct
-from . import Chl, Spm, Cdom, Transparency, OWT_process
+from .product import Product
+from .output import L2bProduct
+from .chlorophyll_a import Chl
+from .suspended_particulate_matter import Spm
+from .cdom import Cdom
+from .transparency import Transparency
+from .owt import OWT, OWT_process
+from .tuning import ChunkPlan
+from .pipeline import Pipeline
+from .overview import Overviews
+from .quality import Quality, pixel_area
+from .uncertainty import UNC_PARAM
 
 opj = os.path.join
 
+# suggested eager_max_pixels: scenes up to 1024 x 1024 pixels
+EAGER_MAX_PIXELS = 2 ** 20
+
+# distributed client, started by the first run processed with dask
+client = None
+
+
+def get_client(address=None):
+    global client
+    if client is None:
+        from dask.distributed import Client
+        if address is not None:
+            client = Client(address)
+            return client
+        client = Client(processes=False)  # this yields a LocalCluster that doesn't have multiprocessing capabilities (doc is very brief and not very helpful: http://distributed.dask.org/en/stable/api.html#distributed.LocalCluster)
+    return client
+
 
 class Process():
     def __init__(self,
                  l2a_obj,
-                 l2b_path='./l2b_product.nc'):
+                 l2b_path='./l2b_product.nc',
+                 zones=None,
+                 zones_id_field='id',
+                 scratch_dir=None,
+                 layout=None,
+                 autotune=False,
+                 calibrate=False,
+                 streaming=False,
+                 codec='zlib',
+                 packing=None,
+                 eager_max_pixels=0,
+                 chunk=2048,
+                 scheduler=None,
+                 overviews=None,
+                 quicklooks=False,
+                 uncertainty=False,
+                 quality=True):
+        '''
+
+        :param l2a_obj: path or xarray of the L2A input image
+        :param l2b_path: path of the L2B output file
+        :param zones: polygons (GeoDataFrame or vector file) for which zonal statistics
+                      are written next to the L2B product
+        :param zones_id_field: name of the polygon ID field
+        :param scratch_dir: directory of the memory-mapped scratch array of Rrs (if layout is set)
+        :param layout: if set ("bsq" or "bip"), Rrs is decoded once into a memory-mapped scratch array
+                       with that layout and every stage works on zero-copy views of it
+        :param autotune: choose the OWT window and dask chunks from the memory, workers and tile size
+        :param calibrate: refine the autotuned OWT window by timing the first windows
+        :param streaming: process and write the image window by window, overlapping reading,
+                          computation and writing (int16 packing fixed by the parameter ranges)
+        :param codec: compression codec of the L2B variables (see output.CODECS)
+        :param packing: int16 packing mode ("data", "range" or "log"), default to "data" for eager processing
+                        and "range" otherwise, so that the parameters are computed and written chunk by chunk
+                        (the "data" packing persists the whole product in memory, see L2bProduct.persist)
+        :param eager_max_pixels: images up to this number of pixels (e.g., EAGER_MAX_PIXELS) are read without
+                                 dask chunks, loaded into memory and processed eagerly with NumPy/numba,
+                                 without dask scheduling (default 0: disabled)
+        :param chunk: spatial size of the dask chunks (if not autotuned); the parameters are computed lazily
+                      and written chunk by chunk (maximum size of the windows for streaming processing)
+        :param scheduler: address of a dask-distributed scheduler on which the chunks are computed,
+                          or "threads" to compute them with local threads (e.g., within a cluster job,
+                          see cluster.py); default to a local distributed client
+        :param overviews: decimation factors of the overviews (e.g., (2, 4, 8)) stored as groups of the L2B file,
+                          computed in the same pass as the export
+        :param quicklooks: write PNG quick-looks (RGB, OWT, Chl-a) of the coarsest overview
+        :param uncertainty: propagate the Rrs uncertainty (uncertainty.UNC_PARAM) of the L2A product
+                            to <parameter>_unc layers computed in the same pass as the parameters
+                            (see uncertainty.py)
+        :param quality: accumulate data-quality statistics (valid and out-of-range fractions, OWT class areas)
+                        while computing the parameters, written into the attributes and a <l2b>_qa.json sidecar
+        '''
         self.l2a_obj = l2a_obj
         self.l2b_path = l2b_path
+        self.zones = zones
+        self.zones_id_field = zones_id_field
+        self.scratch_dir = scratch_dir
+        self.layout = layout
+        self.autotune = autotune or calibrate
+        self.calibrate = calibrate
+        self.streaming = streaming
+        self.codec = codec
+        self.packing = packing
+        self.eager_max_pixels = eager_max_pixels
+        self.eager = False
+        self.chunk = chunk
+        self.scheduler = scheduler
+        self.overviews = overviews
+        self.quicklooks = quicklooks
+        self.uncertainty = uncertainty
+        self.quality = quality
+        self.plan = None
+        self.prod = None
         self.successful = False
 
     def execute(self, ):
+        '''
+        Run the processing; on failure the scratch array of the L2A product (if any) is removed.
+        '''
+        try:
+            self.process()
+        except BaseException:
+            if self.prod is not None:
+                self.prod.close()
+            raise
+
+    def process(self):
         logging.info('import l2a product')
         l2a_obj = self.l2a_obj
 
-        prod = Product(l2a_obj)
+        # opened without dask chunks if it may be processed eagerly (chunked below otherwise)
+        prod = Product(l2a_obj, chunks=None if self.eager_max_pixels > 0 else {'wl': -1})
+        self.prod = prod
+        window = 1024
+        self.eager = (prod.raster.sizes['y'] * prod.raster.sizes['x'] <= self.eager_max_pixels) and not self.streaming
+        if self.eager:
+            logging.info('eager processing')
+            # only the cubes of the legacy beam profile are dask arrays (see Product.read_beam)
+            with dask.config.set(scheduler='synchronous'):
+                prod.raster = prod.raster.load()
+        else:
+            if self.scheduler != 'threads':
+                get_client(self.scheduler)
+            prod.raster = prod.raster.chunk({'wl': -1, 'y': self.chunk, 'x': self.chunk})
+        if self.packing is None:
+            self.packing = 'data' if self.eager else 'range'
+        if self.autotune and not self.eager:
+            Nwl, height, width = prod.raster.Rrs.transpose('wl', 'y', 'x').shape
+            Nworkers = None
+            if self.scheduler != 'threads':
+                Nworkers = sum(get_client(self.scheduler).nthreads().values())
+            self.plan = ChunkPlan(height, width, Nwl, Nworkers=Nworkers)
+            prod.raster = prod.raster.chunk(self.plan.chunks)
+            if self.calibrate:
+                self.plan.calibrate(OWT(prod.raster))
+            logging.info('chunk plan: ' + repr(self.plan))
+            window = self.plan.window
+        if (self.layout is not None) and not self.eager:
+            prod.to_scratch(self.scratch_dir, layout=self.layout)
+        self.prod = prod
+
+        if self.streaming:
+            # windows of at most chunk pixels (e.g., the windows of a Mosaic)
+            pipeline = Pipeline(prod, self.l2b_path, window=min(window, self.chunk), codec=self.codec,
+                                packing=self.packing, uncertainty=self.uncertainty,
+                                quality=self.quality)
+            self.timing = pipeline.run()
+            self.successful = True
+            return
 
         #  ----------------------
         # get OWT parameters
         # ----------------------
         logging.info('get OWT classification')
-        owt_process = OWT_process(prod.raster)
+        owt_process = OWT_process(prod.raster, chunk=window, parallel=not self.eager, lazy=True)
         owt_process.execute()
+        self.owt_process = owt_process
+        unc_param = UNC_PARAM if self.uncertainty else None
 
         # ----------------------
         # get SPM parameters
         # ----------------------
         logging.info('get SPM parameters')
-        spm_prod = Spm(prod.raster)
+        spm_prod = Spm(prod.raster, unc_param=unc_param)
         spm_prod.process()
 
         # ----------------------
         # get Chl-a parameters
         # ----------------------
         logging.info('get Chl-a parameters')
-        chl_prod = Chl(prod.raster)
+        chl_prod = Chl(prod.raster, unc_param=unc_param)
         chl_prod.process()
 
         # ----------------------
         # get CDOM parameters
         # ----------------------
         logging.info('get CDOM parameters')
-        cdom_prod = Cdom(prod.raster)
+        cdom_prod = Cdom(prod.raster, unc_param=unc_param)
         cdom_prod.process()
 
         # ----------------------
         # get transparency parameters
         # ----------------------
         logging.info('get transparency parameters')
-        trans_prod = Transparency(prod.raster)
+        trans_prod = Transparency(prod.raster, unc_param=unc_param)
         trans_prod.process()
 
         logging.info('construct l2b product')
@@ -72,9 +219,40 @@ class Process():
             spm_prod.output,
             cdom_prod.output,
             trans_prod.output]
-        self.l2b = L2bProduct(prod, l2_raster_list)
+        self.l2b = L2bProduct(prod, l2_raster_list, codec=self.codec,
+                              packing=self.packing)
+        if self.plan is not None:
+            self.l2b.l2b_prod.attrs['chunk_plan'] = repr(self.plan)
+        if self.l2b.packing == 'data':
+            # computed once for both the packing ranges and the export
+            self.l2b.persist()
+        self.qa = None
+        if self.quality:
+            self.qa = Quality(pixel_area(prod.raster))
+            self.qa.build(self.l2b.l2b_prod, prod.raster.Rrs.isel(wl=0, drop=True).notnull(),
+                          ranges=self.l2b.packing != 'data')
         self.successful = True
 
     def write_output(self):
-        logging.info('export final l2b product into netcdf')
-        self.l2b.export_to_netcdf(self.l2b_path)
+        try:
+            self.export()
+        finally:
+            self.prod.close()
+
+    def export(self):
+        # with streaming, the l2b product is already written by the pipeline
+        if not self.streaming:
+            logging.info('export final l2b product into netcdf')
+            overviews = None
+            if (self.overviews is not None) or self.quicklooks:
+                overviews = Overviews(self.overviews or (8,), quicklooks=self.quicklooks, cmaps=self.owt_process.cmaps)
+                overviews.build(self.l2b.l2b_prod, self.prod.raster.Rrs, ranges=self.l2b.packing != 'data')
+            self.l2b.export_to_netcdf(self.l2b_path, overviews=overviews, quality=self.qa)
+
+        if self.zones is not None:
+            logging.info('export zonal statistics')
+            from .zonal import ZonalStats
+            # read from the written product rather than computed again
+            zonal = ZonalStats(self.l2b_path, self.zones, id_field=self.zones_id_field)
+            zonal.process()
+            zonal.write(os.path.splitext(self.l2b_path)[0] + '_zonal.csv')
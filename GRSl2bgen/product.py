@@ -1,13 +1,13 @@
 import os, sys, re, glob
+import tempfile
+import weakref
 
 import numpy as np
 import xarray as xr
-import rioxarray
+import dask
 import datetime
 
-from dateutil import parser
 import logging
-from pkg_resources import resource_filename
 
 from . import __package__, __version__
 
@@ -19,12 +19,14 @@ class Product():
 
     '''
 
-    def __init__(self, l2a_obj):
+    def __init__(self, l2a_obj, chunks={'wl': -1}):
         '''
         Get the L2A product object
         :param l2a_obj: path or xarray of the L2A input image
+        :param chunks: dask chunks of the NetCDF input, None for lazy loading without dask
         '''
         self.processor = __package__ + '_' + __version__
+        self.scratch_file = None
 
         ##################################
         # Get image data
@@ -34,21 +36,19 @@ class Product():
             if os.path.isdir(l2a_obj):
 
                 basename = os.path.basename(l2a_obj)
-                main_file = opj(l2a_obj, basename + '.nc')
+                self.l2a_file = opj(l2a_obj, basename + '.nc')
                 ancillary_file = opj(l2a_obj, basename + '_anc.nc')
 
-                self.raster = xr.open_dataset(main_file, decode_coords='all', chunks={'wl': -1})
+                self.raster = self.open_raster(self.l2a_file, chunks=chunks)
                 self.ancillary = xr.open_dataset(ancillary_file, decode_coords='all')
             else:
                 # get extension
                 extension = l2a_obj.split('.')[-1]
+                self.l2a_file = l2a_obj
+                self.ancillary = None
 
-                if extension == 'nc':
-                    self.raster = xr.open_dataset(l2a_obj, decode_coords='all', chunks={'wl': -1})
-                    self.ancillary = None
-                elif 'zarr' in extension:
-                    self.raster =xr.open_zarr(l2a_obj,decode_coords='all')
-                    self.ancillary = None
+                if (extension == 'nc') or ('zarr' in extension):
+                    self.raster = self.open_raster(self.l2a_file, chunks=chunks)
                 else:
                     logging.info('input file format not recognized, stop')
                     return
@@ -61,26 +61,128 @@ class Product():
         if self.raster.attrs['metadata_profile'] != 'beam':
             return
 
-        # reshape into datacube:
-        wls =  self.raster.wl
+        # reshape the bands into datacubes, the other variables being kept as opened
+        self.raster = self.read_beam(self.raster)
 
-        if self.raster.dims.__contains__('wl'):
-            self.raster=self.raster.drop_dims('wl')
+    @staticmethod
+    def open_raster(file, chunks={'wl': -1}):
+        # registers the .rio accessor (CRS and transform) of the opened raster
+        import rioxarray
 
-        Rrs_vars = []
-        Rrs_g_vars = []
-        for wl in wls:
-            Rrs_vars.append('Rrs_{:d}'.format(wl))
-            Rrs_g_vars.append('Rrs_g_{:d}'.format(wl))
+        if 'zarr' in file.split('.')[-1]:
+            if chunks is None:
+                return xr.open_zarr(file, decode_coords='all', chunks=None)
+            return xr.open_zarr(file, decode_coords='all')
+        return xr.open_dataset(file, decode_coords='all', chunks=chunks)
 
-        Rrs = self.raster[Rrs_vars].to_array(dim='wl', name='Rrs').chunk({'wl': 1})
-        Rrs = Rrs.assign_coords({'wl': wls})
-        raster = self.raster.drop_vars(Rrs_vars)
-        Rrs_g = self.raster[Rrs_g_vars].to_array(dim='wl', name='Rrs_g').chunk({'wl': 1})
-        Rrs_g = Rrs_g.assign_coords({'wl': wls})
-        raster = raster.drop_vars(Rrs_g_vars)
-        self.raster = xr.merge([raster, Rrs, Rrs_g])
+    @staticmethod
+    def read_beam(raster, chunk=1024):
+        '''
+        Stack the per-band variables (Rrs_<wl>, Rrs_g_<wl>, Rrs_unc_<wl>) of the legacy "beam" profile
+        into (wl, y, x) cubes chunked over the spatial dimensions only.
+        Each spatial chunk reads all its bands at once, so that the size of the dask graph
+        does not depend on the number of bands.
+
+        :param raster: raster of the "beam" profile (lazily loaded, with or without dask chunks)
+        :param chunk: spatial chunk size
+        :return: raster with the Rrs, Rrs_g and Rrs_unc cubes
+        '''
+        import dask.array as da
+
+        wls = raster.wl.values
+        if 'wl' in raster.dims:
+            raster = raster.drop_dims('wl')
+
+        cubes = {}
+        for name in ['Rrs', 'Rrs_g', 'Rrs_unc']:
+            bands = [name + '_{:d}'.format(wl) for wl in wls]
+            if not all(band in raster.keys() for band in bands):
+                continue
+            data = da.from_array(BeamStack(raster, bands),
+                                 chunks=(-1, chunk, chunk),
+                                 name=name + '-beam-' + dask.base.tokenize(raster.encoding.get('source', id(raster))),
+                                 meta=np.array((), dtype=raster[bands[0]].dtype))
+            cubes[name] = xr.DataArray(data, dims=('wl', 'y', 'x'),
+                                       coords=dict(wl=wls, y=raster.y, x=raster.x),
+                                       name=name)
+            raster = raster.drop_vars(bands)
+
+        return raster.assign(cubes)
+
+    def to_scratch(self, scratch_dir=None, layout='bsq', chunk=1024):
+        '''
+        Decode the Rrs cube once into a memory-mapped float32 scratch array; the Rrs variable
+        of the raster is then a (wl, y, x) view of this array, so that the processing stages
+        get zero-copy slices instead of decompressing and copying the input again.
 
+        :param scratch_dir: directory of the scratch file (default temporary directory)
+        :param layout: "bsq" for band-sequential (wl, y, x) or "bip" for pixel-interleaved (y, x, wl) storage
+        :param chunk: number of rows decoded at once
+        '''
+        logging.info('decode Rrs into {} scratch array'.format(layout))
+        Rrs = self.raster.Rrs.transpose('wl', 'y', 'x')
+        Nwl, height, width = Rrs.shape
+        if layout == 'bsq':
+            dims, shape = ('wl', 'y', 'x'), (Nwl, height, width)
+        elif layout == 'bip':
+            dims, shape = ('y', 'x', 'wl'), (height, width, Nwl)
+        else:
+            raise ValueError('layout should be "bsq" or "bip"')
+
+        self.close()
+        fd, self.scratch_file = tempfile.mkstemp(suffix='_Rrs.dat', dir=scratch_dir)
+        os.close(fd)
+        # the file is also removed if the product is garbage-collected (or at exit) without being closed
+        self._finalizer = weakref.finalize(self, _remove_file, self.scratch_file)
+        arr = np.memmap(self.scratch_file, dtype=np.float32, mode='w+', shape=shape)
+        for iy in range(0, height, chunk):
+            yc = min(height, iy + chunk)
+            block = Rrs[:, iy:yc].values
+            if layout == 'bsq':
+                arr[:, iy:yc] = block
+            else:
+                arr[iy:yc] = block.transpose(1, 2, 0)
+        arr.flush()
 
+        xRrs = xr.DataArray(arr, dims=dims,
+                            coords=dict(wl=Rrs.wl, y=Rrs.y, x=Rrs.x),
+                            attrs=Rrs.attrs)
+        self.raster['Rrs'] = xRrs.transpose('wl', 'y', 'x')
+        self.layout = layout
 
+    def close(self):
+        '''
+        Remove the scratch file, if any.
+        '''
+        if self.scratch_file is not None:
+            self._finalizer()
+        self.scratch_file = None
+
+
+def _remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class BeamStack():
+    '''
+    Array-like (wl, y, x) stack of the per-band variables of a "beam" profile raster,
+    reading all the requested bands of a spatial window at once.
+    '''
 
+    def __init__(self, raster, bands):
+        self.raster = raster
+        self.bands = bands
+        self.dtype = raster[bands[0]].dtype
+        self.shape = (len(bands),) + raster[bands[0]].shape
+        self.ndim = 3
+
+    def __getitem__(self, key):
+        iwl, iy, ix = key
+        # bands opened with dask chunks are read within the task reading the window
+        with dask.config.set(scheduler='synchronous'):
+            if isinstance(iwl, (int, np.integer)):
+                return self.raster[self.bands[iwl]].isel(y=iy, x=ix).values.astype(self.dtype)
+            bands = self.bands[iwl]
+            window = self.raster[bands].isel(y=iy, x=ix).load()
+        return np.stack([window[band].values for band in bands]).astype(self.dtype)
@@ -0,0 +1,175 @@
+'''
+Module dedicated to the data-quality statistics of the L2B parameters (valid-pixel fraction,
+out-of-range fraction, area of the OWT classes), accumulated while the parameters are computed
+instead of reading the exported product again.
+'''
+
+import os
+import json
+
+import numpy as np
+import dask
+import logging
+import netCDF4
+
+# prefix of the statistics in the product attributes
+QA_PREFIX = 'qa_'
+
+
+def pixel_area(raster):
+    '''
+    Area of a pixel (m2) from the (y, x) coordinates of a raster in metres (e.g., UTM tiles).
+    '''
+    if (raster.sizes['x'] < 2) or (raster.sizes['y'] < 2):
+        return np.nan
+    return float(abs((raster.x[1] - raster.x[0]) * (raster.y[1] - raster.y[0])))
+
+
+class Quality():
+    '''
+    Data-quality statistics of the L2B parameters, counted chunk by chunk (lazy reductions computed
+    with the export, see L2bProduct.export_to_netcdf) or window by window (streaming, see Pipeline).
+    '''
+
+    def __init__(self, pixel_area=np.nan):
+        '''
+
+        :param pixel_area: area of a pixel (m2) for the OWT class areas
+        '''
+        self.pixel_area = pixel_area
+        self.counts = {}
+        self.pending = None
+        self.stats = {}
+
+    @staticmethod
+    def params(l2b_prod):
+        return [variable for variable in l2b_prod.data_vars
+                if (l2b_prod[variable].dims == ('y', 'x')) and (variable not in ['mask', 'flags'])
+                and np.issubdtype(l2b_prod[variable].dtype, np.floating) and not variable.endswith('_unc')]
+
+    def build(self, l2b_prod, valid, ranges=False):
+        '''
+        Define the counts of the statistics (lazy reductions for dask arrays).
+
+        :param l2b_prod: xarray Dataset of the L2B parameters
+        :param valid: mask of the pixels with a valid Rrs input
+        :param ranges: values out of the declared range of the parameters are masked when written
+                       ("range" and "log" packings) and counted as out of range
+        :return: nested dict of the counts
+        '''
+        counts = dict(pixels=valid.size, valid_input=valid.sum())
+        for variable in self.params(l2b_prod):
+            param = l2b_prod[variable]
+            if variable.startswith('owt_index'):
+                counts[variable] = dict(classes=self.class_counts(param, int(param.attrs.get('range', [0, 13])[1])))
+            else:
+                finite = param.notnull()
+                if ranges and ('range' in param.attrs):
+                    finite &= (param >= param.attrs['range'][0]) & (param <= param.attrs['range'][1])
+                # valid input but removed by the range masking (set_range, valid_limit, packing)
+                counts[variable] = dict(valid=finite.sum(), out_of_range=(valid & ~finite).sum())
+        self.pending = counts
+        return counts
+
+    @staticmethod
+    def class_counts(param, Nclass):
+        '''
+        Number of pixels of each class (index 1 to Nclass), one histogram per chunk.
+
+        :return: array of Nclass + 1 counts (index 0 unused)
+        '''
+        def block_counts(block):
+            classes = np.rint(block[np.isfinite(block) & (block >= 0) & (block <= Nclass)]).astype(np.int64)
+            return np.bincount(classes, minlength=Nclass + 1)[None, None, :]
+
+        data = param.data
+        if isinstance(data, np.ndarray):
+            return block_counts(data)[0, 0]
+        return data.map_blocks(block_counts, new_axis=2,
+                               chunks=tuple((1,) * len(chunks) for chunks in data.chunks) + ((Nclass + 1,),),
+                               dtype=np.int64).sum(axis=(0, 1))
+
+    def update(self, counts=None):
+        '''
+        Add computed counts (default: the pending ones) to the accumulated counts.
+        '''
+        counts = self.pending if counts is None else counts
+        self.counts = self.add(self.counts, counts)
+        self.pending = None
+        return self.counts
+
+    @classmethod
+    def add(cls, total, counts):
+        if isinstance(counts, dict):
+            total = total or {}
+            return {key: cls.add(total.get(key), value) for key, value in counts.items()}
+        if total is None:
+            total = 0
+        return total + np.asarray(counts, dtype=np.int64)
+
+    def compute(self, *delayed):
+        '''
+        Compute the counts together with other delayed tasks (e.g., the export of the product).
+        '''
+        results = dask.compute(*delayed, self.pending)
+        self.update(results[-1])
+        return results[:-1]
+
+    def get_stats(self):
+        '''
+        Fractions and areas from the accumulated counts.
+
+        :return: nested dict of the statistics
+        '''
+        counts = self.counts
+        pixels, valid_input = int(counts['pixels']), int(counts['valid_input'])
+        stats = dict(pixels=pixels,
+                     pixel_area_m2=self.pixel_area,
+                     valid_input_fraction=valid_input / pixels if pixels > 0 else np.nan,
+                     parameters={},
+                     owt_area_km2={})
+        for variable, count in counts.items():
+            if not isinstance(count, dict):
+                continue
+            if variable.startswith('owt_index'):
+                stats['owt_area_km2'][variable] = {iclass: int(number) * self.pixel_area / 1e6
+                                                   for iclass, number in enumerate(count['classes']) if iclass > 0}
+            else:
+                stats['parameters'][variable] = dict(
+                    valid_fraction=int(count['valid']) / pixels if pixels > 0 else np.nan,
+                    out_of_range_fraction=int(count['out_of_range']) / valid_input if valid_input > 0 else np.nan)
+        self.stats = stats
+        return stats
+
+    def get_attrs(self):
+        '''
+        Statistics as flat product attributes (qa_valid_<param>, qa_out_of_range_<param>,
+        qa_area_km2_<owt_index>_<class>), as Masking.get_stats does for the flags.
+        '''
+        stats = self.get_stats()
+        attrs = {QA_PREFIX + 'valid_input': stats['valid_input_fraction']}
+        for variable, param_stats in stats['parameters'].items():
+            attrs[QA_PREFIX + 'valid_' + variable] = param_stats['valid_fraction']
+            attrs[QA_PREFIX + 'out_of_range_' + variable] = param_stats['out_of_range_fraction']
+        for variable, areas in stats['owt_area_km2'].items():
+            for iclass, area in areas.items():
+                attrs['{}area_km2_{}_{:d}'.format(QA_PREFIX, variable, iclass)] = area
+        return {key: float(value) for key, value in attrs.items()}
+
+    def write(self, ofile, sidecar=None):
+        '''
+        Append the statistics to the attributes of the NetCDF file and write them into a JSON sidecar.
+
+        :param ofile: path of the L2B NetCDF file
+        :param sidecar: path of the JSON file, default to <ofile root>_qa.json
+        :return: path of the JSON file
+        '''
+        attrs = self.get_attrs()
+        with netCDF4.Dataset(ofile, 'a') as nc:
+            nc.setncatts(attrs)
+        if sidecar is None:
+            sidecar = os.path.splitext(ofile)[0] + '_qa.json'
+        with open(sidecar, 'w') as f:
+            json.dump(self.stats, f, indent=2)
+        logging.info('quality statistics: ' + sidecar)
+        return sidecar
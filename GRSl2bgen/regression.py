@@ -0,0 +1,283 @@
+''' Regression harness of the L2B processing: deterministic synthetic L2A products (datacube and beam profiles)
+are processed by the different engines of Process and every L2B variable is compared with the golden output
+(data/regression/L2B_golden.nc) within the tolerance of the int16 packing, next to the processing time.
+
+Usage:
+  GRSl2bgen_regression [--engines <engines>] [--profiles <profiles>] [--odir <odir>] [--update]
+  GRSl2bgen_regression -h | --help
+
+Options:
+  -h --help                Show this screen.
+  --engines engines        Comma-separated engines to check (see ENGINES) [default: all]
+  --profiles profiles      Comma-separated profiles of the synthetic L2A, datacube and/or beam [default: datacube,beam]
+  --odir odir              Directory of the synthetic inputs and of the outputs (kept), default to a temporary directory
+  --update                 Regenerate the golden output with the reference engine (after a deliberate change of results)
+
+  Example:
+      # after a refactoring of the OWT kernel, the SPM algorithms or the packing
+      GRSl2bgen_regression --engines eager,dask,streaming
+'''
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+import numpy as np
+import xarray as xr
+import logging
+
+from importlib_resources import files
+
+from . import __package__
+from .output import L2bProduct, LOG_MIN
+
+GOLDEN_FILE = files(__package__ + '.data').joinpath('regression', 'L2B_golden.nc')
+SEED = 20240617
+SHAPE = (64, 96)
+# Sentinel-2 MSI bands of the synthetic products
+WL = [443, 490, 560, 665, 705, 740, 783, 842, 865, 1610, 2190]
+# end-member spectra (sr-1) of the synthetic products: clear, turbid and eutrophic waters
+ENDMEMBERS = np.array([[0.006, 0.007, 0.005, 0.0008, 0.0006, 0.0003, 0.0002, 0.0001, 0.0001, 0., 0.],
+                       [0.010, 0.014, 0.025, 0.030, 0.028, 0.020, 0.018, 0.012, 0.011, 0.0005, 0.0002],
+                       [0.003, 0.004, 0.012, 0.005, 0.012, 0.006, 0.005, 0.003, 0.003, 0.0002, 0.0001]])
+
+# options of Process of each engine; the golden output is produced by the reference engine
+ENGINES = {'eager': dict(eager_max_pixels=2 ** 20),
+           'dask': dict(chunk=48, scheduler='threads'),
+           'bip': dict(layout='bip', scheduler='threads'),
+           'streaming': dict(streaming=True),
+           'log': dict(packing='log'),
+           }
+REFERENCE_ENGINE = 'eager'
+# tolerance of the comparisons, recorded in the golden output (see tolerance)
+TOLERANCE = ('half a packing step of the golden and of the tested variable, plus 1e-6 relative '
+             '(relative step for the parameters packed in log10 scale)')
+
+
+def synthetic_l2a(profile='datacube', shape=SHAPE, seed=SEED):
+    '''
+    Deterministic synthetic L2A product: mixtures of end-member spectra with amplitudes spanning
+    the switching domains of the SPM and turbidity algorithms, a block of invalid pixels
+    the sunglint reflectance (Rrs_g) and the Rrs uncertainty (Rrs_unc).
+
+    :param profile: "datacube" (Rrs cube) or "beam" (one variable per band)
+    :param shape: (height, width) of the image
+    :param seed: seed of the random generator
+    :return: xarray Dataset
+    '''
+    import rioxarray
+
+    rng = np.random.default_rng(seed)
+    height, width = shape
+    weights = rng.dirichlet(np.ones(len(ENDMEMBERS)), size=shape)
+    amplitude = 10 ** rng.uniform(-0.5, 0.8, size=shape)
+    Rrs = np.einsum('yxe,ew->wyx', weights, ENDMEMBERS) * amplitude
+    Rrs = (Rrs * (1 + 0.02 * rng.standard_normal(Rrs.shape))).astype(np.float32)
+    Rrs[:, :8, :8] = np.nan
+    Rrs_unc = (0.05 * np.abs(Rrs) + 1e-4).astype(np.float32)
+    Rrs_g = np.where(np.isnan(Rrs), np.nan, 2e-4).astype(np.float32)
+    flags = np.zeros(shape, dtype=np.uint32)
+    flags[:8, :8] = 1
+
+    coords = dict(x=600010. + 20 * np.arange(width), y=4899990. - 20 * np.arange(height))
+    if profile == 'datacube':
+        raster = xr.Dataset(dict(Rrs=(('wl', 'y', 'x'), Rrs), Rrs_g=(('wl', 'y', 'x'), Rrs_g),
+                                 Rrs_unc=(('wl', 'y', 'x'), Rrs_unc)),
+                            coords=dict(wl=WL, **coords))
+    elif profile == 'beam':
+        raster = xr.Dataset(coords=dict(wl=('wl', WL), **coords))
+        for iwl, wl in enumerate(WL):
+            raster['Rrs_{:d}'.format(wl)] = (('y', 'x'), Rrs[iwl])
+            raster['Rrs_g_{:d}'.format(wl)] = (('y', 'x'), Rrs_g[iwl])
+            raster['Rrs_unc_{:d}'.format(wl)] = (('y', 'x'), Rrs_unc[iwl])
+    else:
+        raise ValueError('profile should be "datacube" or "beam"')
+    raster['flags'] = (('y', 'x'), flags)
+    raster.attrs['metadata_profile'] = profile
+    return raster.rio.write_crs(32631)
+
+
+def tolerance(golden, tested):
+    '''
+    Per-pixel tolerance of the comparison: half a packing step of each file
+    (relative step for the parameters packed in log10 scale).
+    '''
+    tol = 0.5 * golden.encoding.get('scale_factor', 0) + 1e-6 * np.abs(golden)
+    step = tested.encoding.get('scale_factor', 0)
+    if tested.attrs.get('packing') == 'log10':
+        return tol + np.abs(golden) * (10 ** (0.5 * step) - 1)
+    return tol + 0.5 * step
+
+
+def compare(ofile, golden_file=GOLDEN_FILE, clip=False):
+    '''
+    Compare every variable of a L2B product with the golden output.
+
+    :param ofile: path of the tested L2B product
+    :param golden_file: path of the golden L2B product
+    :param clip: mask the golden values out of the declared range of the parameters (range and log packings),
+                 the pixels within the tolerance of the range bounds being skipped
+    :return: dict with the overall status, the failing variables, the missing or extra variables
+             and the commit of the golden output
+    '''
+    golden = xr.open_dataset(golden_file)
+    tested = xr.open_dataset(ofile)
+    report = dict(passed=True, failures={}, golden_commit=golden.attrs.get('golden_commit', 'unknown'),
+                  missing=sorted(set(golden.data_vars) - set(tested.data_vars)),
+                  extra=sorted(set(tested.data_vars) - set(golden.data_vars)))
+    if len(report['missing']) > 0:
+        report['passed'] = False
+
+    for variable in golden.data_vars:
+        if (variable not in tested.data_vars) or (golden[variable].dims != ('y', 'x')):
+            continue
+        param_golden, param = golden[variable], tested[variable]
+        tol = tolerance(param_golden, param)
+        if np.issubdtype(param.dtype, np.floating):
+            # physical values of the parameters packed in log10 scale
+            param = L2bProduct.decode(tested[[variable]])[variable]
+        values = param.values.astype(np.float64)
+        if clip and ('range' in param.attrs):
+            minval, maxval = param.attrs['range']
+            # pixels whose golden value is within the tolerance of a bound may be masked or not
+            ambiguous = ((param_golden - tol < minval) & (param_golden + tol >= minval)) | \
+                        ((param_golden + tol > maxval) & (param_golden - tol <= maxval))
+            values[ambiguous.values] = np.nan
+            param_golden = param_golden.where((param_golden >= minval) & (param_golden <= maxval) & ~ambiguous)
+            if tested[variable].attrs.get('packing') == 'log10':
+                param_golden = param_golden.clip(min=LOG_MIN)
+        values_golden = param_golden.values.astype(np.float64)
+
+        nan_mismatch = int((np.isnan(values_golden) != np.isnan(values)).sum())
+        with np.errstate(invalid='ignore'):
+            diff = np.abs(values - values_golden)
+            exceed = int((diff > np.asarray(tol)).sum())
+        if (nan_mismatch > 0) or (exceed > 0):
+            report['passed'] = False
+            report['failures'][variable] = dict(nan_mismatch=nan_mismatch, out_of_tolerance=exceed,
+                                                maxdiff=float(np.nanmax(diff)) if np.isfinite(diff).any() else 0.)
+    golden.close()
+    tested.close()
+    return report
+
+
+def process(l2a_file, l2b_file, **kwargs):
+    '''
+    Run the full Process on a L2A product, with the uncertainty propagation.
+
+    :return: processing time (s), int16 packing mode
+    '''
+    from .process import Process
+
+    start = time.perf_counter()
+    process_ = Process(l2a_file, l2b_file, uncertainty=True, **kwargs)
+    process_.execute()
+    process_.write_output()
+    return time.perf_counter() - start, process_.packing
+
+
+def source_commit():
+    '''
+    Commit of the source tree (git describe, "-dirty" with local changes), "unknown" out of a git checkout.
+    '''
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty', '--abbrev=7'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def update_golden(odir, golden_file=GOLDEN_FILE):
+    '''
+    Regenerate the golden output with the reference engine on the datacube profile,
+    its provenance (commit, engine, inputs and tolerance) being recorded in the global attributes.
+    '''
+    import netCDF4
+
+    l2a_file = os.path.join(odir, 'L2A_datacube.nc')
+    synthetic_l2a('datacube').to_netcdf(l2a_file)
+    l2b_file = os.path.join(odir, 'L2B_golden.nc')
+    process(l2a_file, l2b_file, **ENGINES[REFERENCE_ENGINE])
+    with netCDF4.Dataset(l2b_file, 'a') as nc:
+        nc.setncatts(dict(golden_commit=source_commit(),
+                          golden_engine=REFERENCE_ENGINE + ' ' + json.dumps(ENGINES[REFERENCE_ENGINE]),
+                          golden_input='synthetic_l2a("datacube"), seed {:d}, shape {}'.format(SEED, SHAPE),
+                          golden_tolerance=TOLERANCE))
+    os.makedirs(os.path.dirname(str(golden_file)), exist_ok=True)
+    shutil.copyfile(l2b_file, str(golden_file))
+    logging.info('golden output updated: ' + str(golden_file))
+    return str(golden_file)
+
+
+def run(engines=None, profiles=('datacube', 'beam'), odir=None, golden_file=GOLDEN_FILE):
+    '''
+    Process the synthetic products with each engine and compare them with the golden output.
+
+    :param engines: names of ENGINES to check (default all)
+    :param profiles: profiles of the synthetic L2A products
+    :param odir: directory of the inputs and outputs (kept), default to a temporary directory (removed)
+    :param golden_file: path of the golden L2B product
+    :return: report per profile and engine: timing, throughput and comparison
+    '''
+    from .owt import warmup
+
+    engines = list(ENGINES) if engines is None else engines
+    tmp_dir = None
+    if odir is None:
+        odir = tmp_dir = tempfile.mkdtemp(prefix='GRSl2bgen_regression_')
+    os.makedirs(odir, exist_ok=True)
+    # numba kernels are compiled (or loaded from the cache) out of the timings
+    warmup()
+
+    report = {}
+    try:
+        for profile in profiles:
+            l2a_file = os.path.join(odir, 'L2A_' + profile + '.nc')
+            synthetic_l2a(profile).to_netcdf(l2a_file)
+            report[profile] = {}
+            for engine in engines:
+                kwargs = ENGINES[engine]
+                l2b_file = os.path.join(odir, 'L2B_' + profile + '_' + engine + '.nc')
+                seconds, packing = process(l2a_file, l2b_file, **kwargs)
+                result = compare(l2b_file, golden_file, clip=packing != 'data')
+                result.update(seconds=round(seconds, 3),
+                              Mpixels_per_second=round(SHAPE[0] * SHAPE[1] / seconds / 1e6, 3))
+                report[profile][engine] = result
+                logging.info('{} {}: {} ({:.3f} s)'.format(profile, engine,
+                                                           'passed' if result['passed'] else 'FAILED', seconds))
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return report
+
+
+def main():
+    from docopt import docopt
+
+    args = docopt(__doc__)
+    odir = args['--odir']
+    if args['--update']:
+        tmp_dir = odir or tempfile.mkdtemp(prefix='GRSl2bgen_regression_')
+        print(update_golden(tmp_dir))
+        if odir is None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+
+    engines = None if args['--engines'] == 'all' else args['--engines'].split(',')
+    report = run(engines=engines, profiles=args['--profiles'].split(','), odir=odir)
+    print(json.dumps(report, indent=2))
+    for profile, results in report.items():
+        for engine, result in results.items():
+            print('{:10s} {:10s} {:7s} {:8.3f} s {:8.3f} Mpixels/s'.format(
+                profile, engine, 'passed' if result['passed'] else 'FAILED',
+                result['seconds'], result['Mpixels_per_second']))
+    if not all(result['passed'] for results in report.values() for result in results.values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
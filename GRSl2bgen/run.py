@@ -1,7 +1,7 @@
 ''' Executable to process Sentinel-2 L2A images into water quality paratmeters
 
 Usage:
-  GRSl2bgen <input_file> [-o <ofile>] [--odir <odir>]  [--no_clobber]
+  GRSl2bgen <input_file> [-o <ofile>] [--odir <odir>]  [--no_clobber] [--zones <zones>] [--streaming] [--eager] [--uncertainty]
   GRSl2bgen -h | --help
   GRSl2bgen -v | --version
 
@@ -16,6 +16,11 @@ Options:
   -o ofile         Full (absolute or relative) path to output L2 image directory.
   --odir odir      Ouput directory [default: ./]
   --no_clobber     Do not process <input_file> if <output_file> already exists.
+  --zones zones    Vector file of polygons (with an "id" field) for which zonal statistics
+                   are written next to the output file (requires geopandas).
+  --streaming      Process and write the image window by window (reduced memory footprint).
+  --eager          Process small images (up to 1024 x 1024 pixels) in memory, without dask.
+  --uncertainty    Propagate the Rrs uncertainty (Rrs_unc) to <parameter>_unc layers.
 
 
   Example:
@@ -27,11 +32,11 @@ import os, sys
 from docopt import docopt
 import logging
 from . import __package__, __version__
-from . import Process
 
 
 def main():
     args = docopt(__doc__, version=__package__ + '_' + __version__)
+    from .process import Process, EAGER_MAX_PIXELS
     print(args)
 
     file = args['<input_file>']
@@ -67,7 +72,9 @@ def main():
 
     logging.info('call GRSl2bgen for the following paramater. File:' +
                  file + ', output file:' + outfile)
-    process_ = Process(file, outfile)
+    process_ = Process(file, outfile, zones=args['--zones'], streaming=args['--streaming'],
+                       eager_max_pixels=EAGER_MAX_PIXELS if args['--eager'] else 0,
+                       uncertainty=args['--uncertainty'])
     process_.execute()
     if process_.successful:
         process_.write_output()
@@ -0,0 +1,86 @@
+'''
+Module dedicated to the retrieval of water quality parameters from tabular spectra
+(in-situ, hyperspectral or pixel extractions) without raster structure.
+'''
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import logging
+
+from .chlorophyll_a import Chl
+from .suspended_particulate_matter import Spm
+from .cdom import Cdom
+from .transparency import Transparency
+from .owt import OWT_process
+
+# central wavelengths (nm) required by the band-ratio algorithms
+ALGO_WL = [443, 490, 560, 665, 705, 740, 865]
+
+
+class Spectra():
+    '''
+    Retrieval over a set of Rrs spectra of shape (Nspectra, Nwl).
+    '''
+
+    def __init__(self,
+                 Rrs,
+                 wl=None,
+                 index=None):
+        '''
+        Get the Rrs spectra as a 1-D xarray Dataset (dimensions spectrum and wl).
+
+        :param Rrs: remote sensing reflectance (sr-1) as numpy array of shape (Nspectra, Nwl),
+                    pandas DataFrame with the wavelengths as columns or xarray DataArray with a wl dimension
+        :param wl: wavelengths (nm) of the numpy array columns
+        :param index: spectrum labels, default to the DataFrame index or range(Nspectra)
+        '''
+        if isinstance(Rrs, xr.DataArray):
+            Rrs = Rrs.transpose(..., 'wl')
+            Rrs = Rrs.rename({Rrs.dims[0]: 'spectrum'})
+        else:
+            if isinstance(Rrs, pd.DataFrame):
+                if wl is None:
+                    wl = Rrs.columns.astype(float)
+                if index is None:
+                    index = Rrs.index
+                Rrs = Rrs.values
+            if index is None:
+                index = np.arange(Rrs.shape[0])
+            Rrs = xr.DataArray(np.asarray(Rrs, dtype=np.float32),
+                               dims=['spectrum', 'wl'],
+                               coords=dict(spectrum=index, wl=np.asarray(wl)))
+        Rrs.name = 'Rrs'
+
+        self.raster = Rrs.to_dataset()
+        self.Nspectra = self.raster.sizes['spectrum']
+
+        # band-ratio algorithms select the nominal central wavelengths
+        missing = [_wl for _wl in ALGO_WL if _wl not in self.raster.wl.values]
+        if len(missing) > 0:
+            self.raster_algo = Rrs.interp(wl=ALGO_WL).to_dataset()
+        else:
+            self.raster_algo = self.raster
+        self.output = None
+
+    def process(self, owt=True):
+        '''
+        Run all the algorithms vectorized over the spectra.
+
+        :param owt: compute the OWT classification
+        :return: pandas DataFrame of the parameters (one row per spectrum)
+        '''
+        logging.info('process {:d} spectra'.format(self.Nspectra))
+        l2_list = []
+        if owt:
+            owt_process = OWT_process(self.raster)
+            owt_process.execute()
+            l2_list.append(owt_process.output)
+
+        for algo in [Chl, Spm, Cdom, Transparency]:
+            algo_prod = algo(self.raster_algo)
+            algo_prod.process()
+            l2_list.append(algo_prod.output)
+
+        self.output = xr.merge(l2_list, compat='override').drop_vars('wl', errors='ignore')
+        return self.output.to_dataframe()
@@ -2,16 +2,17 @@ import os
 import numpy as np
 import xarray as xr
 
-
-
+from .uncertainty import band_uncertainty, quadrature, uncertainty_layer
 
 
 class Spm():
     def __init__(self,
                  raster,
-                 param='Rrs'):
+                 param='Rrs',
+                 unc_param=None):
         self.raster = raster
         self.Rrs = raster[param]
+        self.Rrs_unc = band_uncertainty(raster, unc_param)
         self.output = None
 
     def process(self):
@@ -51,8 +52,13 @@ class Spm():
             'units': 'mg/l',
             'range': valid_limit
         }
-        self.output = xr.merge([self.spm_obs2co, self.turbi_dogliotti, self.spm_nechad]).drop_vars('wl')
-        self.output = self.output.compute(scheduler='processes')
+        params = [self.spm_obs2co, self.turbi_dogliotti, self.spm_nechad]
+        if self.Rrs_unc is not None:
+            params += [uncertainty_layer(self.obs2co_unc(), self.spm_obs2co),
+                       uncertainty_layer(self.turbi_D15_unc(), self.turbi_dogliotti),
+                       uncertainty_layer(self.spm_N10_unc(), self.spm_nechad)]
+        # kept lazy: computed with the other parameters by the scheduler of the pipeline at export
+        self.output = xr.merge(params, compat='no_conflicts').drop_vars('wl')
 
     def set_range(self, param, minval=0, maxval=2000):
         return param.where((param > minval) & (param < maxval))
@@ -101,7 +107,55 @@ class Spm():
         spm = self.nechad_relationship(red, coefs)
         return spm.where((spm >= valid_limit[0]),0).where(spm <= valid_limit[1])
 
+    def obs2co_unc(self, switch=[0.07, 0.14], coef0=[610.94, 0.2324], coef1=[691.13, 2.5411]):
+        '''
+        Uncertainty of obs2co, including the derivative of the mixing weight in the switching domain.
+        '''
+        red, nir = self.Rrs.sel(wl=665), self.Rrs.sel(wl=865)
+        u_red, u_nir = self.Rrs_unc.sel(wl=665), self.Rrs_unc.sel(wl=865)
+        spm_high = coef1[0] * (nir / red) ** coef1[1]
+        spm_low = self.nechad_relationship(red, coef0)
+        dhigh_red = -coef1[1] * spm_high / red
+        dhigh_nir = coef1[1] * spm_high / nir
+        dlow_red = self.nechad_derivative(red, coef0)
+        w = (red - switch[0]) / (switch[1] - switch[0])
+        dmixing_red = (1 - w) * dlow_red + w * dhigh_red + (spm_high - spm_low) / (switch[1] - switch[0])
+
+        unc_low = np.abs(dlow_red) * u_red
+        unc_high = quadrature(dhigh_red * u_red, dhigh_nir * u_nir)
+        unc_mixing = quadrature(dmixing_red * u_red, w * dhigh_nir * u_nir)
+        return xr.where(red <= switch[0], unc_low, xr.where(red >= switch[1], unc_high, unc_mixing))
+
+    def turbi_D15_unc(self, switch=[0.05, 0.07],
+                      coef_l=[228.1, 0.1641],
+                      coef_h=[3078.9, 0.2112]):
+        '''
+        Uncertainty of the Dogliotti et al., 2015 turbidity.
+        '''
+        red = self.Rrs.sel(wl=665)
+        dt_low = self.nechad_derivative(red, coef_l)
+        dt_high = self.nechad_derivative(red, coef_h)
+        w = (red - switch[0]) / (switch[1] - switch[0])
+        dt_mixing = (1 - w) * dt_low + w * dt_high + \
+                    (self.nechad_relationship(red, coef_h) - self.nechad_relationship(red, coef_l)) / (switch[1] - switch[0])
+        dt = xr.where(red <= switch[0], dt_low, xr.where(red >= switch[1], dt_high, dt_mixing))
+        return np.abs(dt) * self.Rrs_unc.sel(wl=665)
+
+    def spm_N10_unc(self, coefs=[342.1, 0.19563]):
+        '''
+        Uncertainty of the Nechad et al., 2010 SPM.
+        '''
+        return np.abs(self.nechad_derivative(self.Rrs.sel(wl=665), coefs)) * self.Rrs_unc.sel(wl=665)
+
     @staticmethod
     def nechad_relationship(Rrs, coefs):
         rho_wl = np.pi * Rrs
-        return coefs[0] * rho_wl / (1 - (rho_wl / coefs[1]))
\ No newline at end of file
+        return coefs[0] * rho_wl / (1 - (rho_wl / coefs[1]))
+
+    @staticmethod
+    def nechad_derivative(Rrs, coefs):
+        '''
+        Derivative of nechad_relationship with respect to Rrs.
+        '''
+        rho_wl = np.pi * Rrs
+        return np.pi * coefs[0] / (1 - (rho_wl / coefs[1])) ** 2
@@ -2,14 +2,18 @@ import os
 import numpy as np
 import xarray as xr
 
+from .uncertainty import band_uncertainty, quadrature, uncertainty_layer
+
 
 class Transparency():
     def __init__(self,
                  raster,
-                 param='Rrs'):
+                 param='Rrs',
+                 unc_param=None):
 
         self.raster = raster
         self.Rrs = raster[param]
+        self.Rrs_unc = band_uncertainty(raster, unc_param)
         self.output = None
 
 
@@ -29,7 +33,10 @@ class Transparency():
             'range': [0, 200]
         }
 
-        self.output = xr.merge([self.Kd_par])
+        params = [self.Kd_par]
+        if self.Rrs_unc is not None:
+            params.append(uncertainty_layer(self.Kd_par_RD22_unc(self.Kd_par, acoef=acoef), self.Kd_par))
+        self.output = xr.merge(params)
 
         return
 
@@ -47,3 +54,10 @@ class Transparency():
         :return:
         '''
         return acoef[0] * np.exp(acoef[1] * (self.Rrs.sel(wl=490) - self.Rrs.sel(wl=665)))
+
+    def Kd_par_RD22_unc(self, Kd_par, acoef=[3.09, -90.17]):
+        '''
+        Uncertainty of Kd_par_RD22
+        :return:
+        '''
+        return np.abs(acoef[1] * Kd_par) * quadrature(self.Rrs_unc.sel(wl=490), self.Rrs_unc.sel(wl=665))
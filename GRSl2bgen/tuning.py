@@ -0,0 +1,129 @@
+'''
+Module dedicated to the autotuning of the spatial windows and dask chunks.
+'''
+
+import os
+import time
+import json
+
+import numpy as np
+import logging
+
+# (OWT windows are also used for the numba kernels, keep them aligned)
+ALIGN = 256
+MIN_WINDOW = 256
+MAX_WINDOW = 4096
+
+
+class ChunkPlan():
+    '''
+    Spatial window size of the OWT stage and dask chunks of the raster,
+    chosen from the available memory, the number of workers and the tile dimensions.
+    '''
+
+    def __init__(self,
+                 height,
+                 width,
+                 Nwl,
+                 Nowt=13,
+                 itemsize=4,
+                 Nworkers=None,
+                 memory=None,
+                 memory_fraction=0.5,
+                 chunk_bytes=128 * 2 ** 20):
+        '''
+
+        :param height: number of rows of the tile
+        :param width: number of columns of the tile
+        :param Nwl: number of spectral bands
+        :param Nowt: number of optical water types of the largest OWT database
+        :param itemsize: size in bytes of the Rrs values
+        :param Nworkers: number of parallel workers (default: number of CPUs)
+        :param memory: available memory in bytes (default: from psutil)
+        :param memory_fraction: fraction of the available memory that the concurrent windows can use
+        :param chunk_bytes: target size of the dask chunks of the Rrs cube
+        '''
+        self.height = height
+        self.width = width
+        self.Nwl = Nwl
+        self.Nowt = Nowt
+        self.itemsize = itemsize
+        self.Nworkers = Nworkers or os.cpu_count() or 1
+        self.memory = memory or self.available_memory()
+        self.memory_fraction = memory_fraction
+        self.chunk_bytes = chunk_bytes
+        self.calibration = None
+        self.window, self.chunks = self.compute()
+
+    @staticmethod
+    def available_memory():
+        try:
+            import psutil
+            return psutil.virtual_memory().available
+        except ImportError:
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+    @staticmethod
+    def align(size):
+        return int(np.clip(ALIGN * max(1, int(size) // ALIGN), MIN_WINDOW, MAX_WINDOW))
+
+    def compute(self):
+        '''
+        Window size: the concurrent windows (Rrs, SAM per OWT, index and distance) must fit
+        in the memory budget and the tile must be split into at least two windows per worker.
+        Dask chunks: about chunk_bytes per (wl, y, x) chunk, as a multiple of the window size.
+        '''
+        bytes_per_pixel = (self.Nwl + self.Nowt + 2) * self.itemsize
+        budget = self.memory_fraction * self.memory / self.Nworkers
+        window_mem = np.sqrt(budget / bytes_per_pixel)
+        window_par = np.sqrt(self.height * self.width / (2 * self.Nworkers))
+        window = self.align(min(window_mem, window_par, max(self.height, self.width)))
+
+        chunk = np.sqrt(self.chunk_bytes / (self.Nwl * self.itemsize))
+        chunk = max(window, window * int(chunk // window))
+        chunks = {'wl': -1, 'y': min(chunk, self.height), 'x': min(chunk, self.width)}
+        return window, chunks
+
+    def calibrate(self, OWT_kernel, candidates=(256, 512, 1024, 2048)):
+        '''
+        Time the OWT classification (OWT.classify, with the layout of OWT_kernel) on the first window
+        of each candidate size and keep the fastest (in pixels per second) among those within the memory budget.
+
+        :param OWT_kernel: OWT object instantiated on the raster to process
+        :param candidates: candidate window sizes
+        :return: window size, one of the candidates (or the window of the memory budget if none fits)
+        '''
+        logging.info('calibrate OWT window size')
+        Rrs = OWT_kernel.Rrs.transpose('wl', 'y', 'x')
+        # compilation of the numba kernel must not be timed
+        OWT_kernel.classify(Rrs[:, :2, :2].values)
+
+        timing = {}
+        for window in candidates:
+            if window > self.window * 2:
+                continue
+            _Rrs = Rrs[:, :window, :window].values
+            Ny, Nx = _Rrs.shape[1:]
+            start = time.perf_counter()
+            OWT_kernel.classify(_Rrs)
+            timing[window] = Ny * Nx / (time.perf_counter() - start)
+            if (Ny < window) and (Nx < window):
+                break
+
+        if len(timing) > 0:
+            self.window = self.align(max(timing, key=timing.get))
+            self.chunks['y'] = min(max(self.chunks['y'], self.window), self.height)
+            self.chunks['x'] = min(max(self.chunks['x'], self.window), self.width)
+        self.calibration = {str(window): round(rate) for window, rate in timing.items()}
+        return self.window
+
+    def to_dict(self):
+        return dict(window=self.window,
+                    chunks=self.chunks,
+                    Nworkers=self.Nworkers,
+                    memory_GB=round(self.memory / 2 ** 30, 2),
+                    tile=[self.height, self.width, self.Nwl],
+                    calibration_pixels_per_second=self.calibration)
+
+    def __repr__(self):
+        return json.dumps(self.to_dict())
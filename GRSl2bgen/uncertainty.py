@@ -0,0 +1,63 @@
+'''
+Module dedicated to the analytic (first-order) propagation of the Rrs uncertainty to the L2B parameters,
+computed in the same pass as the parameters.
+
+The algorithm classes (Chl, Spm, Cdom, Transparency) take an unc_param argument: the name of the variable
+of the L2A raster holding the standard uncertainty of Rrs per band (UNC_PARAM, Rrs_unc, by default
+when the propagation is requested through Process or Pipeline), the bands being assumed independent.
+Each parameter then gets a <parameter>_unc layer. With unc_param=None (default) nothing is propagated;
+if the variable is missing from the raster, the propagation is skipped with a warning.
+Rrs_g, the sunglint reflectance removed from Rrs in the GRS L2A products, is not an uncertainty
+and is never used as such.
+'''
+
+import logging
+
+import numpy as np
+
+# name of the Rrs uncertainty variable of the L2A products
+UNC_PARAM = 'Rrs_unc'
+UNC_SUFFIX = '_unc'
+
+
+def band_uncertainty(raster, unc_param=None):
+    '''
+    Standard uncertainty of Rrs per band.
+
+    :param raster: L2A raster
+    :param unc_param: name of the uncertainty variable of the raster, None to disable the propagation
+    :return: DataArray (sr-1) or None if not available
+    '''
+    if unc_param is None:
+        return None
+    if unc_param not in raster.keys():
+        logging.warning('no Rrs uncertainty variable "{}" in the L2A raster, '
+                        'the uncertainty propagation is skipped'.format(unc_param))
+        return None
+    return np.abs(raster[unc_param])
+
+
+def quadrature(*terms):
+    '''
+    Combination of independent terms (partial derivative times uncertainty of each band).
+    '''
+    return np.sqrt(sum(term ** 2 for term in terms))
+
+
+def uncertainty_layer(unc, param):
+    '''
+    Uncertainty layer of a parameter: masked as the parameter, same units and range.
+
+    :param unc: propagated uncertainty
+    :param param: parameter with its final name and attributes
+    :return: DataArray named <param>_unc
+    '''
+    unc = unc.where(param.notnull()).drop_vars('wl', errors='ignore')
+    unc.name = param.name + UNC_SUFFIX
+    unc.attrs = {
+        'description': 'Standard uncertainty of ' + param.name + ', first-order propagation of the Rrs uncertainty',
+        'units': param.attrs.get('units', ''),
+    }
+    if 'range' in param.attrs:
+        unc.attrs['range'] = [0, param.attrs['range'][1]]
+    return unc
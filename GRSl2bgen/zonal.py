@@ -0,0 +1,205 @@
+'''
+Module dedicated to zonal statistics (e.g., per lake) of L2B products.
+'''
+
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import rioxarray
+import logging
+
+from rasterio import features
+
+from .output import L2bProduct
+
+# in-memory cache of the label rasters, indexed by tile grid and polygons; a full-tile label raster
+# weighs ~480 MB for a 10980 x 10980 tile, so that only the last ones are kept (least recently used evicted)
+LABEL_CACHE_SIZE = 2
+_label_cache = OrderedDict()
+
+
+def _cache_labels(key, labels):
+    _label_cache[key] = labels
+    _label_cache.move_to_end(key)
+    while len(_label_cache) > LABEL_CACHE_SIZE:
+        _label_cache.popitem(last=False)
+
+
+class ZonalStats():
+    '''
+    Per-polygon statistics of L2B parameters computed with grouped (bincount) reductions.
+    '''
+
+    def __init__(self,
+                 l2b_obj,
+                 polygons,
+                 id_field='id',
+                 variables=None,
+                 cache_dir=None):
+        '''
+        Rasterize the polygon IDs onto the L2B tile grid (once per grid, cached)
+        and reduce every L2B parameter per zone in one vectorized pass.
+
+        :param l2b_obj: path, xarray or L2bProduct of the L2B image
+        :param polygons: GeoDataFrame, path to a vector file (requires geopandas)
+                         or list of (geometry, id) pairs given in the tile CRS
+        :param id_field: name of the polygon ID column for GeoDataFrame and vector files
+        :param variables: variables to reduce, all the L2B parameters if None
+        :param cache_dir: directory where label rasters are saved for further runs
+        '''
+        if isinstance(l2b_obj, str):
+            self.l2b_path = l2b_obj
+            self.raster = L2bProduct.decode(xr.open_dataset(l2b_obj, decode_coords='all'))
+        elif isinstance(l2b_obj, xr.Dataset):
+            self.l2b_path = None
+            self.raster = l2b_obj
+        else:
+            self.l2b_path = None
+            self.raster = l2b_obj.l2b_prod
+
+        if variables is None:
+            variables = [variable for variable in self.raster.data_vars
+                         if self.raster[variable].dims == ('y', 'x') and
+                         variable not in ['mask', 'flags']]
+        self.variables = variables
+        self.cache_dir = cache_dir
+        self.height, self.width = self.raster.sizes['y'], self.raster.sizes['x']
+
+        self.shapes = self.get_shapes(polygons, id_field)
+        self.zone_ids = [zone_id for _, zone_id in self.shapes]
+        self.Nzone = len(self.zone_ids)
+        self.labels = self.get_labels()
+        self.output = None
+
+    def get_shapes(self, polygons, id_field):
+        if isinstance(polygons, str):
+            import geopandas as gpd
+            polygons = gpd.read_file(polygons)
+
+        if isinstance(polygons, pd.DataFrame):
+            crs = self.raster.rio.crs
+            if (polygons.crs is not None) and (crs is not None):
+                polygons = polygons.to_crs(crs)
+            return list(zip(polygons.geometry, polygons[id_field]))
+        return list(polygons)
+
+    def grid_key(self):
+        crs = self.raster.rio.crs
+        transform = self.raster.rio.transform(recalc=True)
+        key = str(crs) + str(tuple(transform)) + str((self.height, self.width))
+        for geom, zone_id in self.shapes:
+            geom = geom.wkb if hasattr(geom, 'wkb') else str(geom)
+            key += str(zone_id) + str(geom)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get_labels(self):
+        '''
+        Rasterize the polygons into a label raster: 0 outside the zones,
+        i+1 for the i-th polygon. The raster is cached per tile grid (LABEL_CACHE_SIZE last ones in memory,
+        all of them in cache_dir if set).
+        '''
+        key = self.grid_key()
+        if key in _label_cache:
+            _label_cache.move_to_end(key)
+            return _label_cache[key]
+
+        cache_file = None
+        if self.cache_dir is not None:
+            cache_file = os.path.join(self.cache_dir, 'zones_' + key + '.npy')
+            if os.path.exists(cache_file):
+                labels = np.load(cache_file)
+                _cache_labels(key, labels)
+                return labels
+
+        logging.info('rasterize {:d} polygons'.format(self.Nzone))
+        labels = features.rasterize(((geom, i + 1) for i, (geom, _) in enumerate(self.shapes)),
+                                    out_shape=(self.height, self.width),
+                                    transform=self.raster.rio.transform(recalc=True),
+                                    fill=0,
+                                    dtype=np.int32)
+        if cache_file is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.save(cache_file, labels)
+        _cache_labels(key, labels)
+        return labels
+
+    @staticmethod
+    def grouped_median(values, labels, Ngroup):
+        '''
+        Median of values per label, computed from a single sort of (label, value).
+        '''
+        order = np.lexsort((values, labels))
+        values, labels = values[order], labels[order]
+        count = np.bincount(labels, minlength=Ngroup)
+        start = np.cumsum(count) - count
+        median = np.full(Ngroup, np.nan)
+        ok = count > 0
+        low = start[ok] + (count[ok] - 1) // 2
+        high = start[ok] + count[ok] // 2
+        median[ok] = 0.5 * (values[low] + values[high])
+        return median
+
+    def process(self):
+        logging.info('compute zonal statistics')
+        Ngroup = self.Nzone + 1
+        labels = self.labels.ravel()
+        inzone = labels > 0
+        if 'mask' in self.raster.keys():
+            inzone &= (self.raster['mask'].values.ravel() == 0)
+        npix = np.bincount(labels, minlength=Ngroup)
+
+        stats = {'zone_id': self.zone_ids,
+                 'npix': npix[1:]}
+        for variable in self.variables:
+            arr = self.raster[variable].values.ravel()
+            valid = inzone & np.isfinite(arr)
+            label, value = labels[valid], arr[valid].astype(np.float64)
+
+            count = np.bincount(label, minlength=Ngroup)
+            if variable.startswith('owt_index'):
+                # class indices are not exact integers once unpacked from int16
+                value = np.rint(value).astype(int)
+                classes = np.unique(value)
+                Nclass = classes.max() + 1 if len(classes) > 0 else 1
+                hist = np.bincount(label * Nclass + value,
+                                   minlength=Ngroup * Nclass).reshape(Ngroup, Nclass)
+                for owt in classes:
+                    stats[variable + '_owt{:d}'.format(owt)] = hist[1:, owt]
+            else:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    total = np.bincount(label, weights=value, minlength=Ngroup)
+                    total2 = np.bincount(label, weights=value ** 2, minlength=Ngroup)
+                    mean = total / count
+                    std = np.sqrt(np.maximum(total2 / count - mean ** 2, 0))
+                stats[variable + '_mean'] = mean[1:]
+                stats[variable + '_median'] = self.grouped_median(value, label, Ngroup)[1:]
+                stats[variable + '_std'] = std[1:]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                stats[variable + '_valid_fraction'] = (count / npix)[1:]
+
+        self.output = pd.DataFrame(stats)
+        return self.output
+
+    def write(self, ofile=None, fmt='csv'):
+        '''
+        Write the zonal statistics table, by default next to the L2B raster product.
+
+        :param ofile: output file path
+        :param fmt: "csv" or "parquet" (requires pyarrow)
+        :return: output file path
+        '''
+        if ofile is None:
+            if self.l2b_path is None:
+                raise ValueError('output file must be provided for in-memory L2B products')
+            ofile = os.path.splitext(self.l2b_path)[0] + '_zonal.' + fmt
+
+        logging.info('export zonal statistics into ' + ofile)
+        if fmt == 'parquet':
+            self.output.to_parquet(ofile, index=False)
+        else:
+            self.output.to_csv(ofile, index=False)
+        return ofile
@@ -0,0 +1,38 @@
+'''
+Shared fixtures of the tests: small deterministic synthetic L2A and L2B products (see regression.py).
+'''
+
+import numpy as np
+import xarray as xr
+import pytest
+
+from GRSl2bgen.regression import synthetic_l2a
+
+
+@pytest.fixture(scope='session')
+def l2a_raster():
+    return synthetic_l2a('datacube', shape=(32, 48))
+
+
+@pytest.fixture(scope='session')
+def l2a_file(tmp_path_factory, l2a_raster):
+    ofile = tmp_path_factory.mktemp('l2a') / 'L2A_datacube.nc'
+    l2a_raster.to_netcdf(ofile)
+    return str(ofile)
+
+
+def synthetic_l2b(seed, shape=(20, 30)):
+    '''
+    Synthetic L2B product on a fixed grid: one parameter with a declared range and an OWT index.
+    '''
+    rng = np.random.default_rng(seed)
+    height, width = shape
+    coords = dict(x=600010. + 20 * np.arange(width), y=4899990. - 20 * np.arange(height))
+    Chla = rng.uniform(1, 50, size=shape)
+    Chla[rng.random(shape) < 0.1] = np.nan
+    owt_index = rng.integers(1, 4, size=shape).astype(np.float32)
+    l2b = xr.Dataset(dict(Chla_OC2=(('y', 'x'), Chla), owt_index_A=(('y', 'x'), owt_index),
+                          mask=(('y', 'x'), np.zeros(shape, dtype=np.uint8))), coords=coords)
+    l2b.Chla_OC2.attrs = dict(units='mg m-3', range=[0, 100])
+    l2b.owt_index_A.attrs = dict(range=[0, 13])
+    return l2b
@@ -0,0 +1,100 @@
+import os
+import json
+import subprocess
+import sys
+import time
+
+import numpy as np
+import xarray as xr
+
+from GRSl2bgen.cluster import Cluster, TileQueue, l2b_name, process_tile
+from GRSl2bgen.regression import synthetic_l2a
+
+WORKER = 'from GRSl2bgen.cluster import TileQueue; import sys; TileQueue(sys.argv[1], lease=float(sys.argv[2])).work()'
+
+
+def submit_tiles(tmp_path, Ntile=4):
+    l2a_files = write_tiles(tmp_path, Ntile)
+    queue = TileQueue(str(tmp_path / 'queue'), lease=30)
+    queue.submit(l2a_files, str(tmp_path / 'L2B'), eager_max_pixels=2 ** 20)
+    return queue, l2a_files
+
+
+def write_tiles(tmp_path, Ntile):
+    l2a_files = []
+    for itile in range(Ntile):
+        l2a_file = str(tmp_path / 'S2A_MSIL2Agrs_tile{:d}.nc'.format(itile))
+        synthetic_l2a(shape=(16, 24), seed=itile).to_netcdf(l2a_file)
+        l2a_files.append(l2a_file)
+    return l2a_files
+
+
+def run_workers(queue, Nworker=3):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    workers = [subprocess.Popen([sys.executable, '-c', WORKER, queue.queue_dir, str(queue.lease)], env=env)
+               for _ in range(Nworker)]
+    assert all(worker.wait(timeout=300) == 0 for worker in workers)
+
+
+def test_queue_with_several_workers(tmp_path):
+    queue, l2a_files = submit_tiles(tmp_path)
+    run_workers(queue)
+
+    report = queue.report()
+    assert report['jobs'] == dict(todo=0, running=0, done=len(l2a_files), failed=0)
+    # each tile claimed and processed exactly once
+    for name in os.listdir(queue.path('done', '')):
+        with open(queue.path('done', name)) as f:
+            job = json.load(f)
+        assert job['attempts'] == 1 and os.path.exists(job['l2b'])
+    assert sum(worker['tiles'] for worker in report['throughput'].values()) == len(l2a_files)
+    assert not any('.tmp-' in file for file in os.listdir(str(tmp_path / 'L2B')))
+
+
+def test_stale_claim_requeued(tmp_path):
+    queue, l2a_files = submit_tiles(tmp_path, Ntile=2)
+    # a worker claims a tile and dies without heartbeat
+    name, job = queue.claim()
+    stale = time.time() - 2 * queue.lease
+    os.utime(queue.path('running', name), (stale, stale))
+
+    run_workers(queue, Nworker=2)
+    assert queue.report()['jobs'] == dict(todo=0, running=0, done=2, failed=0)
+    with open(queue.path('done', name)) as f:
+        job = json.load(f)
+    assert job['attempts'] == 2 and 'lease expired' in job['error']
+
+
+def test_live_claim_kept_and_last_attempt_failed(tmp_path):
+    queue, _ = submit_tiles(tmp_path, Ntile=1)
+    name, job = queue.claim()
+    with queue.heartbeat(name):
+        assert queue.requeue_stale() == []
+    assert os.path.exists(queue.path('running', name))
+
+    stale = time.time() - 2 * queue.lease
+    os.utime(queue.path('running', name), (stale, stale))
+    assert queue.requeue_stale(retries=1) == [name]
+    assert queue.report()['jobs'] == dict(todo=0, running=0, done=0, failed=1)
+    # the release of a requeued job is skipped
+    assert not queue.release(name, job, 'done')
+
+
+def test_dask_cluster_equals_single_process(tmp_path):
+    l2a_files = write_tiles(tmp_path, 3)
+    cluster = Cluster(n_workers=2)
+    try:
+        report = cluster.process(l2a_files, str(tmp_path / 'L2B'), eager_max_pixels=2 ** 20)
+    finally:
+        cluster.close()
+    assert cluster.failed == {}
+    assert sum(worker['tiles'] for worker in report.values()) == len(l2a_files)
+
+    for l2a_file in l2a_files:
+        single = l2b_name(l2a_file, str(tmp_path / 'single'))
+        process_tile(l2a_file, single, eager_max_pixels=2 ** 20)
+        with xr.open_dataset(l2b_name(l2a_file, str(tmp_path / 'L2B'))) as l2b_cluster, \
+                xr.open_dataset(single) as l2b_single:
+            assert set(l2b_cluster.data_vars) == set(l2b_single.data_vars)
+            for variable in l2b_single.data_vars:
+                np.testing.assert_array_equal(l2b_cluster[variable].values, l2b_single[variable].values)
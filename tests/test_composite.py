@@ -0,0 +1,54 @@
+import numpy as np
+
+from GRSl2bgen.composite import Composite
+
+from .conftest import synthetic_l2b
+
+
+def test_composite_statistics():
+    l2bs = [synthetic_l2b(seed) for seed in range(5)]
+    composite = Composite(l2bs, chunk=8, quantiles=[0.5]).process()
+
+    stack = np.stack([l2b.Chla_OC2.values for l2b in l2bs])
+    count = np.isfinite(stack).sum(axis=0)
+    np.testing.assert_array_equal(composite.Chla_OC2_count.values, count)
+    np.testing.assert_allclose(composite.Chla_OC2_mean.values, np.nanmean(stack, axis=0), rtol=1e-5)
+    valid = count > 1
+    np.testing.assert_allclose(composite.Chla_OC2_std.values[valid],
+                               np.nanstd(stack, axis=0, ddof=1)[valid], rtol=1e-4)
+    # the median is approximated within one bin of the log-scale histograms (128 bins over [1e-3, 100])
+    odd = count % 2 == 1
+    np.testing.assert_allclose(composite.Chla_OC2_q50.values[odd],
+                               np.nanmedian(stack, axis=0)[odd], rtol=10 ** (5 / 128) - 1)
+
+
+def test_composite_owt_mode():
+    l2bs = [synthetic_l2b(seed) for seed in range(3)]
+    # unpacked class indices are not exact integers
+    l2bs[0]['owt_index_A'] = l2bs[0].owt_index_A + 1e-4
+    l2bs[1]['owt_index_A'] = l2bs[0].owt_index_A
+    composite = Composite(l2bs, chunk=8).process()
+
+    # categorical variables get a mode and a count, no mean or quantiles
+    assert 'owt_index_A_mean' not in composite
+    assert 'owt_index_A_q50' not in composite
+    np.testing.assert_array_equal(composite.owt_index_A_mode.values, np.rint(l2bs[0].owt_index_A.values))
+    np.testing.assert_array_equal(composite.owt_index_A_count.values, 3)
+
+
+def test_composite_uncertainty_attrs(tmp_path, l2a_file):
+    from GRSl2bgen.process import Process
+
+    l2b_file = str(tmp_path / 'L2B.nc')
+    process = Process(l2a_file, l2b_file, uncertainty=True, quality=False)
+    process.execute()
+    process.write_output()
+    composite = Composite([l2b_file, l2b_file], variables=['SPM_nechad_unc', 'SPM_nechad']).process()
+
+    # X_unc statistics keep their own attributes, not those of X
+    unc_mean = composite.SPM_nechad_unc_mean
+    assert unc_mean.attrs['statistic'] == 'mean'
+    assert unc_mean.attrs['description'] == process.l2b.l2b_prod.SPM_nechad_unc.attrs['description']
+    assert composite.SPM_nechad_mean.attrs['statistic'] == 'mean'
+    assert composite.SPM_nechad_mean.attrs['description'] != unc_mean.attrs['description']
+    assert set(composite.data_vars) >= {'SPM_nechad_count', 'SPM_nechad_unc_count', 'SPM_nechad_unc_std'}
@@ -0,0 +1,23 @@
+import subprocess
+import sys
+
+import numpy as np
+
+from GRSl2bgen import kernels
+
+
+def test_import_does_not_compile():
+    code = ('import sys; import GRSl2bgen.process; '
+            'assert "numba" not in sys.modules, "numba loaded at import"')
+    subprocess.run([sys.executable, '-c', code], check=True)
+
+
+def test_sam_matches_numpy():
+    rng = np.random.default_rng(0)
+    Rrs = rng.random((5, 4, 3), dtype=np.float32)
+    Rrs_owt = rng.random((6, 5), dtype=np.float32)
+    owt_class, dist = kernels.sam_classify(Rrs, Rrs_owt, 5, 4, 3, 6)
+
+    spectra = Rrs.reshape(5, -1).T
+    cos = spectra @ Rrs_owt.T / np.linalg.norm(spectra, axis=1)[:, None] / np.linalg.norm(Rrs_owt, axis=1)
+    np.testing.assert_array_equal(owt_class.ravel(), np.argmax(cos, axis=1) + 1)
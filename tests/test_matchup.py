@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from GRSl2bgen.matchup import Matchup
+from GRSl2bgen.owt import OWT_process
+from GRSl2bgen.chlorophyll_a import Chl
+from GRSl2bgen.suspended_particulate_matter import Spm
+
+X0, Y0, RES = 600010., 4899990., 20.
+
+
+def stations():
+    # stations in the tile CRS, the last one too close to the edge for a 3x3 window
+    return pd.DataFrame(dict(id=['a', 'b', 'c'],
+                             lon=[X0 + RES * 10, X0 + RES * 30 + 5, X0 + RES * 47],
+                             lat=[Y0 - RES * 12, Y0 - RES * 20, Y0 - RES * 5]))
+
+
+def test_matchup_windows(l2a_raster):
+    matchup = Matchup(l2a_raster, stations(), stations_crs='EPSG:32631')
+    table = matchup.process()
+
+    assert list(table.id) == ['a', 'b']
+    assert list(table.row) == [12, 20] and list(table.col) == [10, 30]
+    for _, station in table.iterrows():
+        window = l2a_raster.Rrs.sel(wl=665).values[station.row - 1:station.row + 2, station.col - 1:station.col + 2]
+        np.testing.assert_allclose(station.Rrs_665, window[1, 1], rtol=1e-6)
+        np.testing.assert_allclose(station.Rrs_665_mean, np.nanmean(window), rtol=1e-6)
+        assert station.Rrs_665_n == np.isfinite(window).sum()
+
+
+def test_matchup_parameters_on_windows(l2a_raster):
+    '''
+    Parameters computed on the windows only are those of the full image at the stations.
+    '''
+    table = Matchup(l2a_raster, stations(), stations_crs='EPSG:32631').process()
+
+    owt_process = OWT_process(l2a_raster)
+    owt_process.execute()
+    full = [owt_process.output]
+    for algo in [Chl, Spm]:
+        algo_prod = algo(l2a_raster, unc_param=None)
+        algo_prod.process()
+        full.append(algo_prod.output)
+    full = xr.merge(full, compat='override')
+    for variable in full.data_vars:
+        if full[variable].dims != ('y', 'x'):
+            continue
+        expected = full[variable].values[table.row.values, table.col.values]
+        np.testing.assert_allclose(table[variable].values, expected, rtol=1e-5, err_msg=variable)
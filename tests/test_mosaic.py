@@ -0,0 +1,120 @@
+import numpy as np
+import xarray as xr
+import pytest
+
+from GRSl2bgen.mosaic import Mosaic
+
+
+def to_beam(cube):
+    '''
+    Same tile with the legacy "beam" profile (one variable per band).
+    '''
+    beam = cube.drop_vars(['Rrs', 'Rrs_g', 'Rrs_unc'])
+    for name in ['Rrs', 'Rrs_g', 'Rrs_unc']:
+        for wl in cube.wl.values:
+            beam['{}_{:d}'.format(name, wl)] = cube[name].sel(wl=wl, drop=True)
+    beam.attrs['metadata_profile'] = 'beam'
+    return beam
+
+
+def write_tiles(odir, tiles):
+    odir.mkdir()
+    files = []
+    for itile, tile in enumerate(tiles):
+        files.append(str(odir / 'L2A_tile{:d}.nc'.format(itile)))
+        tile.to_netcdf(files[-1])
+    return files
+
+
+def test_virtual_raster(tmp_path, l2a_raster):
+    # overlapping tiles covering the scene, one of them with the beam profile
+    tiles = [l2a_raster.isel(y=slice(0, 20), x=slice(0, 30)),
+             to_beam(l2a_raster.isel(y=slice(0, 20), x=slice(26, 48))),
+             l2a_raster.isel(y=slice(16, 32), x=slice(0, 30)),
+             l2a_raster.isel(y=slice(16, 32), x=slice(26, 48))]
+    # nodata in the overlap of the first tile: taken from the second one
+    tiles[0] = tiles[0].assign(Rrs=tiles[0].Rrs.where(tiles[0].x < float(l2a_raster.x[26])))
+    mosaic = Mosaic(write_tiles(tmp_path / 'tiles', tiles), chunk=16)
+
+    raster = mosaic.raster
+    assert (mosaic.height, mosaic.width) == (32, 48)
+    assert raster.rio.crs == l2a_raster.rio.crs
+    np.testing.assert_array_equal(raster.x.values, l2a_raster.x.values)
+    np.testing.assert_array_equal(raster.y.values, l2a_raster.y.values)
+    # windows straddling the tiles
+    for variable in ['Rrs', 'Rrs_unc', 'flags']:
+        np.testing.assert_array_equal(raster[variable].values, l2a_raster[variable].values)
+    np.testing.assert_array_equal(mosaic.read('Rrs', slice(10, 22), slice(20, 40), slice(2, 4)),
+                                  l2a_raster.Rrs.values[2:4, 10:22, 20:40])
+    mosaic.close()
+
+
+def test_overlap_order(tmp_path, l2a_raster):
+    tiles = [l2a_raster.isel(x=slice(0, 30)), l2a_raster.isel(x=slice(20, 48))]
+    tiles[1] = tiles[1].assign(Rrs=2 * tiles[1].Rrs)
+    files = write_tiles(tmp_path / 'tiles', tiles)
+    Rrs = l2a_raster.Rrs.values
+
+    first = Mosaic(files, overlap='first').raster.Rrs.values
+    np.testing.assert_array_equal(first[:, :, :30], Rrs[:, :, :30])
+    np.testing.assert_array_equal(first[:, :, 30:], 2 * Rrs[:, :, 30:])
+
+    last = Mosaic(files, overlap='last').raster.Rrs.values
+    np.testing.assert_array_equal(last[:, :, :20], Rrs[:, :, :20])
+    np.testing.assert_array_equal(last[:, :, 20:], 2 * Rrs[:, :, 20:])
+
+    with pytest.raises(ValueError):
+        Mosaic(files, overlap='mean')
+
+
+def test_grid_checks(tmp_path, l2a_raster):
+    tile = l2a_raster.isel(x=slice(0, 30))
+    other_crs = l2a_raster.isel(x=slice(20, 48)).rio.write_crs(32632)
+    with pytest.raises(ValueError, match='CRS'):
+        Mosaic(write_tiles(tmp_path / 'crs', [tile, other_crs]))
+
+    misaligned = l2a_raster.isel(x=slice(20, 48))
+    misaligned = misaligned.assign_coords(x=misaligned.x + 10)
+    with pytest.raises(ValueError, match='aligned'):
+        Mosaic(write_tiles(tmp_path / 'grid', [tile, misaligned]))
+
+
+def test_mosaic_process(tmp_path, l2a_raster, l2a_file):
+    from GRSl2bgen.process import Process
+
+    tiles = [l2a_raster.isel(x=slice(0, 30)), to_beam(l2a_raster.isel(x=slice(20, 48)))]
+    mosaic = Mosaic(write_tiles(tmp_path / 'tiles', tiles), chunk=16)
+    mosaic.process(str(tmp_path / 'L2B_mosaic.nc'), quality=False)
+    mosaic.close()
+    process = Process(l2a_file, str(tmp_path / 'L2B_scene.nc'), streaming=True, chunk=16, quality=False)
+    process.execute()
+    process.write_output()
+
+    with xr.open_dataset(str(tmp_path / 'L2B_mosaic.nc')) as l2b_mosaic, \
+            xr.open_dataset(str(tmp_path / 'L2B_scene.nc')) as l2b_scene:
+        for variable in l2b_scene.data_vars:
+            np.testing.assert_array_equal(l2b_mosaic[variable].values, l2b_scene[variable].values)
+
+
+def test_validity_read_once_per_window(tmp_path, l2a_raster, monkeypatch):
+    import dask
+
+    tiles = [l2a_raster.isel(x=slice(0, 30)), to_beam(l2a_raster.isel(x=slice(20, 48)))]
+    mosaic = Mosaic(write_tiles(tmp_path / 'tiles', tiles), chunk=16)
+    misses = []
+    valid = Mosaic.valid
+
+    def counted_valid(self, index, local, Rrs0=None):
+        key = (index, local['y'].start, local['y'].stop, local['x'].start, local['x'].stop)
+        if key not in self._valid_cache:
+            misses.append(key)
+        return valid(self, index, local, Rrs0)
+
+    monkeypatch.setattr(Mosaic, 'valid', counted_valid)
+    with dask.config.set(scheduler='synchronous'):
+        raster = mosaic.raster.compute()
+    for variable in ['Rrs', 'Rrs_g', 'Rrs_unc', 'flags']:
+        np.testing.assert_array_equal(raster[variable].values, l2a_raster[variable].values)
+    # one mask per window and intersecting input (2 rows x 2 column windows per tile), shared by all the variables
+    assert len(misses) == len(set(misses)) == 2 * 2 * 2
+    mosaic.close()
@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import xarray as xr
+
+from GRSl2bgen.output import L2bProduct, blosc_threads
+
+from .conftest import synthetic_l2b
+
+
+def test_blosc_threads_restored(tmp_path, monkeypatch):
+    monkeypatch.delenv('BLOSC_NTHREADS', raising=False)
+    with blosc_threads(4):
+        assert os.environ['BLOSC_NTHREADS'] == '4'
+    assert 'BLOSC_NTHREADS' not in os.environ
+
+    monkeypatch.setenv('BLOSC_NTHREADS', '2')
+    l2b = L2bProduct(None, [synthetic_l2b(0)], nthreads=8)
+    l2b.export_to_netcdf(str(tmp_path / 'L2B.nc'))
+    assert os.environ['BLOSC_NTHREADS'] == '2'
+
+
+def export(l2b_prod, ofile, packing):
+    l2b = L2bProduct(None, [l2b_prod], packing=packing)
+    l2b.export_to_netcdf(ofile)
+    return L2bProduct.decode(xr.open_dataset(ofile))
+
+
+def test_packing_round_trip(tmp_path):
+    l2b_prod = synthetic_l2b(1)
+    Chla = l2b_prod.Chla_OC2.values
+    for packing in ['data', 'range']:
+        written = export(l2b_prod, str(tmp_path / ('L2B_' + packing + '.nc')), packing)
+        step = written.Chla_OC2.encoding['scale_factor']
+        np.testing.assert_array_equal(np.isnan(written.Chla_OC2.values), np.isnan(Chla))
+        np.testing.assert_allclose(written.Chla_OC2.values, Chla, atol=0.5 * step + 1e-9)
+
+    written = export(l2b_prod, str(tmp_path / 'L2B_log.nc'), 'log')
+    step = xr.open_dataset(str(tmp_path / 'L2B_log.nc')).Chla_OC2.encoding['scale_factor']
+    np.testing.assert_allclose(written.Chla_OC2.values, Chla, rtol=10 ** (0.5 * step) - 1 + 1e-6)
+
+
+def test_range_packing_masks_out_of_range(tmp_path):
+    l2b_prod = synthetic_l2b(2)
+    Chla = l2b_prod.Chla_OC2.values
+    Chla[0, :4] = [-1., 150., 1e4, 100.]
+    for packing in ['range', 'log']:
+        written = export(l2b_prod, str(tmp_path / ('L2B_' + packing + '.nc')), packing).Chla_OC2.values
+        # out of the declared range [0, 100]: masked, not saturated to the bounds
+        assert np.isnan(written[0, :3]).all()
+        np.testing.assert_allclose(written[0, 3], 100., rtol=1e-3)
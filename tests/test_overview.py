@@ -0,0 +1,37 @@
+import os
+import functools
+
+import numpy as np
+import xarray as xr
+import pytest
+
+from GRSl2bgen.overview import Overviews
+
+
+@pytest.mark.parametrize('packing', ['data', 'range'])
+def test_overviews_equal_coarsened_product(tmp_path, l2a_file, packing):
+    from GRSl2bgen.process import Process
+
+    ofile = str(tmp_path / 'L2B.nc')
+    process = Process(l2a_file, ofile, overviews=(2, 4), quicklooks=True, packing=packing, quality=False)
+    process.execute()
+    process.write_output()
+
+    with xr.open_dataset(ofile) as l2b:
+        for factor in (2, 4):
+            with xr.open_dataset(ofile, group='overview_{:d}'.format(factor)) as level:
+                for variable in level.data_vars:
+                    full = l2b[variable].coarsen(y=factor, x=factor, boundary='trim')
+                    if variable.startswith('owt_index'):
+                        Nclass = int(l2b[variable].attrs['range'][1])
+                        expected = full.reduce(functools.partial(Overviews.class_mode, Nclass=Nclass))
+                        np.testing.assert_array_equal(level[variable].values, expected.values, err_msg=variable)
+                    else:
+                        # the full-resolution product is rounded to its packing step
+                        step = float(l2b[variable].encoding.get('scale_factor', 0))
+                        np.testing.assert_allclose(level[variable].values, full.mean().values, rtol=1e-5,
+                                                   atol=step if step > 0 else 1e-6, err_msg=variable)
+
+    root = os.path.splitext(ofile)[0]
+    for quicklook in ['_rgb', '_owt_index_Spyrakos2018', '_owt_index_Bi2024', '_Chla_OC2nasa']:
+        assert os.path.getsize(root + quicklook + '.png') > 0
@@ -0,0 +1,37 @@
+import numpy as np
+import xarray as xr
+import pytest
+
+from GRSl2bgen.owt import OWT
+
+
+def hyperspectral_raster(shape=(12, 16), seed=0):
+    '''
+    Hyperspectral Rrs cube (5 nm bands) built from noisy mixtures of the reference spectra.
+    '''
+    rng = np.random.default_rng(seed)
+    wl = np.arange(400, 801, 5.)
+    ref = OWT(xr.Dataset(dict(Rrs=(('wl', 'y', 'x'), np.ones((len(wl), 1, 1), dtype=np.float32))),
+                         coords=dict(wl=wl, y=[0], x=[0]))).Rrs_owt.transpose('owt', 'wl').values
+    weights = rng.dirichlet(0.3 * np.ones(len(ref)), size=shape)
+    Rrs = np.einsum('yxo,ow->wyx', weights, ref) * (1 + 0.05 * rng.standard_normal((len(wl),) + shape))
+    Rrs[:, 0, 0] = np.nan
+    return xr.Dataset(dict(Rrs=(('wl', 'y', 'x'), Rrs.astype(np.float32))),
+                      coords=dict(wl=wl, y=np.arange(shape[0]), x=np.arange(shape[1])))
+
+
+@pytest.mark.parametrize('layout', ['bip', 'bsq'])
+def test_pca_keeps_full_band_distance(layout):
+    raster = hyperspectral_raster()
+    full = OWT(raster, layout=layout).process_raster()
+    pca = OWT(raster, reduction='pca', n_components=16, layout=layout).process_raster()
+
+    np.testing.assert_array_equal(pca.owt_index.values, full.owt_index.values)
+    np.testing.assert_allclose(pca.owt_dist.values, full.owt_dist.values, atol=1e-5)
+    assert 'full-band' in pca.owt_dist.attrs['reduction']
+
+
+def test_reduced_space_distance_is_flagged():
+    raster = hyperspectral_raster()
+    binned = OWT(raster, reduction='binning', n_components=8).process_raster()
+    assert 'reduced space' in binned.owt_dist.attrs['reduction']
@@ -0,0 +1,124 @@
+import numpy as np
+import xarray as xr
+import pytest
+
+from GRSl2bgen.process import Process
+
+
+def run(l2a_file, l2b_file, **kwargs):
+    process = Process(l2a_file, l2b_file, **kwargs)
+    process.execute()
+    process.write_output()
+    return xr.open_dataset(l2b_file, mask_and_scale=False)
+
+
+def test_streaming_matches_lazy_processing(l2a_file, tmp_path):
+    # small windows so that reads and writes of many windows overlap
+    streamed = run(l2a_file, str(tmp_path / 'L2B_streaming.nc'), streaming=True, chunk=8)
+    lazy = run(l2a_file, str(tmp_path / 'L2B_lazy.nc'), packing='range', eager_max_pixels=0,
+               chunk=16, scheduler='threads')
+
+    assert sorted(streamed.data_vars) == sorted(lazy.data_vars)
+    for variable in lazy.data_vars:
+        if lazy[variable].dims != ('y', 'x'):
+            continue
+        fill = lazy[variable].attrs.get('_FillValue')
+        np.testing.assert_array_equal(streamed[variable].values == fill, lazy[variable].values == fill,
+                                      err_msg=variable)
+        # packed values may differ by rounding (netCDF4 and xarray encoders)
+        np.testing.assert_allclose(streamed[variable].values, lazy[variable].values, atol=1, err_msg=variable)
+
+
+def test_eager_processing_without_dask(l2a_file, tmp_path):
+    import GRSl2bgen.process
+
+    process = Process(l2a_file, str(tmp_path / 'L2B_eager.nc'), eager_max_pixels=GRSl2bgen.process.EAGER_MAX_PIXELS)
+    process.execute()
+    assert process.eager
+    assert isinstance(process.prod.raster.Rrs.data, np.ndarray)
+    assert all(isinstance(process.l2b.l2b_prod[variable].data, np.ndarray) for variable in process.l2b.variables)
+    process.write_output()
+
+    # eager mode is opt-in
+    assert Process(l2a_file).eager_max_pixels == 0
+
+
+@pytest.mark.parametrize('packing', [None, 'data'])
+def test_lazy_parameters_computed_once(l2a_file, tmp_path, monkeypatch, packing):
+    '''
+    The OWT classification of each chunk runs once for the export and the quality statistics
+    (and the packing ranges with the "data" packing).
+    '''
+    from GRSl2bgen.owt import OWT
+
+    calls = []
+    classify_bip = OWT.classify_bip
+
+    def counted(self, Rrs):
+        if Rrs.size > 0:
+            calls.append(self.owt_database)
+        return classify_bip(self, Rrs)
+
+    monkeypatch.setattr(OWT, 'classify_bip', counted)
+    process = Process(l2a_file, str(tmp_path / 'L2B.nc'), chunk=16, scheduler='threads', packing=packing)
+    process.execute()
+    process.write_output()
+    # 32 x 48 pixels in 16 x 16 chunks, for each OWT database
+    assert len(calls) == 6 * len(set(calls))
+
+
+def test_lazy_processing_bounded(l2a_file, tmp_path, monkeypatch):
+    '''
+    With the default packing, the lazy product is never persisted: the parameters are computed
+    and written chunk by chunk.
+    '''
+    import dask.array as da
+    from GRSl2bgen.output import L2bProduct
+
+    def persist(self):
+        raise AssertionError('whole product persisted in memory')
+
+    monkeypatch.setattr(L2bProduct, 'persist', persist)
+    process = Process(l2a_file, str(tmp_path / 'L2B.nc'), chunk=16, scheduler='threads')
+    process.execute()
+    assert process.packing == 'range'
+    l2b_prod = process.l2b.l2b_prod
+    assert all(isinstance(l2b_prod[variable].data, da.Array) for variable in process.l2b.variables)
+    process.write_output()
+
+
+def test_streaming_failure_leaves_no_output(l2a_file, tmp_path, monkeypatch):
+    from GRSl2bgen.pipeline import Pipeline
+
+    write_window = Pipeline.write_window
+    calls = []
+
+    def failing_write_window(nc, l2b, *window):
+        calls.append(window)
+        if len(calls) == 3:
+            raise IOError('disk full')
+        write_window(nc, l2b, *window)
+
+    monkeypatch.setattr(Pipeline, 'write_window', staticmethod(failing_write_window))
+    l2b_file = tmp_path / 'L2B_streaming.nc'
+    process = Process(l2a_file, str(l2b_file), streaming=True, chunk=8)
+    with pytest.raises(IOError, match='disk full'):
+        process.execute()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_streaming_reads_owt_references_once(l2a_file, tmp_path, monkeypatch):
+    from GRSl2bgen import owt
+
+    monkeypatch.setattr(owt, '_database_cache', {})
+    read_csv = owt.pd.read_csv
+    calls = []
+
+    def counted_read_csv(*args, **kwargs):
+        calls.append(args[0])
+        return read_csv(*args, **kwargs)
+
+    monkeypatch.setattr(owt.pd, 'read_csv', counted_read_csv)
+    process = Process(l2a_file, str(tmp_path / 'L2B_streaming.nc'), streaming=True, chunk=8)
+    process.execute()
+    assert len(calls) == 2
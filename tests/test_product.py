@@ -0,0 +1,24 @@
+import numpy as np
+import dask.array as da
+
+from GRSl2bgen.product import Product
+from GRSl2bgen.regression import synthetic_l2a
+
+
+def test_beam_profile_cubes(tmp_path):
+    beam_file = str(tmp_path / 'L2A_beam.nc')
+    synthetic_l2a('beam', shape=(32, 48)).to_netcdf(beam_file)
+    cube = synthetic_l2a('datacube', shape=(32, 48))
+
+    prod = Product(beam_file)
+    raster = prod.raster
+    assert raster.Rrs.dims == ('wl', 'y', 'x')
+    assert not any(variable.startswith('Rrs_4') for variable in raster.data_vars)
+    # all the variables stay dask-backed, the bands being read per spatial chunk
+    assert isinstance(raster.Rrs.data, da.Array) and isinstance(raster.flags.data, da.Array)
+    np.testing.assert_array_equal(raster.Rrs.values, cube.Rrs.values)
+    np.testing.assert_array_equal(raster.Rrs_g.values, cube.Rrs_g.values)
+    np.testing.assert_array_equal(raster.Rrs_unc.values, cube.Rrs_unc.values)
+    np.testing.assert_array_equal(raster.Rrs.isel(wl=3).values, cube.Rrs.isel(wl=3).values)
+    np.testing.assert_array_equal(raster.flags.values, cube.flags.values)
+    raster.close()
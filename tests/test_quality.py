@@ -0,0 +1,31 @@
+import numpy as np
+
+from GRSl2bgen.quality import Quality
+
+from .conftest import synthetic_l2b
+
+
+def test_quality_counts():
+    l2b_prod = synthetic_l2b(3)
+    l2b_prod.Chla_OC2.values[0, :5] = 500.
+    valid = l2b_prod.mask == 0
+    Chla = l2b_prod.Chla_OC2.values
+
+    qa = Quality(pixel_area=400.)
+    qa.build(l2b_prod, valid, ranges=True)
+    qa.update()
+    stats = qa.get_stats()
+    in_range = np.isfinite(Chla) & (Chla <= 100)
+    assert stats['pixels'] == Chla.size
+    np.testing.assert_allclose(stats['parameters']['Chla_OC2']['valid_fraction'], in_range.mean())
+    np.testing.assert_allclose(stats['parameters']['Chla_OC2']['out_of_range_fraction'], 1 - in_range.mean())
+    for owt in [1, 2, 3]:
+        np.testing.assert_allclose(stats['owt_area_km2']['owt_index_A'][owt],
+                                   (l2b_prod.owt_index_A.values == owt).sum() * 400. / 1e6)
+
+    # windows accumulated one after the other (streaming) give the same counts
+    windowed = Quality(pixel_area=400.)
+    for rows in [slice(0, 7), slice(7, 20)]:
+        windowed.build(l2b_prod.isel(y=rows), valid.isel(y=rows), ranges=True)
+        windowed.update()
+    assert windowed.get_stats() == stats
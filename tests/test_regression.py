@@ -0,0 +1,17 @@
+from GRSl2bgen import regression
+
+
+def test_engines_match_golden(tmp_path):
+    report = regression.run(odir=str(tmp_path))
+    failures = {(profile, engine): result for profile, results in report.items()
+                for engine, result in results.items() if not result['passed']}
+    assert failures == {}
+
+
+def test_golden_provenance():
+    import xarray as xr
+
+    with xr.open_dataset(regression.GOLDEN_FILE) as golden:
+        assert golden.attrs['golden_engine'].startswith(regression.REFERENCE_ENGINE)
+        assert golden.attrs['golden_tolerance'] == regression.TOLERANCE
+        assert golden.attrs['golden_commit'] != 'unknown'
@@ -0,0 +1,43 @@
+import gc
+import os
+
+import pytest
+
+from GRSl2bgen.product import Product
+from GRSl2bgen.process import Process
+
+
+def test_scratch_removed_on_failure(l2a_file, tmp_path, monkeypatch):
+    scratch_dir = tmp_path / 'scratch'
+    scratch_dir.mkdir()
+
+    def fail(self):
+        raise RuntimeError('OWT failure')
+
+    monkeypatch.setattr('GRSl2bgen.process.OWT_process.execute', fail)
+    process = Process(l2a_file, str(tmp_path / 'L2B.nc'), scratch_dir=str(scratch_dir), layout='bsq',
+                      eager_max_pixels=0, scheduler='threads')
+    with pytest.raises(RuntimeError):
+        process.execute()
+    assert os.listdir(scratch_dir) == []
+
+
+def test_scratch_removed_with_product(l2a_file, tmp_path):
+    prod = Product(l2a_file)
+    prod.to_scratch(str(tmp_path), layout='bip')
+    scratch_file = prod.scratch_file
+    assert os.path.exists(scratch_file)
+    del prod
+    gc.collect()
+    assert not os.path.exists(scratch_file)
+
+
+def test_scratch_removed_after_output(l2a_file, tmp_path):
+    scratch_dir = tmp_path / 'scratch'
+    scratch_dir.mkdir()
+    process = Process(l2a_file, str(tmp_path / 'L2B.nc'), scratch_dir=str(scratch_dir), layout='bip',
+                      eager_max_pixels=0, scheduler='threads')
+    process.execute()
+    assert len(os.listdir(scratch_dir)) == 1
+    process.write_output()
+    assert os.listdir(scratch_dir) == []
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+from GRSl2bgen.spectra import Spectra
+
+PARAMETERS = ['owt_index_Spyrakos2018', 'owt_dist_Spyrakos2018', 'owt_index_Bi2024', 'owt_dist_Bi2024',
+              'Chla_OC2nasa', 'Chla_M09B', 'SPM_obs2co', 'TURB_dogliotti', 'SPM_nechad', 'acdom_B15', 'Kd_par']
+
+
+def test_spectra_equal_raster_processing(tmp_path, l2a_raster, l2a_file):
+    from GRSl2bgen.process import Process
+
+    process = Process(l2a_file, str(tmp_path / 'L2B.nc'), eager_max_pixels=2 ** 20)
+    process.execute()
+    l2b = process.l2b.l2b_prod
+
+    # pixels in and out of the invalid block
+    iy, ix = np.array([0, 3, 10, 20, 31]), np.array([0, 5, 12, 40, 47])
+    pixels = l2a_raster.Rrs.isel(y=xr.DataArray(iy, dims='pixel'), x=xr.DataArray(ix, dims='pixel'))
+    Rrs = pd.DataFrame(pixels.transpose('pixel', 'wl').values, columns=l2a_raster.wl.values)
+    parameters = Spectra(Rrs).process()
+
+    for parameter in PARAMETERS:
+        np.testing.assert_allclose(parameters[parameter].values, l2b[parameter].values[iy, ix],
+                                   rtol=1e-5, atol=1e-6, err_msg=parameter)
+    assert parameters[PARAMETERS].iloc[:2].isnull().all().all()
+
+
+def test_spectra_wavelengths(l2a_raster):
+    Rrs = l2a_raster.Rrs.isel(y=20, x=slice(10, 14)).transpose('x', 'wl').values
+
+    # spectral range missing the bands of the algorithms: NaN parameters
+    parameters = Spectra(Rrs[:, :4], wl=[400, 410, 420, 430]).process(owt=False)
+    assert parameters.isnull().all().all()
+
+    # no band within the spectral range of the OWT classification
+    with pytest.raises(ValueError, match='OWT'):
+        Spectra(Rrs[:, :3], wl=[1200, 1300, 1400]).process()
+
+    with pytest.raises(ValueError):
+        Spectra(Rrs, wl=[443, 490, 560])
+
+
+def test_nan_spectra(l2a_raster):
+    Rrs = l2a_raster.Rrs.isel(y=20, x=slice(10, 14)).transpose('x', 'wl').values.copy()
+    Rrs[1] = np.nan
+    parameters = Spectra(Rrs, wl=l2a_raster.wl.values).process()
+    assert parameters.iloc[1].isnull().all()
+    assert parameters.drop(index=1).notnull().all().all()
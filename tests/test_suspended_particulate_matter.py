@@ -0,0 +1,18 @@
+import numpy as np
+import dask.array as da
+
+from GRSl2bgen.suspended_particulate_matter import Spm
+
+
+def test_spm_kept_lazy(l2a_raster):
+    eager = Spm(l2a_raster, unc_param='Rrs_unc')
+    eager.process()
+
+    lazy = Spm(l2a_raster.chunk({'wl': -1, 'y': 16, 'x': 16}), unc_param='Rrs_unc')
+    lazy.process()
+    assert 'wl' not in lazy.output.coords
+    for variable in eager.output.data_vars:
+        assert isinstance(lazy.output[variable].data, da.Array), variable
+        np.testing.assert_array_equal(lazy.output[variable].values, eager.output[variable].values,
+                                      err_msg=variable)
+        assert lazy.output[variable].attrs == eager.output[variable].attrs
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from GRSl2bgen.owt import OWT
+from GRSl2bgen.regression import synthetic_l2a
+from GRSl2bgen.tuning import ChunkPlan, MIN_WINDOW
+
+
+@pytest.mark.parametrize('memory', [2 ** 28, 2 ** 30, 2 ** 34])
+def test_plan_memory_budget(memory):
+    plan = ChunkPlan(10980, 10980, 11, Nworkers=8, memory=memory)
+    bytes_per_pixel = (plan.Nwl + plan.Nowt + 2) * plan.itemsize
+    budget = plan.memory_fraction * memory / plan.Nworkers
+    assert (plan.window ** 2 * bytes_per_pixel <= budget) or (plan.window == MIN_WINDOW)
+    # at least two windows per worker, dask chunks made of whole windows
+    assert plan.window ** 2 * 2 * plan.Nworkers <= 10980 ** 2
+    assert plan.chunks['wl'] == -1
+    assert plan.chunks['y'] % plan.window == 0
+
+
+def test_calibrate_classify(monkeypatch):
+    raster = synthetic_l2a('datacube', shape=(600, 600))
+    plan = ChunkPlan(600, 600, raster.sizes['wl'], Nworkers=1, memory=2 ** 32)
+    OWT_kernel = OWT(raster)
+
+    # the production kernel is timed, not the kernel storing every angle
+    def SAM(*args):
+        raise AssertionError('OWT.SAM timed')
+
+    monkeypatch.setattr(OWT, 'SAM', staticmethod(SAM))
+    candidates = (256, 512)
+    window = plan.calibrate(OWT_kernel, candidates=candidates)
+    assert window in candidates
+    assert set(plan.calibration) <= {str(candidate) for candidate in candidates}
+
+
+@pytest.mark.parametrize('layout', ['bip', 'bsq'])
+def test_lazy_windows(layout):
+    raster = synthetic_l2a('datacube', shape=(64, 96)).chunk({'wl': -1, 'y': 64, 'x': 96})
+    whole = OWT(raster, chunk=1024, layout=layout).lazy_process()
+    windows = OWT(raster, chunk=24, layout=layout).lazy_process()
+    for variable in whole.data_vars:
+        np.testing.assert_array_equal(windows[variable].values, whole[variable].values)
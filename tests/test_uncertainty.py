@@ -0,0 +1,64 @@
+import logging
+
+import numpy as np
+import pytest
+
+from GRSl2bgen.chlorophyll_a import Chl
+from GRSl2bgen.suspended_particulate_matter import Spm
+from GRSl2bgen.cdom import Cdom
+from GRSl2bgen.transparency import Transparency
+from GRSl2bgen.output import L2bProduct
+
+
+def test_no_propagation_by_default(l2a_raster):
+    chl = Chl(l2a_raster)
+    chl.process()
+    assert not any(variable.endswith('_unc') for variable in chl.output.data_vars)
+
+
+def test_missing_uncertainty_skipped(l2a_raster, caplog):
+    # Rrs_g is the sunglint reflectance, not an uncertainty
+    with caplog.at_level(logging.WARNING):
+        chl = Chl(l2a_raster.drop_vars('Rrs_unc'), unc_param='Rrs_unc')
+    assert 'Rrs_unc' in caplog.text
+    chl.process()
+    assert not any(variable.endswith('_unc') for variable in chl.output.data_vars)
+
+
+@pytest.mark.parametrize('algorithm, parameter', [(Chl, 'Chla_OC2nasa'), (Chl, 'Chla_M09B'),
+                                                   (Spm, 'SPM_obs2co'), (Spm, 'TURB_dogliotti'), (Spm, 'SPM_nechad'),
+                                                   (Cdom, 'acdom_B15'), (Transparency, 'Kd_par')])
+def test_first_order_propagation(l2a_raster, algorithm, parameter):
+    raster = l2a_raster.isel(y=slice(8, 16), x=slice(8, 20))
+    model = algorithm(raster, unc_param='Rrs_unc')
+    model.process()
+    value = model.output[parameter]
+
+    # finite differences, the bands being independent
+    variance = 0.
+    for iwl in range(raster.sizes['wl']):
+        eps = 1e-3 * np.abs(raster.Rrs.isel(wl=iwl)) + 1e-7
+        perturbed = raster.copy()
+        perturbed['Rrs'] = raster.Rrs + eps.where(raster.wl == raster.wl[iwl], 0)
+        model_eps = algorithm(perturbed)
+        model_eps.process()
+        derivative = (model_eps.output[parameter] - value) / eps
+        variance = variance + (derivative * raster.Rrs_unc.isel(wl=iwl)) ** 2
+    unc = model.output[parameter + '_unc'].values
+    expected = np.sqrt(variance).values
+    # the derivative is not defined where the values are clipped to the declared range
+    vmin, vmax = value.attrs['range']
+    finite = np.isfinite(expected) & (value > vmin).values & (value < vmax).values
+    assert finite.sum() > 0
+    np.testing.assert_allclose(unc[finite], expected[finite], rtol=1e-2, err_msg=parameter)
+
+
+def test_uncertainty_packed_linearly(l2a_raster):
+    spm = Spm(l2a_raster, unc_param='Rrs_unc')
+    spm.process()
+    l2b = L2bProduct(None, [spm.output], packing='log')
+    assert l2b.pack(spm.output.SPM_nechad)[0].attrs['packing'] == 'log10'
+    unc, scale_factor, add_offset = l2b.pack(spm.output.SPM_nechad_unc)
+    assert 'packing' not in unc.attrs
+    np.testing.assert_allclose(unc.values, spm.output.SPM_nechad_unc.where(
+        spm.output.SPM_nechad_unc <= spm.output.SPM_nechad_unc.attrs['range'][1]).values)
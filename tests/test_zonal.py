@@ -0,0 +1,59 @@
+import numpy as np
+
+from GRSl2bgen.zonal import ZonalStats
+
+from .conftest import synthetic_l2b
+
+
+def box(x0, y0, x1, y1):
+    return dict(type='Polygon', coordinates=[[(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)]])
+
+
+def test_zonal_statistics():
+    l2b = synthetic_l2b(0).rio.write_crs(32631)
+    # zones covering the rows 2-9 / columns 3-14 and the rows 12-19 / columns 20-29 (pixel centers inside)
+    zones = [(box(600000. + 20 * 3, 4900000. - 20 * 10, 600000. + 20 * 15, 4900000. - 20 * 2), 'lake_a'),
+             (box(600000. + 20 * 20, 4900000. - 20 * 20, 600000. + 20 * 30, 4900000. - 20 * 12), 'lake_b')]
+    stats = ZonalStats(l2b, zones).process()
+
+    assert list(stats.zone_id) == ['lake_a', 'lake_b']
+    for (rows, cols), (_, zone) in zip([(slice(2, 10), slice(3, 15)), (slice(12, 20), slice(20, 30))],
+                                       stats.iterrows()):
+        values = l2b.Chla_OC2.values[rows, cols]
+        assert zone.npix == values.size
+        np.testing.assert_allclose(zone.Chla_OC2_mean, np.nanmean(values))
+        np.testing.assert_allclose(zone.Chla_OC2_median, np.nanmedian(values))
+        np.testing.assert_allclose(zone.Chla_OC2_std, np.nanstd(values), rtol=1e-6)
+        np.testing.assert_allclose(zone.Chla_OC2_valid_fraction, np.isfinite(values).mean())
+        classes = l2b.owt_index_A.values[rows, cols]
+        for owt in [1, 2, 3]:
+            assert zone['owt_index_A_owt{:d}'.format(owt)] == (classes == owt).sum()
+
+
+def test_zonal_statistics_of_processed_product(l2a_file, tmp_path):
+    import pandas as pd
+    from GRSl2bgen.process import Process
+
+    zones = [(box(600000. + 20 * 3, 4900000. - 20 * 30, 600000. + 20 * 40, 4900000. - 20 * 10), 1)]
+    l2b_file = str(tmp_path / 'L2B.nc')
+    process = Process(l2a_file, l2b_file, zones=zones, chunk=16, scheduler='threads')
+    process.execute()
+    process.write_output()
+
+    # statistics of the written (packed) product
+    expected = ZonalStats(l2b_file, zones).process()
+    written = pd.read_csv(str(tmp_path / 'L2B_zonal.csv'))
+    pd.testing.assert_frame_equal(written, expected, check_dtype=False)
+
+
+def test_label_cache_bounded(tmp_path):
+    from GRSl2bgen import zonal
+
+    l2b = synthetic_l2b(0).rio.write_crs(32631)
+    for i in range(5):
+        zones = [(box(600000. + 20 * i, 4900000. - 20 * 10, 600000. + 20 * (i + 5), 4900000.), 1)]
+        stats = ZonalStats(l2b, zones, cache_dir=str(tmp_path))
+        assert len(zonal._label_cache) <= zonal.LABEL_CACHE_SIZE
+    # the most recent label raster is kept in memory, the evicted ones stay on disk
+    assert any(labels is stats.labels for labels in zonal._label_cache.values())
+    assert len(list(tmp_path.glob('zones_*.npy'))) == 5